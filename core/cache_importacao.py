@@ -0,0 +1,133 @@
+# core/cache_importacao.py
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - (cache_importacao) - %(message)s')
+
+NOME_ARQUIVO_CACHE = ".AuditPlusCacheImportacao.sqlite"
+# Incrementar quando a extração ou as regras mudarem o dicionário produzido para um mesmo ZIP
+VERSAO_FORMATO_CACHE = 2
+TAMANHO_BLOCO_HASH = 1024 * 1024
+
+
+def calcular_hash_arquivo(caminho_arquivo):
+    """SHA-256 do conteúdo do arquivo, lido em blocos."""
+    hash_conteudo = hashlib.sha256()
+    with open(caminho_arquivo, 'rb') as arquivo:
+        for bloco in iter(lambda: arquivo.read(TAMANHO_BLOCO_HASH), b''):
+            hash_conteudo.update(bloco)
+    return hash_conteudo.hexdigest()
+
+
+def calcular_versao_dados(*partes):
+    """
+    Resume em um hash os dados de referência que influenciam o resultado da importação (listas
+    de referência, códigos HM a ignorar, mapa de Unimeds, regras...). Conjuntos
+    são ordenados para que a versão não dependa da ordem de carga.
+    """
+    serializado = json.dumps([VERSAO_FORMATO_CACHE, *partes], sort_keys=True, ensure_ascii=False,
+                             default=lambda valor: sorted(valor) if isinstance(valor, (set, frozenset)) else str(valor))
+    return hashlib.sha256(serializado.encode('utf-8')).hexdigest()
+
+
+class CacheImportacao:
+    """
+    Cache persistente (SQLite na pasta importada) do dicionário de cada fatura.
+
+    A chave é o conteúdo do ZIP (SHA-256 + tamanho) junto com o modo de leitura e a versão dos
+    dados de referência; o modo fica numa coluna própria para que alternar entre modos na mesma
+    pasta não descarte as entradas dos outros (ver remover_versoes_antigas). Para não recalcular o hash de ZIPs inalterados, a tabela 'arquivos' guarda o
+    último hash visto para cada nome, com tamanho e mtime: se os dois conferem, o hash
+    registrado é reaproveitado; senão o arquivo é relido e o hash recalculado (um ZIP
+    copiado ou com a data alterada, mas com o mesmo conteúdo, continua sendo acerto).
+    """
+
+    def __init__(self, pasta_importacao, versao_dados, modo_leitura):
+        self.caminho_banco = os.path.join(pasta_importacao, NOME_ARQUIVO_CACHE)
+        self.versao_dados = versao_dados
+        self.modo_leitura = modo_leitura
+        self._conexao = sqlite3.connect(self.caminho_banco)
+        # Banco de uma versão anterior, com o modo de leitura dentro de versao_dados: as entradas não
+        # servem para a chave atual
+        colunas_faturas = {coluna[1] for coluna in self._conexao.execute("PRAGMA table_info(faturas)")}
+        if colunas_faturas and 'modo_leitura' not in colunas_faturas: self._conexao.execute("DROP TABLE faturas")
+        self._conexao.executescript("""
+            CREATE TABLE IF NOT EXISTS arquivos (
+                nome_zip TEXT PRIMARY KEY,
+                tamanho INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS faturas (
+                sha256 TEXT NOT NULL,
+                tamanho INTEGER NOT NULL,
+                modo_leitura TEXT NOT NULL,
+                versao_dados TEXT NOT NULL,
+                dados_json TEXT NOT NULL,
+                gravado_em REAL NOT NULL,
+                PRIMARY KEY (sha256, tamanho, modo_leitura, versao_dados)
+            );
+        """)
+        self._conexao.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo_excecao, excecao, rastreamento_pilha):
+        self.fechar()
+
+    def fechar(self):
+        if self._conexao is not None:
+            self._conexao.close()
+            self._conexao = None
+
+    def _identificar_arquivo(self, caminho_zip):
+        """Retorna (sha256, tamanho) do ZIP, reaproveitando o hash quando tamanho e mtime não mudaram."""
+        estado = os.stat(caminho_zip)
+        nome_zip = os.path.basename(caminho_zip)
+        registro = self._conexao.execute("SELECT tamanho, mtime_ns, sha256 FROM arquivos WHERE nome_zip = ?",
+                                         (nome_zip,)).fetchone()
+        if registro and registro[0] == estado.st_size and registro[1] == estado.st_mtime_ns:
+            return registro[2], estado.st_size
+        sha256 = calcular_hash_arquivo(caminho_zip)
+        self._conexao.execute("INSERT OR REPLACE INTO arquivos (nome_zip, tamanho, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                              (nome_zip, estado.st_size, estado.st_mtime_ns, sha256))
+        self._conexao.commit()
+        return sha256, estado.st_size
+
+    def obter(self, caminho_zip):
+        """
+        Retorna o dicionário da fatura gravado para este conteúdo de ZIP, ou None se não houver.
+        'caminho_zip_original' e 'nome_zip' são sempre os do arquivo atual.
+        """
+        sha256, tamanho = self._identificar_arquivo(caminho_zip)
+        registro = self._conexao.execute(
+            "SELECT dados_json FROM faturas WHERE sha256 = ? AND tamanho = ? AND modo_leitura = ? AND versao_dados = ?",
+            (sha256, tamanho, self.modo_leitura, self.versao_dados)).fetchone()
+        if not registro:
+            return None
+        dados_fatura = json.loads(registro[0])
+        dados_fatura['caminho_zip_original'] = caminho_zip
+        dados_fatura['nome_zip'] = os.path.basename(caminho_zip)
+        return dados_fatura
+
+    def gravar(self, caminho_zip, dados_fatura):
+        sha256, tamanho = self._identificar_arquivo(caminho_zip)
+        self._conexao.execute(
+            "INSERT OR REPLACE INTO faturas (sha256, tamanho, modo_leitura, versao_dados, dados_json, gravado_em) VALUES (?, ?, ?, ?, ?, ?)",
+            (sha256, tamanho, self.modo_leitura, self.versao_dados, json.dumps(dados_fatura, ensure_ascii=False), time.time()))
+        self._conexao.commit()
+
+    def remover_versoes_antigas(self):
+        """
+        Apaga as entradas gravadas com outra versão dos dados de referência, de qualquer modo de leitura
+        (as dos outros modos com a versão atual continuam valendo). Retorna quantas foram removidas.
+        """
+        cursor = self._conexao.execute("DELETE FROM faturas WHERE versao_dados <> ?", (self.versao_dados,))
+        self._conexao.commit()
+        return cursor.rowcount
@@ -1,13 +1,22 @@
 # core/file_manager.py
 
 import os
+import sys
 import glob
+import json
+import time
+import hashlib
+import contextlib
 import shutil
+import struct
 import zipfile
 import tempfile
 import logging # Garanta que logging esteja importado no início
 
+from utils import rastreamento
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - (file_manager) - %(message)s')
+_RASTRO = rastreamento.obter_canal(rastreamento.CANAL_ZIP)
 
 def listar_arquivos_zip(caminho_pasta):
     """
@@ -22,6 +31,17 @@ def listar_arquivos_zip(caminho_pasta):
     lista_zips = glob.glob(padrao_busca)
     return lista_zips
 
+def listar_arquivos_051(caminho_pasta):
+    """
+    Lista os arquivos .051 (XMLs PTU extraídos para correção) de uma pasta, em ordem de nome.
+    Retorna uma lista de caminhos completos.
+    """
+    if not os.path.isdir(caminho_pasta):
+        logging.error(f"O caminho '{caminho_pasta}' não é uma pasta válida.")
+        return []
+
+    return sorted(glob.glob(os.path.join(caminho_pasta, "*.051")))
+
 def criar_pasta_backup(pasta_raiz_faturas):
     """
     Cria uma subpasta chamada 'Backup' dentro da pasta raiz das faturas, se não existir.
@@ -75,35 +95,257 @@ def fazer_backup_fatura(caminho_fatura_original, caminho_pasta_backup):
         logging.error(f"Falha ao copiar '{nome_arquivo}' para backup. Erro: {e}")
         return False
 
-def extrair_xml_fatura_do_zip(caminho_zip, pasta_destino_extracao):
+NOME_PASTA_OBJETOS_BACKUP = ".objetos"
+NOME_PASTA_OBJETOS_BACKUP_COMPARTILHADA = ".objetos_backup_auditplus"
+NOME_MANIFESTO_BACKUP = "manifesto_backup.jsonl"
+TAMANHO_BLOCO_COPIA = 8 * 1024 * 1024
+
+def hash_conteudo_arquivo(caminho_arquivo):
+    hash_conteudo = hashlib.sha256()
+    with open(caminho_arquivo, 'rb') as arquivo:
+        for bloco in iter(lambda: arquivo.read(TAMANHO_BLOCO_COPIA), b''):
+            hash_conteudo.update(bloco)
+    return hash_conteudo.hexdigest()
+
+def _copiar_conteudo_arquivo(origem, destino):
     """
-    Extrai o arquivo .051 (XML da fatura) de dentro de um arquivo .zip.
+    Copia 'origem' para 'destino' usando os.copy_file_range quando disponível (no Linux o
+    kernel copia sem passar pelo Python e, em btrfs/xfs, pode fazer reflink). Em qualquer
+    falha dessa via, usa shutil.copyfile. Preserva as datas do arquivo de origem.
     """
-    nome_base_zip, _ = os.path.splitext(os.path.basename(caminho_zip))
-    nome_arquivo_xml_interno_esperado = nome_base_zip + ".051"
-    caminho_completo_xml_extraido = os.path.join(pasta_destino_extracao, nome_arquivo_xml_interno_esperado)
+    copiado = False
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(origem, 'rb') as arquivo_origem, open(destino, 'wb') as arquivo_destino:
+                tamanho_restante = os.fstat(arquivo_origem.fileno()).st_size
+                while tamanho_restante > 0:
+                    copiados = os.copy_file_range(arquivo_origem.fileno(), arquivo_destino.fileno(),
+                                                  min(tamanho_restante, TAMANHO_BLOCO_COPIA))
+                    if copiados == 0: break
+                    tamanho_restante -= copiados
+            copiado = tamanho_restante == 0
+        except OSError:
+            copiado = False
+    if not copiado:
+        shutil.copyfile(origem, destino)
+    shutil.copystat(origem, destino)
+
+# Manifestos já lidos neste processo: {caminho: (posição lida, última entrada de cada nome)}.
+# Como o manifesto só recebe acréscimos, cada leitura processa apenas as linhas novas.
+_manifestos_lidos = {}
+
+def pasta_objetos_backup_compartilhada(caminho_pasta_backup):
+    """
+    Repositório de objetos ao lado das pastas de importação ('<pasta acima da importação>/.objetos_backup_auditplus'):
+    pastas de importação vizinhas (ex: uma por competência) guardam uma única vez a mesma fatura e,
+    estando no mesmo sistema de arquivos, os backups visíveis continuam sendo hardlinks.
+    """
+    pasta_importacao = os.path.dirname(os.path.abspath(caminho_pasta_backup))
+    return os.path.join(os.path.dirname(pasta_importacao), NOME_PASTA_OBJETOS_BACKUP_COMPARTILHADA)
+
+def _ler_manifesto_backup(caminho_pasta_backup):
+    """Lê o manifesto (JSON Lines, só acréscimos) e retorna a última entrada de cada nome de arquivo."""
+    caminho_manifesto = os.path.join(caminho_pasta_backup, NOME_MANIFESTO_BACKUP)
+    if not os.path.exists(caminho_manifesto):
+        _manifestos_lidos.pop(caminho_manifesto, None)
+        return {}
+    posicao, entradas = _manifestos_lidos.get(caminho_manifesto, (0, {}))
+    if os.path.getsize(caminho_manifesto) < posicao: posicao, entradas = 0, {} # Manifesto recriado
+    with open(caminho_manifesto, 'rb') as manifesto:
+        manifesto.seek(posicao)
+        for linha in manifesto:
+            if not linha.endswith(b"\n"): break # Linha ainda sendo gravada: fica para a próxima leitura
+            posicao += len(linha)
+            try:
+                entrada = json.loads(linha)
+            except ValueError:
+                continue # Linha truncada por uma gravação interrompida
+            entradas[entrada['nome']] = entrada
+    _manifestos_lidos[caminho_manifesto] = (posicao, entradas)
+    return entradas
+
+def _registrar_no_manifesto_backup(caminho_pasta_backup, entrada):
+    # Uma linha pequena em modo append: gravações concorrentes (workers da importação) não se misturam
+    with open(os.path.join(caminho_pasta_backup, NOME_MANIFESTO_BACKUP), 'a', encoding='utf-8') as manifesto:
+        manifesto.write(json.dumps(entrada, ensure_ascii=False) + "\n")
+
+def _caminho_objeto_backup(caminho_fatura_original, sha256, pasta_objetos):
+    _, extensao = os.path.splitext(caminho_fatura_original)
+    return os.path.join(pasta_objetos, sha256[:2], sha256 + extensao.lower())
+
+def _guardar_objeto_backup_calculando_hash(caminho_fatura_original, pasta_objetos):
+    """
+    Copia o arquivo para o repositório de objetos calculando o SHA-256 na mesma leitura e retorna
+    (sha256, caminho do objeto). Se o conteúdo já estava guardado, a cópia temporária é descartada.
+    """
+    os.makedirs(pasta_objetos, exist_ok=True)
+    caminho_temporario = os.path.join(pasta_objetos, f".{os.path.basename(caminho_fatura_original)}.{os.getpid()}.tmp")
+    hash_conteudo = hashlib.sha256()
+    try:
+        with open(caminho_fatura_original, 'rb') as arquivo_origem, open(caminho_temporario, 'wb') as arquivo_destino:
+            for bloco in iter(lambda: arquivo_origem.read(TAMANHO_BLOCO_COPIA), b''):
+                hash_conteudo.update(bloco)
+                arquivo_destino.write(bloco)
+        shutil.copystat(caminho_fatura_original, caminho_temporario)
+        sha256 = hash_conteudo.hexdigest()
+        caminho_objeto = _caminho_objeto_backup(caminho_fatura_original, sha256, pasta_objetos)
+        if not os.path.exists(caminho_objeto):
+            os.makedirs(os.path.dirname(caminho_objeto), exist_ok=True)
+            os.replace(caminho_temporario, caminho_objeto)
+    finally:
+        if os.path.exists(caminho_temporario): os.remove(caminho_temporario)
+    return sha256, caminho_objeto
+
+def _guardar_objeto_backup(caminho_fatura_original, sha256, pasta_objetos):
+    """Garante que o conteúdo está no repositório de objetos (uma cópia por hash) e retorna o caminho do objeto."""
+    caminho_objeto = _caminho_objeto_backup(caminho_fatura_original, sha256, pasta_objetos)
+    pasta_prefixo = os.path.dirname(caminho_objeto)
+    if os.path.exists(caminho_objeto):
+        return caminho_objeto
+    os.makedirs(pasta_prefixo, exist_ok=True)
+    caminho_temporario = f"{caminho_objeto}.{os.getpid()}.tmp"
+    try:
+        _copiar_conteudo_arquivo(caminho_fatura_original, caminho_temporario)
+        os.replace(caminho_temporario, caminho_objeto)
+    finally:
+        if os.path.exists(caminho_temporario): os.remove(caminho_temporario)
+    return caminho_objeto
+
+def _materializar_objeto_backup(caminho_objeto, caminho_destino_backup):
+    """Cria o arquivo visível em 'Backup' como hardlink do objeto; em outro sistema de arquivos, copia."""
+    try:
+        os.link(caminho_objeto, caminho_destino_backup)
+        return "hardlink"
+    except FileExistsError:
+        return "existente"
+    except OSError:
+        _copiar_conteudo_arquivo(caminho_objeto, caminho_destino_backup)
+        return "copia"
+
+def _backup_tem_conteudo(caminho_destino_backup, sha256, tamanho, entrada_anterior):
+    if entrada_anterior:
+        return entrada_anterior['sha256'] == sha256
+    # Backup feito antes do manifesto existir: compara o conteúdo uma única vez
+    return os.path.getsize(caminho_destino_backup) == tamanho and hash_conteudo_arquivo(caminho_destino_backup) == sha256
+
+def fazer_backup_fatura_deduplicado(caminho_fatura_original, caminho_pasta_backup, pasta_objetos=None):
+    """
+    Backup com armazenamento por conteúdo (SHA-256), sem copiar de novo o que já está guardado.
+
+    - Se o manifesto já registra este nome com o mesmo tamanho e mtime e o arquivo existe em
+      'Backup', nada é lido nem copiado.
+    - Sem backup visível, o arquivo é lido uma única vez: copiado para o repositório de objetos
+      enquanto o hash é calculado (descartando a cópia se o conteúdo já estava guardado).
+    - Com backup visível, o arquivo é lido uma vez para o hash e só é copiado se o conteúdo mudou.
+    - O conteúdo fica em '<pasta_objetos>/<2 primeiros>/<sha256>.zip' (padrão: 'Backup/.objetos';
+      uma pasta compartilhada deduplica também entre pastas de importação diferentes) e o
+      arquivo visível 'Backup/<nome>' é um hardlink para o objeto quando os dois estão no mesmo
+      sistema de arquivos (copy_file_range/cópia caso contrário).
+    - Como em fazer_backup_fatura, um 'Backup/<nome>' existente nunca é sobrescrito; uma versão
+      diferente do mesmo nome fica guardada como objeto e registrada no manifesto.
+    Retorna True se o backup for bem-sucedido, False caso contrário.
+    """
+    if not os.path.isfile(caminho_fatura_original):
+        logging.error(f"Arquivo original '{caminho_fatura_original}' não encontrado para backup.")
+        return False
+    if not os.path.isdir(caminho_pasta_backup):
+        logging.error(f"Pasta de backup '{caminho_pasta_backup}' não encontrada.")
+        return False
+
+    nome_arquivo = os.path.basename(caminho_fatura_original)
+    caminho_destino_backup = os.path.join(caminho_pasta_backup, nome_arquivo)
+    pasta_objetos = pasta_objetos or os.path.join(caminho_pasta_backup, NOME_PASTA_OBJETOS_BACKUP)
 
     try:
-        with zipfile.ZipFile(caminho_zip, 'r') as arquivo_zip_aberto:
-            lista_arquivos_no_zip = arquivo_zip_aberto.namelist()
-            arquivo_xml_para_extrair = None
+        estado = os.stat(caminho_fatura_original)
+        entrada_anterior = _ler_manifesto_backup(caminho_pasta_backup).get(nome_arquivo)
+        if (entrada_anterior and entrada_anterior['tamanho'] == estado.st_size
+                and entrada_anterior['mtime_ns'] == estado.st_mtime_ns and os.path.exists(caminho_destino_backup)):
+            logging.info(f"Backup de '{nome_arquivo}' já existe e o arquivo não mudou. Nenhuma ação necessária.")
+            return True
 
-            if nome_arquivo_xml_interno_esperado in lista_arquivos_no_zip:
-                arquivo_xml_para_extrair = nome_arquivo_xml_interno_esperado
+        if not os.path.exists(caminho_destino_backup):
+            sha256, caminho_objeto = _guardar_objeto_backup_calculando_hash(caminho_fatura_original, pasta_objetos)
+            acao = _materializar_objeto_backup(caminho_objeto, caminho_destino_backup)
+        else:
+            sha256 = hash_conteudo_arquivo(caminho_fatura_original)
+            if _backup_tem_conteudo(caminho_destino_backup, sha256, estado.st_size, entrada_anterior):
+                acao = "inalterado"
             else:
-                for nome_no_zip in lista_arquivos_no_zip:
-                    if nome_no_zip.lower().endswith(".051"):
-                        logging.info(f"Nome exato '{nome_arquivo_xml_interno_esperado}' não encontrado em '{os.path.basename(caminho_zip)}'. Usando alternativo '{nome_no_zip}'.")
-                        arquivo_xml_para_extrair = nome_no_zip
-                        caminho_completo_xml_extraido = os.path.join(pasta_destino_extracao, arquivo_xml_para_extrair)
-                        break
+                caminho_objeto = _guardar_objeto_backup(caminho_fatura_original, sha256, pasta_objetos)
+                acao = _materializar_objeto_backup(caminho_objeto, caminho_destino_backup)
+            if acao == "existente":
+                logging.info(f"Backup de '{nome_arquivo}' já existe com outro conteúdo; nova versão guardada em '{os.path.basename(caminho_objeto)}'.")
+        _registrar_no_manifesto_backup(caminho_pasta_backup, {
+            'nome': nome_arquivo, 'sha256': sha256, 'tamanho': estado.st_size, 'mtime_ns': estado.st_mtime_ns,
+            'origem': os.path.abspath(caminho_fatura_original), 'acao': acao, 'registrado_em': time.time()})
+        return True
+    except Exception as e:
+        logging.error(f"Falha ao criar backup deduplicado de '{nome_arquivo}'. Erro: {e}")
+        return False
 
+def _localizar_xml_fatura_no_zip(arquivo_zip_aberto, caminho_zip):
+    """
+    Retorna o nome do membro .051 dentro de um ZIP já aberto, priorizando o nome
+    igual ao do próprio ZIP. Retorna None se nenhum .051 for encontrado.
+    """
+    nome_base_zip, _ = os.path.splitext(os.path.basename(caminho_zip))
+    nome_arquivo_xml_interno_esperado = nome_base_zip + ".051"
+    lista_arquivos_no_zip = arquivo_zip_aberto.namelist()
+
+    if nome_arquivo_xml_interno_esperado in lista_arquivos_no_zip:
+        return nome_arquivo_xml_interno_esperado
+    for nome_no_zip in lista_arquivos_no_zip:
+        if nome_no_zip.lower().endswith(".051"):
+            logging.info(f"Nome exato '{nome_arquivo_xml_interno_esperado}' não encontrado em '{os.path.basename(caminho_zip)}'. Usando alternativo '{nome_no_zip}'.")
+            return nome_no_zip
+    logging.error(f"Nenhum arquivo .051 (ex: '{nome_arquivo_xml_interno_esperado}') encontrado dentro de '{os.path.basename(caminho_zip)}'.")
+    return None
+
+@contextlib.contextmanager
+def abrir_xml_fatura_do_zip(caminho_zip):
+    """
+    Abre o .051 de dentro do ZIP como um stream de leitura, sem gravar nada em disco.
+    Uso:
+        with abrir_xml_fatura_do_zip(caminho_zip) as (nome_xml, stream_xml):
+            ...
+    O stream pode ser passado diretamente para o lxml (etree.parse / iterparse).
+    Em caso de falha, produz (None, None).
+    """
+    try:
+        arquivo_zip_aberto = zipfile.ZipFile(caminho_zip, 'r')
+    except zipfile.BadZipFile:
+        logging.error(f"Arquivo '{os.path.basename(caminho_zip)}' não é um ZIP válido ou está corrompido.")
+        yield None, None
+        return
+    except Exception as e:
+        logging.exception(f"Falha ao abrir '{os.path.basename(caminho_zip)}'. Erro: {e}")
+        yield None, None
+        return
+
+    with arquivo_zip_aberto:
+        nome_xml_interno = _localizar_xml_fatura_no_zip(arquivo_zip_aberto, caminho_zip)
+        if not nome_xml_interno:
+            yield None, None
+            return
+        if _RASTRO.ativo:
+            info_xml = arquivo_zip_aberto.getinfo(nome_xml_interno)
+            _RASTRO.registrar("xml_aberto_do_zip", zip=os.path.basename(caminho_zip), membro=nome_xml_interno,
+                              bytes=info_xml.file_size, bytes_comprimidos=info_xml.compress_size)
+        with arquivo_zip_aberto.open(nome_xml_interno) as stream_xml:
+            yield nome_xml_interno, stream_xml
+
+def extrair_xml_fatura_do_zip(caminho_zip, pasta_destino_extracao):
+    """
+    Extrai o arquivo .051 (XML da fatura) de dentro de um arquivo .zip.
+    """
+    try:
+        with zipfile.ZipFile(caminho_zip, 'r') as arquivo_zip_aberto:
+            arquivo_xml_para_extrair = _localizar_xml_fatura_no_zip(arquivo_zip_aberto, caminho_zip)
             if arquivo_xml_para_extrair:
                 arquivo_zip_aberto.extract(arquivo_xml_para_extrair, path=pasta_destino_extracao)
-                return caminho_completo_xml_extraido
-            else:
-                logging.error(f"Nenhum arquivo .051 (ex: '{nome_arquivo_xml_interno_esperado}') encontrado dentro de '{os.path.basename(caminho_zip)}'.")
-                return None
+                return os.path.join(pasta_destino_extracao, arquivo_xml_para_extrair)
+            return None
     except zipfile.BadZipFile:
         logging.error(f"Arquivo '{os.path.basename(caminho_zip)}' não é um ZIP válido ou está corrompido.")
         return None
@@ -121,6 +363,58 @@ def remover_arquivo_se_existe(caminho_arquivo):
         logging.warning(f"Não foi possível remover o arquivo '{os.path.basename(caminho_arquivo)}'. Erro: {e}")
     return False
 
+# --- XMLs corrigidos na importação (reaproveitados na etapa de correção) ---
+NOME_PASTA_XMLS_CORRIGIDOS = ".xmls_corrigidos"
+EXTENSAO_XML_INALTERADO = ".inalterado"
+
+def pasta_xmls_corrigidos(pasta_raiz_correcao_xml):
+    """Pasta 'Correção XML/.xmls_corrigidos', onde a importação guarda o .051 já com as regras aplicadas."""
+    return os.path.join(pasta_raiz_correcao_xml, NOME_PASTA_XMLS_CORRIGIDOS)
+
+def _nome_xml_corrigido(sha256_original, chave_regras):
+    return f"{sha256_original}-{chave_regras}"
+
+def guardar_xml_corrigido(pasta_xmls, sha256_original, chave_regras, caminho_xml_corrigido=None):
+    """
+    Guarda o resultado das regras para o .051 cujo conteúdo original tem hash 'sha256_original',
+    com as regras identificadas por 'chave_regras'. O arquivo em 'caminho_xml_corrigido' é movido
+    para a pasta; None registra que as regras não alteraram nada (só um marcador vazio).
+    Retorna o caminho guardado, ou None se falhar.
+    """
+    nome_base = _nome_xml_corrigido(sha256_original, chave_regras)
+    try:
+        os.makedirs(pasta_xmls, exist_ok=True)
+        if caminho_xml_corrigido is None:
+            caminho_destino = os.path.join(pasta_xmls, nome_base + EXTENSAO_XML_INALTERADO)
+            with open(caminho_destino, 'wb'):
+                pass
+            return caminho_destino
+        caminho_destino = os.path.join(pasta_xmls, nome_base + ".051")
+        try:
+            os.replace(caminho_xml_corrigido, caminho_destino)
+        except OSError:
+            shutil.move(caminho_xml_corrigido, caminho_destino)
+        return caminho_destino
+    except Exception as e:
+        logging.error(f"Falha ao guardar o XML corrigido '{nome_base}' em '{pasta_xmls}'. Erro: {e}")
+        return None
+
+def localizar_xml_corrigido(pasta_xmls, caminho_xml_original, chave_regras):
+    """
+    Procura o resultado guardado por guardar_xml_corrigido para o conteúdo atual de
+    'caminho_xml_original' e as mesmas regras. Retorna (caminho do .051 corrigido, False),
+    (None, True) se as regras não alteravam o arquivo, ou (None, False) se não houver nada guardado.
+    """
+    if not os.path.isdir(pasta_xmls) or not os.path.isfile(caminho_xml_original):
+        return None, False
+    nome_base = _nome_xml_corrigido(hash_conteudo_arquivo(caminho_xml_original), chave_regras)
+    caminho_corrigido = os.path.join(pasta_xmls, nome_base + ".051")
+    if os.path.isfile(caminho_corrigido):
+        return caminho_corrigido, False
+    if os.path.exists(os.path.join(pasta_xmls, nome_base + EXTENSAO_XML_INALTERADO)):
+        return None, True
+    return None, False
+
 def organizar_faturas_por_auditor(plano_distribuicao, pasta_base_onde_faturas_estao, pasta_base_para_distribuicao):
     if not plano_distribuicao:
         logging.error("Plano de distribuição está vazio. Nada a organizar.")
@@ -243,13 +537,137 @@ def recriar_zip_com_novo_xml(caminho_zip_original, caminho_xml_modificado, nome_
     Returns:
         tuple: (bool, str) - True e o caminho do novo ZIP em caso de sucesso, False e msg de erro em caso de falha.
     """
-    if not os.path.exists(caminho_zip_original):
-        logging.error(f"Erro: Arquivo ZIP original não encontrado: {caminho_zip_original}")
-        return False, f"Arquivo ZIP original não encontrado: {caminho_zip_original}"
     if not os.path.exists(caminho_xml_modificado):
         logging.error(f"Erro: Arquivo XML modificado não encontrado: {caminho_xml_modificado}")
         return False, f"Arquivo XML modificado não encontrado: {caminho_xml_modificado}"
 
+    def adicionar_xml(zip_write):
+        zip_write.write(caminho_xml_modificado, arcname=nome_xml_dentro_zip)
+        return os.path.getsize(caminho_xml_modificado)
+
+    return _recriar_zip(caminho_zip_original, nome_xml_dentro_zip, pasta_destino_novos_zips, adicionar_xml)
+
+
+def recriar_zip_gravando_xml(caminho_zip_original, escrever_xml, nome_xml_dentro_zip, pasta_destino_novos_zips):
+    """
+    Como recriar_zip_com_novo_xml, mas o XML novo não vem de um arquivo: 'escrever_xml(arquivo)'
+    o escreve num arquivo binário aberto para escrita. O XML é serializado uma única vez, em memória
+    (ou em disco, se passar de _TAMANHO_MAXIMO_XML_EM_MEMORIA), e copiado de lá para a entrada do ZIP,
+    inclusive quando _recriar_zip precisa refazer o ZIP.
+    Um erro em 'escrever_xml' é tratado como qualquer falha na criação do ZIP.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=_TAMANHO_MAXIMO_XML_EM_MEMORIA) as xml_serializado:
+        try:
+            escrever_xml(xml_serializado)
+        except Exception as e:
+            logging.exception(f"Erro ao serializar o XML '{nome_xml_dentro_zip}' para '{os.path.basename(caminho_zip_original)}': {e}")
+            return False, f"Erro ao criar novo ZIP: {e}"
+
+        def adicionar_xml(zip_write):
+            info_xml = zipfile.ZipInfo(nome_xml_dentro_zip, date_time=time.localtime()[:6])
+            info_xml.compress_type = zipfile.ZIP_DEFLATED
+            info_xml.external_attr = 0o644 << 16
+            xml_serializado.seek(0)
+            with zip_write.open(info_xml, 'w') as arquivo_xml:
+                shutil.copyfileobj(xml_serializado, arquivo_xml, _TAMANHO_BLOCO_COPIA)
+            return info_xml.file_size
+
+        return _recriar_zip(caminho_zip_original, nome_xml_dentro_zip, pasta_destino_novos_zips, adicionar_xml)
+
+
+# Membros inalterados do ZIP original (anexos da fatura) são copiados com os bytes já comprimidos,
+# sem descomprimir e comprimir de novo; False volta à cópia por zip_read.read() + writestr.
+#
+# O zipfile não tem API pública para isso: a cópia escreve em zip_write.fp a partir de
+# zip_write.start_dir e registra o membro em zip_write.filelist / NameToInfo, de onde close() monta o
+# diretório central, e lê o cabeçalho local com zipfile.structFileHeader. Esses internos não mudaram
+# nas versões de _VERSOES_PYTHON_COPIA_SEM_RECOMPRIMIR; fora delas (ou se faltar algum atributo) a
+# cópia recomprime. Antes de ampliar a faixa, rodar 'python -m core.file_manager' na nova versão.
+# Cada ZIP gerado assim ainda é conferido (_conferir_membros_copiados) e refeito se não conferir.
+COPIAR_MEMBROS_SEM_RECOMPRIMIR = True
+_VERSOES_PYTHON_COPIA_SEM_RECOMPRIMIR = ((3, 8), (3, 13))
+_ATRIBUTOS_INTERNOS_ZIPFILE = ('fp', 'start_dir', 'filelist', 'NameToInfo', '_seekable', '_writing')
+_TAMANHO_BLOCO_COPIA = 1024 * 1024
+_TAMANHO_MAXIMO_XML_EM_MEMORIA = 64 * 1024 * 1024
+_ID_EXTRA_ZIP64 = 0x0001
+_FLAG_DESCRITOR_DE_DADOS = 0x08
+
+def _pode_copiar_sem_recomprimir(zip_write):
+    """
+    A cópia sem recomprimir depende de atributos internos do zipfile (ver o comentário acima): só é
+    usada nas versões conferidas do Python, com todos os atributos presentes, num arquivo com seek e
+    sem outra entrada aberta para escrita.
+    """
+    versao_minima, versao_maxima = _VERSOES_PYTHON_COPIA_SEM_RECOMPRIMIR
+    return (COPIAR_MEMBROS_SEM_RECOMPRIMIR and versao_minima <= sys.version_info[:2] <= versao_maxima
+            and all(hasattr(zip_write, atributo) for atributo in _ATRIBUTOS_INTERNOS_ZIPFILE)
+            and zip_write._seekable and not zip_write._writing)
+
+def _extra_sem_zip64(extra):
+    """Campo extra sem o bloco ZIP64 (FileHeader e o diretório central o recriam quando preciso)."""
+    blocos = []
+    posicao = 0
+    while posicao + 4 <= len(extra):
+        id_bloco, tamanho = struct.unpack('<HH', extra[posicao:posicao + 4])
+        if id_bloco != _ID_EXTRA_ZIP64: blocos.append(extra[posicao:posicao + 4 + tamanho])
+        posicao += 4 + tamanho
+    return b"".join(blocos)
+
+def _copiar_membro_sem_recomprimir(arquivo_original, item, zip_write):
+    """
+    Copia o membro 'item' do ZIP original (aberto em 'arquivo_original', binário) para 'zip_write' com os
+    bytes comprimidos e o CRC como estão: só o cabeçalho local é refeito, já com CRC e tamanhos (sem o
+    descritor de dados que o original possa ter usado).
+    """
+    arquivo_original.seek(item.header_offset)
+    cabecalho_original = struct.unpack(zipfile.structFileHeader, arquivo_original.read(zipfile.sizeFileHeader))
+    if cabecalho_original[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Cabeçalho local inválido para o membro '{item.filename}'.")
+    # Nome e campo extra do cabeçalho local (os dois últimos campos) podem diferir dos do diretório central
+    arquivo_original.seek(cabecalho_original[-2] + cabecalho_original[-1], os.SEEK_CUR)
+
+    info = zipfile.ZipInfo(item.filename, item.date_time)
+    info.compress_type = item.compress_type
+    info.comment = item.comment
+    info.extra = _extra_sem_zip64(item.extra)
+    info.create_system = item.create_system
+    info.create_version = item.create_version
+    info.extract_version = item.extract_version
+    info.flag_bits = item.flag_bits & ~_FLAG_DESCRITOR_DE_DADOS
+    info.volume = item.volume
+    info.internal_attr = item.internal_attr
+    info.external_attr = item.external_attr
+    info.CRC = item.CRC
+    info.compress_size = item.compress_size
+    info.file_size = item.file_size
+
+    destino = zip_write.fp
+    destino.seek(zip_write.start_dir)
+    info.header_offset = destino.tell()
+    destino.write(info.FileHeader())
+    restante = item.compress_size
+    while restante > 0:
+        bloco = arquivo_original.read(min(restante, _TAMANHO_BLOCO_COPIA))
+        if not bloco: raise zipfile.BadZipFile(f"Dados do membro '{item.filename}' truncados no ZIP original.")
+        destino.write(bloco)
+        restante -= len(bloco)
+    zip_write.start_dir = destino.tell()
+    zip_write.filelist.append(info)
+    zip_write.NameToInfo[info.filename] = info
+
+
+def _recriar_zip(caminho_zip_original, nome_xml_dentro_zip, pasta_destino_novos_zips, adicionar_xml):
+    """
+    Copia para um ZIP de mesmo nome em 'pasta_destino_novos_zips' os membros do original, menos o XML,
+    e chama 'adicionar_xml(zip_write)' para incluir o novo (retorna o tamanho do XML incluído).
+    Os membros copiados não são recomprimidos (ver COPIAR_MEMBROS_SEM_RECOMPRIMIR): o tempo depende
+    do XML novo, não do tamanho dos anexos. Se o ZIP assim gerado não conferir com o original
+    (_conferir_membros_copiados), ele é refeito recomprimindo os membros.
+    """
+    if not os.path.exists(caminho_zip_original):
+        logging.error(f"Erro: Arquivo ZIP original não encontrado: {caminho_zip_original}")
+        return False, f"Arquivo ZIP original não encontrado: {caminho_zip_original}"
+
     os.makedirs(pasta_destino_novos_zips, exist_ok=True)
 
     # O nome do novo ZIP será o mesmo do original
@@ -266,21 +684,18 @@ def recriar_zip_com_novo_xml(caminho_zip_original, caminho_xml_modificado, nome_
             return False, f"Erro: Não foi possível remover ZIP de destino existente: {e}"
 
     try:
-        with zipfile.ZipFile(caminho_zip_original, 'r') as zip_read:
-            with zipfile.ZipFile(caminho_novo_zip, 'w', zipfile.ZIP_DEFLATED) as zip_write:
-                # Copiar todos os arquivos do ZIP original, exceto o XML que será substituído
-                for item in zip_read.infolist():
-                    if item.filename == nome_xml_dentro_zip:
-                        logging.info(f"Ignorando o XML antigo '{nome_xml_dentro_zip}' no ZIP original para o novo ZIP.")
-                        continue # Pula o XML antigo
-
-                    data = zip_read.read(item.filename)
-                    zip_write.writestr(item, data)
-                    logging.debug(f"Copiado '{item.filename}' para o novo ZIP.")
-
-                # Adicionar o novo XML modificado
-                zip_write.write(caminho_xml_modificado, arcname=nome_xml_dentro_zip)
-                logging.info(f"Novo XML '{nome_xml_dentro_zip}' adicionado ao novo ZIP.")
+        try:
+            copiados_sem_recomprimir = _gravar_zip_recriado(caminho_zip_original, caminho_novo_zip, nome_xml_dentro_zip,
+                                                            adicionar_xml, COPIAR_MEMBROS_SEM_RECOMPRIMIR)
+            divergencia = _conferir_membros_copiados(caminho_zip_original, caminho_novo_zip, nome_xml_dentro_zip) if copiados_sem_recomprimir else None
+        except (zipfile.BadZipFile, struct.error) as e:
+            if not COPIAR_MEMBROS_SEM_RECOMPRIMIR: raise
+            divergencia = str(e)
+        if divergencia:
+            # Nunca deixar um ZIP corrompido: refaz com a cópia por zip_read.read() + writestr
+            logging.warning(f"Cópia sem recomprimir de '{nome_base_zip}' não conferiu ({divergencia}); recriando o ZIP recomprimindo os membros.")
+            if os.path.exists(caminho_novo_zip): os.remove(caminho_novo_zip)
+            _gravar_zip_recriado(caminho_zip_original, caminho_novo_zip, nome_xml_dentro_zip, adicionar_xml, False)
 
         return True, caminho_novo_zip
 
@@ -291,11 +706,121 @@ def recriar_zip_com_novo_xml(caminho_zip_original, caminho_xml_modificado, nome_
         logging.exception(f"Erro ao recriar ZIP com novo XML para '{os.path.basename(caminho_zip_original)}': {e}")
         return False, f"Erro ao criar novo ZIP: {e}"
 
+def _gravar_zip_recriado(caminho_zip_original, caminho_novo_zip, nome_xml_dentro_zip, adicionar_xml, sem_recomprimir):
+    """
+    Escreve o ZIP recriado de _recriar_zip. Retorna True se os membros foram copiados sem recomprimir
+    ('sem_recomprimir' e o ZipFile de escrita permite, ver _pode_copiar_sem_recomprimir).
+    """
+    nome_base_zip = os.path.basename(caminho_zip_original)
+    with zipfile.ZipFile(caminho_zip_original, 'r') as zip_read, open(caminho_zip_original, 'rb') as arquivo_original:
+        with zipfile.ZipFile(caminho_novo_zip, 'w', zipfile.ZIP_DEFLATED) as zip_write:
+            copiar_sem_recomprimir = sem_recomprimir and _pode_copiar_sem_recomprimir(zip_write)
+            # Copiar todos os arquivos do ZIP original, exceto o XML que será substituído
+            for item in zip_read.infolist():
+                if item.filename == nome_xml_dentro_zip:
+                    logging.info(f"Ignorando o XML antigo '{nome_xml_dentro_zip}' no ZIP original para o novo ZIP.")
+                    continue # Pula o XML antigo
+
+                if copiar_sem_recomprimir:
+                    _copiar_membro_sem_recomprimir(arquivo_original, item, zip_write)
+                else:
+                    data = zip_read.read(item.filename)
+                    zip_write.writestr(item, data)
+                if _RASTRO.ativo: _RASTRO.registrar("membro_copiado", zip=nome_base_zip, membro=item.filename, bytes=item.file_size,
+                                                    bytes_comprimidos=item.compress_size, recomprimido=not copiar_sem_recomprimir)
 
-# Bloco de teste (para rodar 'python core/file_manager.py' diretamente)
+            # Adicionar o novo XML modificado
+            bytes_xml = adicionar_xml(zip_write)
+            logging.info(f"Novo XML '{nome_xml_dentro_zip}' adicionado ao novo ZIP.")
+            if _RASTRO.ativo: _RASTRO.registrar("xml_substituido_no_zip", zip=nome_base_zip, membro=nome_xml_dentro_zip,
+                                                bytes=bytes_xml)
+    return copiar_sem_recomprimir
+
+def _conferir_membros_copiados(caminho_zip_original, caminho_novo_zip, nome_xml_dentro_zip):
+    """
+    Conferência barata do ZIP recriado sem recomprimir (sem descomprimir nada): os membros copiados,
+    na ordem do original, têm o CRC, os tamanhos e o método do original no diretório central, e o
+    cabeçalho local de cada um é aceito pelo próprio zipfile. Retorna a primeira divergência, ou None.
+    """
+    with zipfile.ZipFile(caminho_zip_original) as zip_original, zipfile.ZipFile(caminho_novo_zip) as zip_novo:
+        originais = [item for item in zip_original.infolist() if item.filename != nome_xml_dentro_zip]
+        copiados = [item for item in zip_novo.infolist() if item.filename != nome_xml_dentro_zip]
+        if len(copiados) != len(originais):
+            return f"{len(copiados)} membro(s) copiado(s) de {len(originais)}"
+        for original, copiado in zip(originais, copiados):
+            if ((copiado.filename, copiado.CRC, copiado.file_size, copiado.compress_size, copiado.compress_type)
+                    != (original.filename, original.CRC, original.file_size, original.compress_size, original.compress_type)):
+                return f"membro '{original.filename}' difere do original"
+            with zip_novo.open(copiado):
+                pass
+    return None
+
+
+# Bloco de teste (para rodar 'python -m core.file_manager' diretamente): a cópia sem recomprimir
+# tem de gerar os mesmos membros (nomes, CRC, tamanhos, método, datas, atributos e conteúdo) que a
+# cópia por zip_read.read() + writestr, inclusive de membros gravados com descritor de dados.
 if __name__ == '__main__':
-    logging.info("Executando file_manager.py como script principal para teste (apenas exemplo de funções).")
-    # Este bloco pode ser expandido para testar as novas funções, se desejar.
-    # Exemplo de uso da nova função:
-    # criar um ZIP de teste, extrair um XML, modificá-lo, e depois recriar o ZIP
-    # e verificar a pasta de destino.
\ No newline at end of file
+    import io
+    import sys
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    class _SaidaSemSeek(io.RawIOBase):
+        """Sem seek, o zipfile grava os membros com descritor de dados (flag 0x08)."""
+        def __init__(self, arquivo): self.arquivo = arquivo
+        def writable(self): return True
+        def write(self, dados): return self.arquivo.write(dados)
+
+    def _montar_zip_exemplo(caminho_zip, nome_xml):
+        with open(caminho_zip, 'wb') as arquivo_bruto:
+            with zipfile.ZipFile(_SaidaSemSeek(arquivo_bruto), 'w', zipfile.ZIP_DEFLATED) as zip_exemplo:
+                zip_exemplo.writestr(nome_xml, b'<ptu:ptuA500 xmlns:ptu="u"><ptu:hash>velho</ptu:hash></ptu:ptuA500>')
+                with zip_exemplo.open('anexo_em_fluxo.bin', 'w') as anexo: anexo.write(os.urandom(5000) + b'a' * 100000)
+                zip_exemplo.writestr('descritor_guardado.txt', b'sem seek' * 500, compress_type=zipfile.ZIP_STORED)
+        with zipfile.ZipFile(caminho_zip, 'a') as zip_exemplo:
+            zip_exemplo.comment = b'comentario do zip'
+            zip_exemplo.writestr('guardado.txt', b'abc' * 1000, compress_type=zipfile.ZIP_STORED)
+            zip_exemplo.writestr('bzip2.txt', b'bz' * 5000, compress_type=zipfile.ZIP_BZIP2)
+            zip_exemplo.writestr('lzma.txt', b'lz' * 5000, compress_type=zipfile.ZIP_LZMA)
+            zip_exemplo.writestr('pasta/', b'')
+            info = zipfile.ZipInfo('pasta/guia ação ü.pdf', (2020, 5, 6, 7, 8, 10))
+            info.comment = b'comentario do membro'
+            info.external_attr = 0o640 << 16
+            zip_exemplo.writestr(info, os.urandom(300000), compress_type=zipfile.ZIP_DEFLATED)
+            zip_exemplo.writestr('vazio.txt', b'')
+
+    def _descrever_membros(caminho_zip, nome_xml):
+        with zipfile.ZipFile(caminho_zip) as zip_lido:
+            if zip_lido.testzip() is not None: return None
+            return [(item.filename, item.CRC, item.file_size, item.compress_type, item.date_time, item.external_attr,
+                     item.comment, zip_lido.read(item.filename)) for item in zip_lido.infolist() if item.filename != nome_xml]
+
+    nome_xml = 'N0000001.051'
+
+    def _adicionar_xml(zip_write):
+        zip_write.writestr(nome_xml, b'<ptu:ptuA500 xmlns:ptu="u"/>')
+        return 0
+
+    with tempfile.TemporaryDirectory() as pasta_teste:
+        caminho_zip = os.path.join(pasta_teste, 'N0000001.zip')
+        _montar_zip_exemplo(caminho_zip, nome_xml)
+        with zipfile.ZipFile(caminho_zip) as zip_exemplo:
+            com_descritor = [item.filename for item in zip_exemplo.infolist() if item.flag_bits & _FLAG_DESCRITOR_DE_DADOS]
+        print(f"Membros com descritor de dados no ZIP de exemplo: {com_descritor}")
+        caminho_recomprimido = os.path.join(pasta_teste, 'recomprimido.zip')
+        _gravar_zip_recriado(caminho_zip, caminho_recomprimido, nome_xml, _adicionar_xml, False)
+        esperado = _descrever_membros(caminho_recomprimido, nome_xml)
+        todos_iguais = esperado is not None and len(com_descritor) > 1
+        # Sem o fallback de _recriar_zip, que esconderia uma cópia errada; a segunda geração parte do
+        # ZIP já copiado sem recomprimir (sem descritores de dados)
+        origem = caminho_zip
+        for geracao, nome_caso in enumerate(("ZIP com descritores de dados", "ZIP recriado sem recomprimir"), 1):
+            caminho_copia = os.path.join(pasta_teste, f'copia_{geracao}.zip')
+            copiado_sem_recomprimir = _gravar_zip_recriado(origem, caminho_copia, nome_xml, _adicionar_xml, True)
+            igual = (copiado_sem_recomprimir and _conferir_membros_copiados(origem, caminho_copia, nome_xml) is None
+                     and _descrever_membros(caminho_copia, nome_xml) == esperado)
+            print(f"{'OK  ' if igual else 'ERRO'} {nome_caso}: {len(esperado or [])} membro(s) copiado(s) sem recomprimir")
+            todos_iguais &= igual
+            origem = caminho_copia
+    print("A cópia sem recomprimir confere com a recompressão." if todos_iguais else "HÁ MEMBROS DIVERGENTES.")
+    sys.exit(0 if todos_iguais else 1)
@@ -3,10 +3,118 @@
 import hashlib
 import logging
 import re
+import time
 from lxml import etree
 
+from utils import rastreamento
+
 # Configuração do logging para este módulo
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - (hash_calculator) - %(message)s')
+_RASTRO = rastreamento.obter_canal(rastreamento.CANAL_HASH)
+
+# Etapas de limpeza, na ordem em que são aplicadas ao documento serializado
+_RE_HASH_ANTIGO = re.compile(r'<ptu:hash>.*?</ptu:hash>', flags=re.IGNORECASE | re.DOTALL)
+_RE_ESPACOS_ENTRE_TAGS = re.compile(r'>\s+<')
+_RE_TAGS = re.compile(r'<[^>]+>')
+# Início e fim de _RE_HASH_ANTIGO, para a versão em blocos
+_RE_INICIO_HASH_ANTIGO = re.compile(r'<ptu:hash>', flags=re.IGNORECASE)
+_RE_FIM_HASH_ANTIGO = re.compile(r'</ptu:hash>', flags=re.IGNORECASE)
+_TAMANHO_INICIO_HASH_ANTIGO = len('<ptu:hash>')
+_TAMANHO_FIM_HASH_ANTIGO = len('</ptu:hash>')
+
+
+def _escapar_conteudo(texto):
+    return texto.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+class _ConteudoEmBlocos:
+    """
+    Recebe a serialização do documento em blocos (é o arquivo de saída de etree.xmlfile) e aplica
+    as mesmas etapas de _calcular_hash_serializando, alimentando o MD5 à medida que o conteúdo
+    fica pronto. Cada etapa guarda só o final do bloco que ainda pode fazer parte de uma
+    ocorrência da sua expressão (ex: depois do último '>'), então a memória não depende do
+    tamanho do documento.
+    """
+
+    def __init__(self):
+        self.hash_md5 = hashlib.md5()
+        self.bytes_xml = 0
+        self.bytes_conteudo = 0
+        self._pendente_hash_antigo = ""
+        # Se _pendente_hash_antigo começa com um <ptu:hash> ainda sem o fechamento, e onde continuar a busca
+        self._dentro_hash_antigo = False
+        self._retomar_busca_fim = 0
+        self._pendente_espacos = ""
+        self._pendente_tags = ""
+        self._antes_do_conteudo = True
+        self._espacos_finais = ""
+
+    def write(self, dados):
+        self.bytes_xml += len(dados)
+        self._remover_hash_antigo(bytes(dados).decode('latin-1'), False)
+
+    def finalizar(self):
+        self._remover_hash_antigo("", True)
+        return self.hash_md5.hexdigest()
+
+    def _remover_hash_antigo(self, texto, final):
+        # Mesma busca de _RE_HASH_ANTIGO: o <ptu:hash> mais à esquerda até o primeiro </ptu:hash> depois dele
+        dados = self._pendente_hash_antigo + texto
+        partes = []
+        posicao = 0
+        while True:
+            if self._dentro_hash_antigo:
+                fim = _RE_FIM_HASH_ANTIGO.search(dados, max(posicao + _TAMANHO_INICIO_HASH_ANTIGO, self._retomar_busca_fim))
+                if fim is None:
+                    if final: partes.append(dados[posicao:])
+                    else: self._retomar_busca_fim = max(0, len(dados) - _TAMANHO_FIM_HASH_ANTIGO + 1) - posicao
+                    break
+                posicao = fim.end()
+                self._dentro_hash_antigo = False
+                continue
+            inicio = _RE_INICIO_HASH_ANTIGO.search(dados, posicao)
+            if inicio is None:
+                corte = len(dados) if final else max(posicao, len(dados) - _TAMANHO_INICIO_HASH_ANTIGO + 1)
+                partes.append(dados[posicao:corte])
+                posicao = corte
+                break
+            partes.append(dados[posicao:inicio.start()])
+            posicao = inicio.start()
+            self._dentro_hash_antigo = True
+            self._retomar_busca_fim = 0
+        self._pendente_hash_antigo = "" if final else dados[posicao:]
+        self._remover_espacos_entre_tags("".join(partes), final)
+
+    def _remover_espacos_entre_tags(self, texto, final):
+        # Nenhuma ocorrência de '>\s+<' atravessa o último '>'
+        dados = self._pendente_espacos + texto
+        ultimo_fechamento = dados.rfind('>')
+        corte = len(dados) if final or ultimo_fechamento < 0 else ultimo_fechamento
+        self._pendente_espacos = dados[corte:]
+        self._remover_tags(_RE_ESPACOS_ENTRE_TAGS.sub('><', dados[:corte]), final)
+
+    def _remover_tags(self, texto, final):
+        # Cada ocorrência de '<[^>]+>' termina no primeiro '>' depois do '<'
+        dados = self._pendente_tags + texto
+        corte = len(dados) if final else dados.rfind('>') + 1
+        self._pendente_tags = dados[corte:]
+        self._acrescentar_conteudo(_RE_TAGS.sub('', dados[:corte]))
+
+    def _acrescentar_conteudo(self, texto):
+        # strip() do conteúdo inteiro: descarta os espaços iniciais e segura os finais até aparecer mais conteúdo
+        if self._antes_do_conteudo:
+            texto = texto.lstrip()
+            if not texto: return
+            self._antes_do_conteudo = False
+        corpo = texto.rstrip()
+        if not corpo:
+            self._espacos_finais += texto
+            return
+        dados = _escapar_conteudo(self._espacos_finais + corpo).encode('latin1')
+        self._espacos_finais = texto[len(corpo):]
+        self.bytes_conteudo += len(dados)
+        self.hash_md5.update(dados)
+
 
 def calcular_hash_moderno(xml_tree_root):
     """
@@ -14,10 +122,10 @@ def calcular_hash_moderno(xml_tree_root):
 
     Este método replica o processo do programa 'Ajusta-Layout-XML-PTU-A500.p':
     1.  Recebe um objeto lxml etree (a árvore XML já em memória).
-    2.  Converte a árvore XML inteira para uma string de texto.
-    3.  Usa Expressões Regulares (Regex) para remover todas as tags XML e
-        espaços desnecessários, deixando apenas o conteúdo textual concatenado.
-    4.  Calcula o hash MD5 sobre essa string limpa.
+    2.  Serializa a árvore em blocos (etree.xmlfile gera os mesmos bytes de etree.tostring).
+    3.  Remove de cada bloco a tag de hash antiga, os espaços entre tags e as tags, com as mesmas
+        expressões regulares do cálculo original (_calcular_hash_serializando), e escapa &, < e >.
+    4.  Alimenta o MD5 com o conteúdo de cada bloco, sem montar o documento inteiro em memória.
 
     Args:
         xml_tree_root: O elemento raiz da árvore XML (objeto lxml.etree._Element).
@@ -29,6 +137,32 @@ def calcular_hash_moderno(xml_tree_root):
         logging.error("A raiz da árvore XML fornecida é nula. Não é possível calcular o hash.")
         return None
 
+    inicio = time.perf_counter() if _RASTRO.ativo else 0.0
+    try:
+        conteudo = _ConteudoEmBlocos()
+        with etree.xmlfile(conteudo) as arquivo_xml:
+            arquivo_xml.write(xml_tree_root)
+        hash_resultado = conteudo.finalizar()
+
+        logging.info(f"Hash moderno calculado com sucesso: {hash_resultado}")
+        if _RASTRO.ativo: _RASTRO.registrar("hash_calculado", hash=hash_resultado, bytes_xml=conteudo.bytes_xml,
+                                            bytes_conteudo=conteudo.bytes_conteudo,
+                                            duracao_s=round(time.perf_counter() - inicio, 6))
+        return hash_resultado
+
+    except Exception as e:
+        logging.exception(f"Erro inesperado durante o cálculo do hash moderno: {e}")
+        return None
+
+
+def _calcular_hash_serializando(xml_tree_root):
+    """
+    Cálculo original, sobre o documento inteiro serializado em uma string.
+    Mantido como referência para a verificação de equivalência (bloco __main__).
+    """
+    if xml_tree_root is None:
+        logging.error("A raiz da árvore XML fornecida é nula. Não é possível calcular o hash.")
+        return None
     try:
         # Etapa 1: Converter a árvore XML em memória para uma string.
         # 'unicode' garante que obtemos uma string de texto, não bytes.
@@ -43,28 +177,77 @@ def calcular_hash_moderno(xml_tree_root):
         
         # 2.1. Remove a própria tag de hash antiga, caso exista, para não interferir no novo cálculo.
         # Isso torna a função re-executável com segurança.
-        string_sem_hash_antigo = re.sub(r'<ptu:hash>.*?</ptu:hash>', '', xml_string, flags=re.IGNORECASE | re.DOTALL)
+        string_sem_hash_antigo = _RE_HASH_ANTIGO.sub('', xml_string)
         
         # 2.2. Remove quebras de linha e espaços entre as tags (ex: '>  <' vira '><').
-        string_sem_espacos = re.sub(r'>\s+<', '><', string_sem_hash_antigo)
+        string_sem_espacos = _RE_ESPACOS_ENTRE_TAGS.sub('><', string_sem_hash_antigo)
 
         # 2.3. Remove TODAS as tags XML, deixando apenas o conteúdo.
-        string_final_apenas_conteudo = re.sub(r'<[^>]+>', '', string_sem_espacos).strip()
+        string_final_apenas_conteudo = _RE_TAGS.sub('', string_sem_espacos).strip()
         
         # 2.4. Trata entidades XML que podem ter sido convertidas para caracteres.
         # Embora o tostring deva lidar com isso, é uma garantia extra.
-        string_final_apenas_conteudo = string_final_apenas_conteudo.replace('&', '&amp;')
-        string_final_apenas_conteudo = string_final_apenas_conteudo.replace('<', '&lt;')
-        string_final_apenas_conteudo = string_final_apenas_conteudo.replace('>', '&gt;')
+        string_final_apenas_conteudo = _escapar_conteudo(string_final_apenas_conteudo)
 
 
         # Etapa 3: Calcular o hash MD5 sobre a string final.
         # Usamos 'latin1' (ISO-8859-1) que é o padrão de fato para estes sistemas legados.
-        hash_resultado = hashlib.md5(string_final_apenas_conteudo.encode('latin1')).hexdigest()
-
-        logging.info(f"Hash moderno calculado com sucesso: {hash_resultado}")
-        return hash_resultado
+        return hashlib.md5(string_final_apenas_conteudo.encode('latin1')).hexdigest()
 
     except Exception as e:
-        logging.exception(f"Erro inesperado durante o cálculo do hash moderno: {e}")
-        return None
\ No newline at end of file
+        logging.exception(f"Erro inesperado durante o cálculo do hash (serializando o documento): {e}")
+        return None
+
+
+# --- Verificação de equivalência (executar 'python -m core.hash_calculator [arquivo.xml ...]' na raiz do projeto) ---
+# Compara o hash em blocos com o cálculo original nos XMLs de exemplo (e nos informados), em casos
+# sintéticos (CDATA, comentários, entidades, acentos, tag de hash em várias formas) e com a
+# serialização cortada em blocos de vários tamanhos, inclusive de um caractere.
+if __name__ == '__main__':
+    import os
+    import sys
+    from utils import xml_parser
+
+    logging.getLogger().setLevel(logging.WARNING)
+    pasta_exemplos = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils')
+    arquivos = sys.argv[1:] or [os.path.join(pasta_exemplos, nome) for nome in sorted(os.listdir(pasta_exemplos)) if nome.endswith('.xml')]
+
+    casos_sinteticos = [
+        b'<ptu:ptuA500 xmlns:ptu="http://ptu.unimed.coop.br/schemas/V3_0"><ptu:hash>abc</ptu:hash><ptu:a> x </ptu:a></ptu:ptuA500>',
+        b'<ptu:r xmlns:ptu="u">\n  <ptu:a>1</ptu:a>\n  <ptu:hash>velho</ptu:hash>\n  <ptu:b>2</ptu:b>\n</ptu:r>',
+        b'<ptu:r xmlns:ptu="u">x <ptu:hash>h</ptu:hash> y<PTU:HASH xmlns:PTU="v">h2</PTU:HASH>\t</ptu:r>',
+        b'<ptu:r xmlns:ptu="u"><ptu:hash/> <ptu:hash a="1">h</ptu:hash> <hash>h</hash><ptu:hash>a<ptu:hash>b</ptu:hash>c</ptu:hash></ptu:r>',
+        b'<r>  texto inicial <a>&amp; &lt; &gt; "aspas" \'apostrofo\'</a> final  </r>',
+        '<?xml version="1.0" encoding="ISO-8859-1"?><r a="\xe9&gt;">Jos\xe9 Concei\xe7\xe3o &#13;&#160;&#128512; <b>\xa0</b></r>'.encode('latin-1'),
+        b'<r><![CDATA[ dentro < > & ]]> <a><![CDATA[x]]></a><b><![CDATA[a>b]]></b></r>',
+        b'<r>a<!-- comentario > com < sinais --> b <!-- <ptu:hash> sem fechamento --><c>d</c><?pi alvo > x?></r>',
+        b'<!DOCTYPE r [<!ENTITY e "valor">]><r>&e; <a>&e;</a></r>',
+        b'<r><a>' + b'x' * 20000 + b'</a>' + b' ' * 9000 + b'<b>' + b'  ' * 5000 + b'</b><c/>' * 3000 + b'</r>',
+        b'<r>\n\n</r>',
+        b'<r/>',
+    ]
+
+    def _hash_em_blocos(serializado, tamanho_bloco):
+        conteudo = _ConteudoEmBlocos()
+        for inicio in range(0, len(serializado), tamanho_bloco):
+            conteudo.write(serializado[inicio:inicio + tamanho_bloco])
+        return conteudo.finalizar()
+
+    def _verificar(nome, raiz, tamanhos_blocos):
+        esperado = _calcular_hash_serializando(raiz)
+        serializado = etree.tostring(raiz)
+        resultados = [calcular_hash_moderno(raiz)] + [_hash_em_blocos(serializado, tamanho) for tamanho in tamanhos_blocos]
+        divergentes = [resultado for resultado in resultados if resultado != esperado]
+        print(f"{'OK  ' if not divergentes else 'ERRO'} {nome}: {esperado}" + (f" (divergentes: {divergentes})" if divergentes else ""))
+        return not divergentes
+
+    parser_xml = etree.XMLParser(recover=True, strip_cdata=False, resolve_entities=False)
+    todos_iguais = True
+    for caminho_arquivo in arquivos:
+        raiz = xml_parser.carregar_arvore_xml(caminho_arquivo).getroot()
+        todos_iguais &= _verificar(os.path.basename(caminho_arquivo), raiz, (1000, 4096, 65536))
+    for indice, xml_caso in enumerate(casos_sinteticos, 1):
+        raiz = etree.fromstring(xml_caso, parser_xml)
+        todos_iguais &= _verificar(f"caso sintético {indice}", raiz, range(1, 24))
+    print("Todos os hashes conferem." if todos_iguais else "HÁ HASHES DIVERGENTES.")
+    sys.exit(0 if todos_iguais else 1)
@@ -0,0 +1,148 @@
+# core/indice_cobertura.py
+
+"""
+Índice de cobertura das listas referenciais HM e SADT: o conjunto dos cd_Servico que a regra
+HM/CO trata como cobertos, compilado uma vez a partir dos JSONs de config/reference_list.
+A regra passa a fazer um único teste de pertinência, sem guardar as linhas dos JSONs.
+
+Cobertura (a mesma da busca que a regra fazia): o código é procurado na lista HM e, se não
+estiver lá, na SADT; está coberto se COBERTO_UNIMED_CG da linha encontrada é "SIM".
+
+O índice é gravado em binário na pasta de cache do usuário (ver caminho_indice; a pasta config/
+pode não ser gravável com o programa instalado ou empacotado) e só é reaproveitado se nome, tamanho
+e mtime dos JSONs conferirem (ver impressao_listas): carregar é ler um arquivo pequeno e dividir um texto.
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - (indice_cobertura) - %(message)s')
+
+NOME_PASTA_CACHE_USUARIO = "AuditPlus"
+PREFIXO_ARQUIVO_INDICE = "indice_cobertura_"
+# Incrementar quando a compilação ou o formato do arquivo mudarem
+VERSAO_FORMATO_INDICE = 1
+ASSINATURA_ARQUIVO = b"AUDITPLUS-COBERTURA\n"
+
+CHAVE_CODIGO = "COD_PROCEDIMENTO"
+CHAVE_COBERTURA = "COBERTO_UNIMED_CG"
+# NUL não pode aparecer no texto de um XML: separa os códigos sem ambiguidade
+_SEPARADOR_CODIGOS = "\x00"
+
+
+class IndiceCobertura:
+    """
+    codigos_cobertos: frozenset dos cd_Servico cobertos.
+    quantidade_hm / quantidade_sadt: códigos lidos de cada lista (0 = lista não carregada).
+    versao: hash do conteúdo, para as chaves de cache que dependem das listas.
+    """
+
+    __slots__ = ('codigos_cobertos', 'quantidade_hm', 'quantidade_sadt', 'versao')
+
+    def __init__(self, codigos_cobertos=frozenset(), quantidade_hm=0, quantidade_sadt=0, versao=None):
+        self.codigos_cobertos = frozenset(codigos_cobertos)
+        self.quantidade_hm = quantidade_hm
+        self.quantidade_sadt = quantidade_sadt
+        self.versao = versao or _calcular_versao(self.codigos_cobertos, quantidade_hm, quantidade_sadt)
+
+    @property
+    def carregado(self):
+        """Se alguma das listas trouxe códigos (sem elas a regra HM/CO não é aplicada)."""
+        return bool(self.quantidade_hm or self.quantidade_sadt)
+
+    def __getstate__(self):
+        return (self.codigos_cobertos, self.quantidade_hm, self.quantidade_sadt, self.versao)
+
+    def __setstate__(self, estado):
+        self.codigos_cobertos, self.quantidade_hm, self.quantidade_sadt, self.versao = estado
+
+
+def _calcular_versao(codigos_cobertos, quantidade_hm, quantidade_sadt):
+    conteudo = f"{quantidade_hm}|{quantidade_sadt}|" + _SEPARADOR_CODIGOS.join(sorted(codigos_cobertos))
+    return hashlib.sha256(conteudo.encode('utf-8')).hexdigest()
+
+
+def _cobertura_por_codigo(registros):
+    """{código: coberto} de uma lista referencial; um código repetido fica com a última linha."""
+    cobertura = {}
+    for registro in registros or ():
+        codigo = registro.get(CHAVE_CODIGO)
+        if not codigo: continue
+        situacao = registro.get(CHAVE_COBERTURA, "NAO")
+        cobertura[str(codigo).strip()] = isinstance(situacao, str) and situacao.upper() == "SIM"
+    return cobertura
+
+
+def compilar_indice(registros_hm, registros_sadt):
+    """Índice a partir das linhas (dicionários) das listas HM e SADT; None para lista ausente."""
+    cobertura_hm = _cobertura_por_codigo(registros_hm)
+    cobertura_sadt = _cobertura_por_codigo(registros_sadt)
+    cobertura = {**cobertura_sadt, **cobertura_hm}
+    # Código vazio ou com NUL nunca é igual ao texto de um <cd_Servico>
+    cobertos = {codigo for codigo, coberto in cobertura.items() if coberto and codigo and _SEPARADOR_CODIGOS not in codigo}
+    return IndiceCobertura(cobertos, len(cobertura_hm), len(cobertura_sadt))
+
+
+def impressao_listas(*caminhos_listas):
+    """[[nome, tamanho, mtime_ns]] das listas (tamanho e mtime None para arquivo ausente)."""
+    impressao = []
+    for caminho in caminhos_listas:
+        try:
+            estado = os.stat(caminho)
+            impressao.append([os.path.basename(caminho), estado.st_size, estado.st_mtime_ns])
+        except OSError:
+            impressao.append([os.path.basename(caminho), None, None])
+    return impressao
+
+
+def pasta_cache_usuario():
+    """%LOCALAPPDATA%\\AuditPlus no Windows; $XDG_CACHE_HOME/AuditPlus (ou ~/.cache/AuditPlus) nos demais."""
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser("~"), "AppData", "Local")
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, NOME_PASTA_CACHE_USUARIO)
+
+
+def caminho_indice(pasta_listas):
+    """Arquivo do índice das listas de 'pasta_listas': um por pasta, para instalações diferentes não se sobrescreverem."""
+    chave_pasta = hashlib.sha256(os.path.realpath(pasta_listas).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(pasta_cache_usuario(), f"{PREFIXO_ARQUIVO_INDICE}{chave_pasta}.bin")
+
+
+def gravar_indice(caminho_indice, indice, impressao):
+    """Grava o índice (arquivo temporário + os.replace, para não deixar um índice pela metade)."""
+    cabecalho = json.dumps({'formato': VERSAO_FORMATO_INDICE, 'listas': impressao, 'quantidade_hm': indice.quantidade_hm,
+                            'quantidade_sadt': indice.quantidade_sadt, 'versao': indice.versao})
+    conteudo = (ASSINATURA_ARQUIVO + cabecalho.encode('utf-8') + b"\n"
+                + _SEPARADOR_CODIGOS.join(sorted(indice.codigos_cobertos)).encode('utf-8'))
+    os.makedirs(os.path.dirname(caminho_indice), exist_ok=True)
+    caminho_temporario = f"{caminho_indice}.{os.getpid()}.tmp"
+    try:
+        with open(caminho_temporario, 'wb') as arquivo:
+            arquivo.write(conteudo)
+        os.replace(caminho_temporario, caminho_indice)
+    finally:
+        if os.path.exists(caminho_temporario): os.remove(caminho_temporario)
+
+
+def ler_indice(caminho_indice, impressao):
+    """Índice gravado, se existir e tiver sido compilado das listas com essa 'impressao'; senão None."""
+    try:
+        with open(caminho_indice, 'rb') as arquivo:
+            conteudo = arquivo.read()
+    except OSError:
+        return None
+    if not conteudo.startswith(ASSINATURA_ARQUIVO): return None
+    cabecalho, _, codigos = conteudo[len(ASSINATURA_ARQUIVO):].partition(b"\n")
+    try:
+        cabecalho = json.loads(cabecalho)
+        if cabecalho.get('formato') != VERSAO_FORMATO_INDICE or cabecalho.get('listas') != impressao: return None
+        codigos = codigos.decode('utf-8')
+        return IndiceCobertura(codigos.split(_SEPARADOR_CODIGOS) if codigos else (),
+                               cabecalho['quantidade_hm'], cabecalho['quantidade_sadt'], cabecalho['versao'])
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logging.warning(f"Índice de cobertura '{caminho_indice}' ilegível, será recompilado: {e}")
+        return None
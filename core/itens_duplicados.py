@@ -0,0 +1,130 @@
+# core/itens_duplicados.py
+
+"""
+Itens cobrados em duplicidade: um índice por chave (beneficiário, guia, cd_Servico, tp_Tabela,
+data de execução, valor), montado numa única passagem pelos <procedimentosExecutados>, sem
+comparar os itens dois a dois.
+
+- No arquivo: WorkflowController._remanejar_itens_duplicados_xml agrupa os itens de mesma chave.
+- No lote importado: as chaves de cada fatura ficam no dicionário da fatura ('itens_cobrados') e
+  localizar_duplicados_entre_faturas cruza as faturas da mesma competência sem reler os XMLs.
+
+O valor é a soma de vl_ServCobrado e vl_CO_Cobrado, em centavos: a regra HM/CO junta os dois em
+vl_ServCobrado, então a chave de um item é a mesma antes e depois das regras.
+"""
+
+from utils import ptu_xpath
+
+# Campos da chave, na ordem (também os nomes usados nos registros e no CSV do lote)
+CAMPOS_CHAVE = ('codigo_beneficiario', 'numero_guia', 'cd_servico', 'tp_tabela', 'dt_execucao', 'valor_centavos')
+SEPARADOR_CHAVE = "|"
+
+_TAGS_GUIAS = frozenset((ptu_xpath.TAG_GUIA_CONSULTA, ptu_xpath.TAG_GUIA_SADT,
+                         ptu_xpath.TAG_GUIA_INTERNACAO, ptu_xpath.TAG_GUIA_HONORARIOS))
+_TAGS_VALORES = (ptu_xpath.TAG_VL_SERV_COBRADO, ptu_xpath.TAG_VL_CO_COBRADO)
+_TAG_PROCEDIMENTOS_EXECUTADOS = ptu_xpath.TAG_PROCEDIMENTOS_EXECUTADOS
+_TAG_PROCEDIMENTOS = ptu_xpath.TAG_PROCEDIMENTOS
+_TAG_ID_BENEF = ptu_xpath.TAG_ID_BENEF
+_TAG_NR_GUIA_TISS_PRESTADOR = ptu_xpath.TAG_NR_GUIA_TISS_PRESTADOR
+_TAG_CD_SERVICO = ptu_xpath.TAG_CD_SERVICO
+_TAG_DT_EXECUCAO = ptu_xpath.TAG_DT_EXECUCAO
+_TAGS_INDICE = (*_TAGS_GUIAS, _TAG_PROCEDIMENTOS_EXECUTADOS, *_TAGS_VALORES, _TAG_ID_BENEF, _TAG_NR_GUIA_TISS_PRESTADOR,
+                _TAG_CD_SERVICO, ptu_xpath.TAG_TP_TABELA, _TAG_DT_EXECUCAO)
+
+
+def _texto(no):
+    return no.text.strip() if no is not None and no.text else ""
+
+
+def _centavos(texto):
+    try:
+        return round(float(texto.strip().replace(',', '.')) * 100)
+    except ValueError:
+        return 0
+
+
+def indexar_itens(raiz):
+    """
+    {chave: [<procedimentosExecutados>, ...]} de todas as guias do documento, na ordem do documento.
+    A chave é uma tupla de textos na ordem de CAMPOS_CHAVE.
+    Um único iter() filtrado pelas tags da chave: find() em cada item custaria mais que o resto.
+    """
+    indice = {}
+    guia = procedimento = None
+    dados_guia = ["", ""]
+    itens_guia = []
+
+    def concluir_guia():
+        for proc_exec, cd_servico, tp_tabela, dt_execucao, valor, _ in itens_guia:
+            chave = (dados_guia[0], dados_guia[1], cd_servico, tp_tabela, dt_execucao, str(valor))
+            itens = indice.get(chave)
+            if itens is None: indice[chave] = [proc_exec]
+            else: itens.append(proc_exec)
+        itens_guia.clear()
+
+    for elemento in raiz.iter(*_TAGS_INDICE):
+        tag = elemento.tag
+        if tag in _TAGS_GUIAS:
+            concluir_guia()
+            guia, procedimento = elemento, None
+            dados_guia[:] = ["", ""]
+        elif guia is None:
+            continue
+        elif tag == _TAG_PROCEDIMENTOS_EXECUTADOS:
+            # [item, cd_Servico, tp_Tabela, dt_Execucao, valor, primeiro <procedimentos> do item]
+            procedimento = [elemento, "", "", "", 0, None]
+            itens_guia.append(procedimento)
+        elif tag in _TAGS_VALORES:
+            pai = elemento.getparent()
+            if procedimento is not None and elemento.text and (pai is procedimento[0] or pai.getparent() is procedimento[0]):
+                procedimento[4] += _centavos(elemento.text)
+        elif tag == _TAG_ID_BENEF:
+            if elemento.getparent().getparent() is guia: dados_guia[0] = _texto(elemento)
+        elif tag == _TAG_NR_GUIA_TISS_PRESTADOR:
+            if elemento.getparent().getparent().getparent() is guia: dados_guia[1] = _texto(elemento)
+        elif procedimento is not None:
+            pai = elemento.getparent()
+            if tag == _TAG_DT_EXECUCAO:
+                if pai is procedimento[0]: procedimento[3] = _texto(elemento)
+            elif pai.tag == _TAG_PROCEDIMENTOS and pai.getparent() is procedimento[0]:
+                if procedimento[5] is None: procedimento[5] = pai
+                if pai is procedimento[5]: procedimento[1 if tag == _TAG_CD_SERVICO else 2] = _texto(elemento)
+    concluir_guia()
+    return indice
+
+
+def duplicados_no_indice(indice):
+    """[(chave, itens)] das chaves com mais de um item."""
+    return [(chave, itens) for chave, itens in indice.items() if len(itens) > 1]
+
+
+def chave_para_texto(chave):
+    return SEPARADOR_CHAVE.join(chave)
+
+
+def registro_da_chave(chave, **campos):
+    """Dicionário com os campos da chave (ver CAMPOS_CHAVE) e os 'campos' extras."""
+    registro = dict(zip(CAMPOS_CHAVE, chave))
+    registro.update(campos)
+    return registro
+
+
+def chaves_itens_cobrados(raiz):
+    """Chaves (em texto, sem repetição) dos itens do documento, para o dicionário da fatura."""
+    return [chave_para_texto(chave) for chave in indexar_itens(raiz)]
+
+
+def localizar_duplicados_entre_faturas(faturas):
+    """
+    Cruza as 'itens_cobrados' das faturas importadas: retorna um registro (ver registro_da_chave,
+    com 'competencia' e 'faturas') para cada item cobrado em mais de uma fatura da mesma competência.
+    Faturas sem 'itens_cobrados' (lidas em streaming) ficam de fora.
+    """
+    faturas_por_chave = {}
+    for fatura in faturas:
+        competencia = fatura.get('competencia') or ""
+        identificacao = fatura.get('numero_fatura') or fatura.get('nome_zip') or ""
+        for chave in fatura.get('itens_cobrados') or ():
+            faturas_por_chave.setdefault((competencia, chave), []).append(identificacao)
+    return [registro_da_chave(chave.split(SEPARADOR_CHAVE), competencia=competencia, faturas=identificacoes)
+            for (competencia, chave), identificacoes in faturas_por_chave.items() if len(identificacoes) > 1]
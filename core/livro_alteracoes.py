@@ -0,0 +1,135 @@
+# core/livro_alteracoes.py
+
+"""
+Livro de alterações das regras de negócio: um registro compacto por alteração (arquivo, guia,
+regra, caminho do nó, valor antigo, valor novo) em um SQLite por lote importado, na pasta
+'Correção XML'. O banco só recebe INSERTs; serve à auditoria e a consultas de resumo
+(ex: alterações por regra e por Unimed) sem depender do texto do log de detalhe.
+
+As regras não tocam no banco: o WorkflowController acumula os registros do arquivo em uma lista
+(ver localizar_no) e grava todos numa única transação ao final (LivroAlteracoes.acrescentar).
+Cada gravação de um arquivo é guardada à parte; a visão 'alteracoes_atuais' mostra só a última
+de cada arquivo, já que as regras são sempre aplicadas sobre o XML original.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+from lxml import etree
+
+from utils import ptu_xpath
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - (livro_alteracoes) - %(message)s')
+
+NOME_ARQUIVO_LIVRO = ".livro_alteracoes.sqlite"
+# Workers da importação gravam no mesmo banco: espera pelo bloqueio em vez de falhar
+TEMPO_ESPERA_BLOQUEIO_S = 30.0
+
+OPERACAO_TEXTO = "texto"
+OPERACAO_REMOVER = "remover"
+OPERACAO_INSERIR = "inserir"
+
+_TAGS_GUIAS = frozenset((ptu_xpath.TAG_GUIA_CONSULTA, ptu_xpath.TAG_GUIA_SADT,
+                         ptu_xpath.TAG_GUIA_INTERNACAO, ptu_xpath.TAG_GUIA_HONORARIOS))
+_XPATH_UNIMED_DESTINO = dict(ptu_xpath.XPATH_CAMPOS_CABECALHO_DOCUMENTO)['codigo_unimed_destino']
+
+
+def caminho_livro(pasta_raiz_correcao_xml):
+    """Banco do livro de alterações dentro de 'Correção XML'."""
+    return os.path.join(pasta_raiz_correcao_xml, NOME_ARQUIVO_LIVRO)
+
+
+def localizar_no(no):
+    """
+    (nr_GuiaTissPrestador da guia que contém o nó ou None, caminho XPath do nó). Dentro de uma guia
+    o caminho começa na própria guia (ex: '/ptu:guiaSADT/ptu:dadosGuia/...'), o que o torna
+    independente da posição da guia no arquivo; fora das guias, começa na raiz do documento.
+    """
+    guia = no
+    while guia is not None and guia.tag not in _TAGS_GUIAS: guia = guia.getparent()
+    if guia is None: return None, no.getroottree().getpath(no)
+    numeros = ptu_xpath.XPATH_GUIA_NR_GUIA_TISS_PRESTADOR(guia)
+    numero_guia = numeros[0].text.strip() if numeros and numeros[0].text else None
+    return numero_guia, etree.ElementTree(guia).getpath(no)
+
+
+def unimed_destino(raiz):
+    """cd_Uni_Destino do cabeçalho, ou None."""
+    nos = _XPATH_UNIMED_DESTINO(raiz)
+    return nos[0].text.strip() if nos and nos[0].text else None
+
+
+class LivroAlteracoes:
+    """
+    Banco SQLite do livro de alterações.
+    Registros de alteração: (regra, guia, caminho, operação, valor antigo, valor novo).
+    """
+
+    def __init__(self, caminho_banco):
+        self.caminho_banco = caminho_banco
+        self._conexao = sqlite3.connect(caminho_banco, timeout=TEMPO_ESPERA_BLOQUEIO_S)
+        self._conexao.executescript("""
+            CREATE TABLE IF NOT EXISTS gravacoes (
+                id INTEGER PRIMARY KEY,
+                arquivo TEXT NOT NULL,
+                unimed TEXT,
+                gravado_em REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS alteracoes (
+                id INTEGER PRIMARY KEY,
+                gravacao INTEGER NOT NULL REFERENCES gravacoes (id),
+                guia TEXT,
+                regra TEXT NOT NULL,
+                operacao TEXT NOT NULL,
+                caminho TEXT NOT NULL,
+                valor_antigo TEXT,
+                valor_novo TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_gravacoes_arquivo ON gravacoes (arquivo, id);
+            CREATE INDEX IF NOT EXISTS idx_alteracoes_gravacao ON alteracoes (gravacao);
+            CREATE VIEW IF NOT EXISTS alteracoes_atuais AS
+                SELECT a.id, g.arquivo, g.unimed, g.gravado_em, a.guia, a.regra, a.operacao, a.caminho, a.valor_antigo, a.valor_novo
+                FROM alteracoes a JOIN gravacoes g ON g.id = a.gravacao
+                WHERE g.id = (SELECT MAX(ultima.id) FROM gravacoes ultima WHERE ultima.arquivo = g.arquivo);
+        """)
+        self._conexao.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo_excecao, excecao, rastreamento_pilha):
+        self.fechar()
+
+    def fechar(self):
+        if self._conexao is not None:
+            self._conexao.close()
+            self._conexao = None
+
+    def acrescentar(self, arquivo, unimed, registros):
+        """
+        Grava a aplicação das regras em 'arquivo' (mesmo sem alterações, para substituir a anterior
+        na visão alteracoes_atuais) com os seus registros. Retorna quantos registros foram gravados.
+        """
+        with self._conexao:
+            cursor = self._conexao.execute("INSERT INTO gravacoes (arquivo, unimed, gravado_em) VALUES (?, ?, ?)",
+                                           (arquivo, unimed, time.time()))
+            id_gravacao = cursor.lastrowid
+            self._conexao.executemany(
+                "INSERT INTO alteracoes (gravacao, regra, guia, caminho, operacao, valor_antigo, valor_novo) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((id_gravacao, *registro) for registro in registros))
+        return len(registros)
+
+    def resumo_por_regra_e_unimed(self):
+        """[(regra, unimed, alterações, arquivos, guias)] da última gravação de cada arquivo."""
+        return self._conexao.execute("""
+            SELECT regra, unimed, COUNT(*), COUNT(DISTINCT arquivo), COUNT(DISTINCT arquivo || '/' || guia)
+            FROM alteracoes_atuais GROUP BY regra, unimed ORDER BY regra, unimed
+        """).fetchall()
+
+    def alteracoes_do_arquivo(self, arquivo):
+        """[(guia, regra, operação, caminho, valor antigo, valor novo)] da última gravação de 'arquivo'."""
+        return self._conexao.execute("""
+            SELECT guia, regra, operacao, caminho, valor_antigo, valor_novo
+            FROM alteracoes_atuais WHERE arquivo = ? ORDER BY id
+        """, (arquivo,)).fetchall()
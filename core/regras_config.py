@@ -0,0 +1,272 @@
+# core/regras_config.py
+
+"""
+Definição declarativa das regras de negócio (config/regras_negocio.json) e sua compilação
+em tabelas de consulta.
+
+Cada regra declara onde se aplica ('contextos': tag do elemento e, opcionalmente, as tags
+aceitas para o pai), se está ativa e os valores das suas condições e ações. A lógica de cada
+regra continua nos métodos _regra_*_no do WorkflowController; o arquivo troca só os dados,
+o que basta para as mudanças de tabela de uma nova versão do PTU.
+
+Na carga, a definição vira uma TabelasRegras: contextos por regra (para a tabela de despacho
+por tag do motor de passagem única), um XPath compilado por regra (modo sequencial) e
+conjuntos/dicionários para as condições, como o mapa de tp_Prestador invertido
+(código original -> novo código), para que a avaliação por nó seja uma consulta O(1).
+"""
+
+import os
+import re
+import copy
+import json
+import logging
+from lxml import etree
+
+from utils import ptu_xpath
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - (regras_config) - %(message)s')
+
+# Identificadores das regras, na ordem de aplicação
+REGRA_CNES = "cnes"
+REGRA_TIPO_DOCUMENTO = "tipo_documento"
+REGRA_DATA_CONHECIMENTO_PROTOCOLO = "data_conhecimento_protocolo"
+REGRA_TIPO_PRESTADOR = "tipo_prestador"
+REGRA_RECURSO_PROPRIO = "recurso_proprio"
+REGRA_DIGITOS_PACOTE = "digitos_pacote"
+REGRA_HM_CO = "hm_co"
+REGRAS = (REGRA_CNES, REGRA_TIPO_DOCUMENTO, REGRA_DATA_CONHECIMENTO_PROTOCOLO, REGRA_TIPO_PRESTADOR,
+          REGRA_RECURSO_PROPRIO, REGRA_DIGITOS_PACOTE, REGRA_HM_CO)
+
+# Tags (nome local) que cada regra pode alterar, criar ou remover. São fixas no código das
+# funções _regra_*_no: a definição muda onde e com que valores a regra se aplica, não o que ela
+# escreve. Usado para saber se os dados lidos na importação dependem das regras.
+TAGS_ALTERADAS_POR_REGRA = {
+    REGRA_CNES: frozenset(('CNES',)),
+    REGRA_TIPO_DOCUMENTO: frozenset(('tp_Documento', 'NFE')),
+    REGRA_DATA_CONHECIMENTO_PROTOCOLO: frozenset(('dt_Protocolo',)),
+    REGRA_TIPO_PRESTADOR: frozenset(('tp_Prestador', 'tp_Participacao', 'tp_Atendimento')),
+    REGRA_RECURSO_PROPRIO: frozenset(('id_RecProprio',)),
+    REGRA_DIGITOS_PACOTE: frozenset(('cd_Pacote',)),
+    REGRA_HM_CO: frozenset(('valores', 'taxas', 'vl_ServCobrado', 'vl_CO_Cobrado', 'tx_AdmServico', 'tx_AdmCO')),
+}
+
+VERSAO_FORMATO_REGRAS = 1
+ARQUIVO_REGRAS_PADRAO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                     'config', 'regras_negocio.json')
+
+_CONTEXTOS_PRESTADOR = [{"tag": "contratadoExecutante"}, {"tag": "contratadoSolicitante"}, {"tag": "dadosExecutante"}]
+
+# Regras como eram no código; usadas quando o arquivo não existe e para completar as chaves
+# que o arquivo não informa
+DEFINICAO_PADRAO = {
+    "versao": VERSAO_FORMATO_REGRAS,
+    "regras": {
+        REGRA_CNES: {
+            "ativa": True,
+            "contextos": [{"tag": "CNES", "pais": ["contratadoExecutante", "dadosExecutante", "dadosHospital"]}],
+            "valores_vazios": ["", "0"],
+            "cnes_padrao": "9999999",
+        },
+        REGRA_TIPO_DOCUMENTO: {
+            "ativa": True,
+            "contextos": [{"tag": "documento1", "pais": ["Cobranca"]}, {"tag": "documento2", "pais": ["Cobranca"]}],
+            "tp_documento_original": "3",
+            "tp_documento_novo": "1",
+            "remover_nfe": True,
+        },
+        REGRA_DATA_CONHECIMENTO_PROTOCOLO: {
+            "ativa": True,
+            "contextos": [{"tag": "dadosGuia"}],
+        },
+        REGRA_TIPO_PRESTADOR: {
+            "ativa": True,
+            "contextos": _CONTEXTOS_PRESTADOR + [{"tag": "Prestador", "pais": ["equipe_Profissional"]}],
+            "mapa_tp_prestador": {
+                "01": ["10", "11", "13", "49", "54", "80", "82"],
+                "02": ["42", "44", "50", "51", "52"],
+                "03": ["30"],
+                "04": ["20", "21", "22", "23", "24", "25", "26", "40", "41", "43", "45", "46", "53"],
+                "05": ["12", "47"],
+                "06": ["14"],
+                "11": ["48"],
+            },
+            "cd_prest_tp_fixo": "11110",
+            "tp_prestador_fixo": "08",
+            "tp_atendimento_tp_fixo": "06",
+        },
+        REGRA_RECURSO_PROPRIO: {
+            "ativa": True,
+            "contextos": _CONTEXTOS_PRESTADOR,
+            "codigos_recurso_proprio": ["11099", "11110", "11152", "8150", "8162"],
+        },
+        REGRA_DIGITOS_PACOTE: {
+            "ativa": True,
+            "contextos": [{"tag": "procedimentosExecutados"}],
+            "id_pacote": "S",
+            "tamanho_cd_pacote": 8,
+        },
+        REGRA_HM_CO: {
+            "ativa": True,
+            "contextos": [{"tag": "cd_Servico", "pais": ["procedimentos"]}],
+        },
+    },
+}
+
+_NOME_TAG_VALIDO = re.compile(r"^[A-Za-z_][A-Za-z0-9_.-]*$")
+_CHAVES_COMUNS = {"descricao", "ativa", "contextos"}
+
+
+def inverter_mapa_tp_prestador(mapa_tp_prestador):
+    """código original -> novo código, respeitando a primeira ocorrência na ordem do mapa."""
+    invertido = {}
+    for novo_valor, codigos_originais in mapa_tp_prestador.items():
+        for codigo in codigos_originais:
+            invertido.setdefault(codigo, novo_valor)
+    return invertido
+
+
+def _validar_texto(id_regra, chave, valor, aceita_nulo=False):
+    if valor is None and aceita_nulo:
+        return None
+    if not isinstance(valor, str):
+        raise ValueError(f"Regra '{id_regra}': '{chave}' deve ser texto, recebido {valor!r}.")
+    return valor.strip()
+
+
+def _validar_lista_textos(id_regra, chave, valor):
+    if not isinstance(valor, list) or not all(isinstance(item, str) for item in valor):
+        raise ValueError(f"Regra '{id_regra}': '{chave}' deve ser uma lista de textos.")
+    return [item.strip() for item in valor]
+
+
+def _validar_contextos(id_regra, contextos):
+    if not isinstance(contextos, list) or not contextos:
+        raise ValueError(f"Regra '{id_regra}': 'contextos' deve ser uma lista não vazia.")
+    for contexto in contextos:
+        if not isinstance(contexto, dict) or set(contexto) - {"tag", "pais"}:
+            raise ValueError(f"Regra '{id_regra}': contexto inválido {contexto!r} (chaves aceitas: 'tag', 'pais').")
+        nomes = [contexto.get("tag")] + list(contexto.get("pais") or [])
+        for nome in nomes:
+            if not isinstance(nome, str) or not _NOME_TAG_VALIDO.match(nome):
+                raise ValueError(f"Regra '{id_regra}': nome de tag inválido {nome!r} em {contexto!r}.")
+
+
+def mesclar_definicao(definicao_arquivo):
+    """
+    Completa a definição lida do arquivo com DEFINICAO_PADRAO (chave a chave, dentro de cada
+    regra) e valida o resultado. Regras ou chaves desconhecidas são erro, para que um nome
+    digitado errado não seja ignorado em silêncio.
+    """
+    if not isinstance(definicao_arquivo, dict) or not isinstance(definicao_arquivo.get("regras", {}), dict):
+        raise ValueError("Estrutura inesperada: esperava um objeto com a chave 'regras'.")
+    versao = definicao_arquivo.get("versao", VERSAO_FORMATO_REGRAS)
+    if versao != VERSAO_FORMATO_REGRAS:
+        raise ValueError(f"Versão {versao!r} do arquivo de regras não suportada (esperada {VERSAO_FORMATO_REGRAS}).")
+
+    definicao = copy.deepcopy(DEFINICAO_PADRAO)
+    for id_regra, regra_arquivo in definicao_arquivo.get("regras", {}).items():
+        if id_regra not in definicao["regras"]:
+            raise ValueError(f"Regra desconhecida '{id_regra}'. Disponíveis: {', '.join(REGRAS)}")
+        if not isinstance(regra_arquivo, dict):
+            raise ValueError(f"Regra '{id_regra}': esperava um objeto.")
+        chaves_aceitas = _CHAVES_COMUNS | set(definicao["regras"][id_regra])
+        for chave in set(regra_arquivo) - chaves_aceitas:
+            raise ValueError(f"Regra '{id_regra}': chave desconhecida '{chave}'.")
+        definicao["regras"][id_regra].update(copy.deepcopy(regra_arquivo))
+
+    for id_regra, regra in definicao["regras"].items():
+        if not isinstance(regra.get("ativa", True), bool):
+            raise ValueError(f"Regra '{id_regra}': 'ativa' deve ser true ou false.")
+        _validar_contextos(id_regra, regra["contextos"])
+    return definicao
+
+
+def carregar_definicao_regras(caminho_arquivo=None):
+    """
+    Lê config/regras_negocio.json (ou 'caminho_arquivo') e devolve a definição completa e
+    validada. Sem arquivo, devolve as regras padrão. Arquivo inválido levanta ValueError.
+    """
+    caminho_arquivo = caminho_arquivo or ARQUIVO_REGRAS_PADRAO
+    if not os.path.exists(caminho_arquivo):
+        logging.warning(f"Arquivo de regras '{caminho_arquivo}' não encontrado. Usando as regras padrão.")
+        return copy.deepcopy(DEFINICAO_PADRAO)
+    try:
+        with open(caminho_arquivo, 'r', encoding='utf-8') as f:
+            definicao_arquivo = json.load(f)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"JSON inválido em '{caminho_arquivo}': {e}") from e
+    return mesclar_definicao(definicao_arquivo)
+
+
+def _contextos_compilados(contextos):
+    """[(tag Clark, frozenset das tags Clark aceitas para o pai ou None), ...]"""
+    return tuple((ptu_xpath.tag_ptu(contexto["tag"]),
+                  frozenset(ptu_xpath.tag_ptu(pai) for pai in contexto["pais"]) if contexto.get("pais") else None)
+                 for contexto in contextos)
+
+
+def _xpath_contextos(contextos):
+    """XPath (união, em ordem de documento) dos elementos dos contextos, para o modo sequencial."""
+    caminhos = []
+    for contexto in contextos:
+        if contexto.get("pais"):
+            caminhos.extend(f".//ptu:{pai}/ptu:{contexto['tag']}" for pai in contexto["pais"])
+        else:
+            caminhos.append(f".//ptu:{contexto['tag']}")
+    return etree.XPath(" | ".join(caminhos), namespaces=ptu_xpath.NAMESPACES)
+
+
+class TabelasRegras:
+    """
+    Definição de regras compilada. Os atributos são só de leitura para as regras; para
+    trocar as regras, compile outra definição.
+    """
+
+    def __init__(self, definicao):
+        regras = definicao["regras"]
+        self.definicao = definicao
+        # Identifica a definição (chave de cache da folha XSLT e da versão dos dados da importação)
+        self.chave = json.dumps(definicao, sort_keys=True, ensure_ascii=False)
+
+        self.regras_ativas = frozenset(id_regra for id_regra in REGRAS if regras[id_regra].get("ativa", True))
+        self.contextos = {id_regra: _contextos_compilados(regras[id_regra]["contextos"]) for id_regra in REGRAS}
+        self.xpath_contextos = {id_regra: _xpath_contextos(regras[id_regra]["contextos"]) for id_regra in REGRAS}
+        self.contextos_padrao = all(regras[id_regra]["contextos"] == DEFINICAO_PADRAO["regras"][id_regra]["contextos"]
+                                    for id_regra in REGRAS)
+
+        cnes = regras[REGRA_CNES]
+        self.cnes_valores_vazios = frozenset(_validar_lista_textos(REGRA_CNES, "valores_vazios", cnes["valores_vazios"]))
+        self.cnes_padrao = _validar_texto(REGRA_CNES, "cnes_padrao", cnes["cnes_padrao"])
+
+        documento = regras[REGRA_TIPO_DOCUMENTO]
+        self.tp_documento_original = _validar_texto(REGRA_TIPO_DOCUMENTO, "tp_documento_original", documento["tp_documento_original"])
+        self.tp_documento_novo = _validar_texto(REGRA_TIPO_DOCUMENTO, "tp_documento_novo", documento["tp_documento_novo"])
+        self.remover_nfe = bool(documento["remover_nfe"])
+
+        prestador = regras[REGRA_TIPO_PRESTADOR]
+        if not isinstance(prestador["mapa_tp_prestador"], dict):
+            raise ValueError(f"Regra '{REGRA_TIPO_PRESTADOR}': 'mapa_tp_prestador' deve ser um objeto (novo código -> lista de códigos).")
+        self.mapa_tp_prestador = {novo_valor.strip(): tuple(_validar_lista_textos(REGRA_TIPO_PRESTADOR, f"mapa_tp_prestador.{novo_valor}", codigos))
+                                  for novo_valor, codigos in prestador["mapa_tp_prestador"].items()}
+        self.tp_prestador_por_original = inverter_mapa_tp_prestador(self.mapa_tp_prestador)
+        repetidos = sum(len(codigos) for codigos in self.mapa_tp_prestador.values()) - len(self.tp_prestador_por_original)
+        if repetidos:
+            logging.warning(f"mapa_tp_prestador tem {repetidos} código(s) em mais de um grupo; vale o primeiro grupo.")
+        # None desliga o cd_Prest com tipo fixo
+        self.cd_prest_tp_fixo = _validar_texto(REGRA_TIPO_PRESTADOR, "cd_prest_tp_fixo", prestador["cd_prest_tp_fixo"], aceita_nulo=True)
+        self.tp_prestador_fixo = _validar_texto(REGRA_TIPO_PRESTADOR, "tp_prestador_fixo", prestador["tp_prestador_fixo"])
+        self.tp_atendimento_tp_fixo = _validar_texto(REGRA_TIPO_PRESTADOR, "tp_atendimento_tp_fixo", prestador["tp_atendimento_tp_fixo"])
+
+        self.codigos_recurso_proprio = frozenset(_validar_lista_textos(
+            REGRA_RECURSO_PROPRIO, "codigos_recurso_proprio", regras[REGRA_RECURSO_PROPRIO]["codigos_recurso_proprio"]))
+
+        pacote = regras[REGRA_DIGITOS_PACOTE]
+        self.id_pacote = _validar_texto(REGRA_DIGITOS_PACOTE, "id_pacote", pacote["id_pacote"]).upper()
+        self.tamanho_cd_pacote = pacote["tamanho_cd_pacote"]
+        if not isinstance(self.tamanho_cd_pacote, int) or isinstance(self.tamanho_cd_pacote, bool) or self.tamanho_cd_pacote < 1:
+            raise ValueError(f"Regra '{REGRA_DIGITOS_PACOTE}': 'tamanho_cd_pacote' deve ser um inteiro positivo.")
+
+
+def compilar_tabelas_regras(definicao=None):
+    """Compila a definição (padrão: DEFINICAO_PADRAO). Levanta ValueError se algum valor for inválido."""
+    return TabelasRegras(definicao if definicao is not None else mesclar_definicao(DEFINICAO_PADRAO))
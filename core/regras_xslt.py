@@ -0,0 +1,492 @@
+# core/regras_xslt.py
+
+"""
+Motor de regras de negócio em XSLT: as regras do WorkflowController viram uma folha de
+estilo gerada a partir das tabelas de regras compiladas (core/regras_config.py) e do
+conjunto de códigos cobertos das listas de referência, executada pelo libxslt.
+O percurso da árvore, os testes e as alterações acontecem em C; o Python só monta a folha
+(uma vez por conjunto de tabelas) e lê as contagens de alterações por regra.
+
+Cada regra é escrita como padrões XPath sobre a árvore de entrada, com as mesmas
+condições dos métodos _regra_*_no. Diferenças conhecidas em relação ao motor em Python,
+que não ocorrem em arquivos PTU válidos (os contextos das regras são os padrão; só os valores
+das condições e ações e as regras ativas vêm da definição):
+- os campos são tratados como folhas (texto sem elementos filhos);
+- espaços são os do XML (normalize-space) e não qualquer espaço Unicode (str.strip);
+- na soma HM/CO os valores devem estar no formato decimal do PTU ('123,45'); valores com
+  mais de duas casas podem arredondar diferente de f"{valor:.2f}" no meio-termo.
+"""
+
+from lxml import etree
+
+from utils import ptu_xpath
+from .regras_config import (REGRA_CNES, REGRA_TIPO_DOCUMENTO, REGRA_DATA_CONHECIMENTO_PROTOCOLO, REGRA_TIPO_PRESTADOR,
+                            REGRA_RECURSO_PROPRIO, REGRA_DIGITOS_PACOTE, REGRA_HM_CO)
+
+# Chaves das contagens por regra (os identificadores de core/regras_config.py), na ordem de aplicação
+REGRAS_XSLT = (REGRA_CNES, REGRA_TIPO_DOCUMENTO, REGRA_DATA_CONHECIMENTO_PROTOCOLO, REGRA_TIPO_PRESTADOR,
+               REGRA_RECURSO_PROPRIO, REGRA_DIGITOS_PACOTE, REGRA_HM_CO)
+# Quantidade de <cd_Servico> avaliados pela regra HM/CO (para a mensagem de resumo)
+CONTAGEM_NOS_CD_SERVICO = "nos_cd_servico"
+
+# Prefixo da mensagem (xsl:message) com as contagens, emitida ao fim da transformação
+PREFIXO_MENSAGEM_CONTAGENS = "auditplus-regras:"
+
+_CONTEXTOS_PRESTADOR = ('ptu:contratadoExecutante', 'ptu:contratadoSolicitante', 'ptu:dadosExecutante')
+_CONTEXTOS_TIPO_PRESTADOR = _CONTEXTOS_PRESTADOR + ('ptu:equipe_Profissional/ptu:Prestador',)
+_GUIA_ANCESTRAL = ('(ancestor::ptu:guiaConsulta | ancestor::ptu:guiaSADT | '
+                   'ancestor::ptu:guiaInternacao | ancestor::ptu:guiaHonorarios)[1]')
+_TEXTO = "normalize-space(text()[1])"
+_MINUSCULAS = "'abcdefghijklmnopqrstuvwxyz'"
+_MAIUSCULAS = "'ABCDEFGHIJKLMNOPQRSTUVWXYZ'"
+
+
+def _literal(texto):
+    """Literal de string XPath 1.0 (sem escape de aspas na linguagem, usa concat quando preciso)."""
+    if "'" not in texto:
+        return f"'{texto}'"
+    if '"' not in texto:
+        return f'"{texto}"'
+    return "concat(" + ", \"'\", ".join(f"'{parte}'" for parte in texto.split("'")) + ")"
+
+
+def _pertence(expressao, valores):
+    """Teste XPath 'expressao in valores' para um conjunto pequeno de códigos."""
+    valores = sorted(valores)
+    if not valores:
+        return "false()"
+    if not any("|" in valor for valor in valores):
+        return f"contains({_literal('|' + '|'.join(valores) + '|')}, concat('|', {expressao}, '|'))"
+    return "(" + " or ".join(f"{expressao} = {_literal(valor)}" for valor in valores) + ")"
+
+
+def _atributo(expressao):
+    return (expressao.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;"))
+
+
+def _texto_xml(texto):
+    return texto.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _cd_prest(k):
+    return f"normalize-space(({k}/ptu:UnimedPrestador/ptu:cd_Prest | {k}/ptu:cd_Prest[not(../ptu:UnimedPrestador/ptu:cd_Prest)])[1]/text()[1])"
+
+
+def _tem_cd_prest(k):
+    return f"({k}/ptu:UnimedPrestador/ptu:cd_Prest or {k}/ptu:cd_Prest)"
+
+
+def _tp_prest(k):
+    return f"normalize-space(({k}/ptu:prestador/ptu:tp_Prestador | {k}/ptu:tp_Prestador[not(../ptu:prestador/ptu:tp_Prestador)])[1]/text()[1])"
+
+
+def _tem_tp_prest(k):
+    return f"({k}/ptu:prestador/ptu:tp_Prestador or {k}/ptu:tp_Prestador)"
+
+
+def _numero(no):
+    return f"number(translate(normalize-space({no}/text()[1]), ',', '.'))"
+
+
+def _valor_monetario(expressao):
+    return f"translate(format-number({expressao}, '0.00'), '.', ',')"
+
+
+def _padroes_regras(tabelas):
+    """
+    Padrões (caminhos relativos, sem '//') dos nós alterados por cada regra. Servem tanto como
+    'match' dos templates quanto, prefixados com '//', para contar as alterações.
+    """
+    invertido = tabelas.tp_prestador_por_original
+    tp_fixo = _literal(tabelas.tp_prestador_fixo)
+    remapeados = {codigo for codigo, novo in invertido.items() if novo != codigo}
+    resultam_no_tp_fixo = {codigo for codigo, novo in invertido.items() if novo == tabelas.tp_prestador_fixo}
+    if tabelas.tp_prestador_fixo not in invertido: resultam_no_tp_fixo.add(tabelas.tp_prestador_fixo)
+
+    def e_cd_prest_fixo(k):
+        return f"{_cd_prest(k)} = {_literal(tabelas.cd_prest_tp_fixo)}" if tabelas.cd_prest_tp_fixo is not None else "false()"
+
+    def muda_tp_prestador(k):
+        return (f"({e_cd_prest_fixo(k)} and {_TEXTO} != {tp_fixo}) or "
+                f"(not({e_cd_prest_fixo(k)}) and {_pertence(_TEXTO, remapeados)})")
+
+    def contexto_resulta_no_tp_fixo(k):
+        return (f"{_tem_cd_prest(k)} and {_tem_tp_prest(k)} and "
+                f"({e_cd_prest_fixo(k)} or {_pertence(_tp_prest(k), resultam_no_tp_fixo)})")
+
+    guia_com_prestador_tp_fixo = " or ".join(f"{_GUIA_ANCESTRAL}//{contexto}[{contexto_resulta_no_tp_fixo('.')}]"
+                                             for contexto in _CONTEXTOS_TIPO_PRESTADOR)
+    recurso_proprio_s = _pertence(_cd_prest('../..'), tabelas.codigos_recurso_proprio)
+    tp_documento_original = _literal(tabelas.tp_documento_original)
+
+    padroes = {
+        'cnes': [f"{contexto}/ptu:CNES[not(text()) or {_pertence(_TEXTO, tabelas.cnes_valores_vazios)}]"
+                 for contexto in ('ptu:contratadoExecutante', 'ptu:dadosExecutante', 'ptu:dadosHospital')],
+        'tp_documento': [f"ptu:Cobranca/ptu:{documento}/ptu:tp_Documento[1][{_TEXTO} = {tp_documento_original}]"
+                         for documento in ('documento1', 'documento2')],
+        'documento_com_nfe': [f"ptu:Cobranca/ptu:{documento}[ptu:NFE][ptu:tp_Documento[1][{_TEXTO} = {tp_documento_original}]]"
+                              for documento in ('documento1', 'documento2')],
+        'dt_protocolo': ["ptu:dadosGuia/ptu:dt_Protocolo[1][../ptu:dt_Conhecimento[1]/text()]"
+                         "[string(text()[1]) != string(../ptu:dt_Conhecimento[1]/text()[1])]"],
+        # tp_Prestador filho direto do contexto (só vale se não houver prestador/tp_Prestador)
+        'tp_prestador_direto': [f"{contexto}/ptu:tp_Prestador[1][not(../ptu:prestador/ptu:tp_Prestador)]"
+                                f"[{_tem_cd_prest('..')}][{muda_tp_prestador('..')}]"
+                                for contexto in _CONTEXTOS_TIPO_PRESTADOR],
+        'tp_prestador_em_prestador': [f"{contexto}/ptu:prestador/ptu:tp_Prestador"
+                                      f"[generate-id() = generate-id(../../ptu:prestador/ptu:tp_Prestador)]"
+                                      f"[{_tem_cd_prest('../..')}][{muda_tp_prestador('../..')}]"
+                                      for contexto in _CONTEXTOS_TIPO_PRESTADOR],
+        'contexto_com_tp_participacao': [f"{contexto}[ptu:tp_Participacao][{_tem_cd_prest('.')}][{_tem_tp_prest('.')}]"
+                                         f"[{e_cd_prest_fixo('.')}]"
+                                         for contexto in _CONTEXTOS_TIPO_PRESTADOR],
+        'tp_atendimento': [f"ptu:dadosAtendimento/ptu:tp_Atendimento[text()][{_TEXTO} != {_literal(tabelas.tp_atendimento_tp_fixo)}]"
+                           f"[generate-id() = generate-id({_GUIA_ANCESTRAL}//ptu:dadosAtendimento/ptu:tp_Atendimento)]"
+                           f"[{guia_com_prestador_tp_fixo}]"],
+        'id_rec_proprio': [f"{contexto}/ptu:prestador/ptu:id_RecProprio"
+                           f"[generate-id() = generate-id(../../ptu:prestador/ptu:id_RecProprio)][{_tem_cd_prest('../..')}]"
+                           f"[({recurso_proprio_s} and (not(text()) or {_TEXTO} != 'S')) or "
+                           f"(not({recurso_proprio_s}) and (not(text()) or {_TEXTO} != 'N'))]"
+                           for contexto in _CONTEXTOS_PRESTADOR],
+        'cd_pacote': [f"ptu:procedimentosExecutados/ptu:cd_Pacote[1]"
+                      f"[../ptu:id_Pacote[1][translate({_TEXTO}, {_MINUSCULAS}, {_MAIUSCULAS}) = {_literal(tabelas.id_pacote)}]]"
+                      f"[{_TEXTO} != ''][string-length({_TEXTO}) < {tabelas.tamanho_cd_pacote}]"],
+    }
+    return padroes
+
+
+def _match(padroes):
+    return _atributo(" | ".join(padroes))
+
+
+def _contagem(padroes):
+    return "count(" + " | ".join(f"//{padrao}" for padrao in padroes) + ")"
+
+
+def montar_folha_estilo_regras(tabelas, codigos_cobertos=None):
+    """
+    Gera o texto da folha de estilo para as regras ativas de 'tabelas' (TabelasRegras).
+    'codigos_cobertos' é o conjunto de cd_Servico cobertos (COBERTO_UNIMED_CG = SIM) das listas
+    de referência; None deixa a regra HM/CO de fora, como acontece no controller quando as
+    listas não foram carregadas.
+    """
+    padroes = _padroes_regras(tabelas)
+    ativas = tabelas.regras_ativas
+    aplicar_hm_co = codigos_cobertos is not None and REGRA_HM_CO in ativas
+
+    escolhas_tp_prestador = "".join(
+        f'<xsl:when test="{_atributo(_pertence("$tp", codigos))}">{_texto_xml(novo_valor)}</xsl:when>'
+        for novo_valor, codigos in tabelas.mapa_tp_prestador.items()
+        if any(tabelas.tp_prestador_por_original[codigo] == novo_valor for codigo in codigos))
+    if tabelas.cd_prest_tp_fixo is not None:
+        escolhas_tp_prestador = (f'<xsl:when test="$cd = {_atributo(_literal(tabelas.cd_prest_tp_fixo))}">'
+                                 f'{_texto_xml(tabelas.tp_prestador_fixo)}</xsl:when>' + escolhas_tp_prestador)
+    escolhas_tp_prestador = escolhas_tp_prestador or '<xsl:when test="false()"/>' # xsl:choose exige um xsl:when
+
+    contagens = [
+        (REGRA_CNES, _contagem(padroes['cnes'])),
+        (REGRA_TIPO_DOCUMENTO, _contagem(padroes['tp_documento'])),
+        (REGRA_DATA_CONHECIMENTO_PROTOCOLO, _contagem(padroes['dt_protocolo'])),
+        (REGRA_TIPO_PRESTADOR, f"{_contagem(padroes['tp_prestador_direto'] + padroes['tp_prestador_em_prestador'])}"
+                               f" + {_contagem(padroes['tp_atendimento'])}"),
+        (REGRA_RECURSO_PROPRIO, _contagem(padroes['id_rec_proprio'])),
+        (REGRA_DIGITOS_PACOTE, _contagem(padroes['cd_pacote'])),
+    ]
+    contagens = [(chave, expressao) for chave, expressao in contagens if chave in ativas]
+    if aplicar_hm_co:
+        contagens += [(REGRA_HM_CO, "string-length($marcas_hm_co)"),
+                      (CONTAGEM_NOS_CD_SERVICO, "count(//ptu:procedimentos/ptu:cd_Servico)")]
+    instrucao_contagens = "<xsl:text> </xsl:text>".join(
+        f'<xsl:text>{chave}=</xsl:text><xsl:value-of select="{_atributo(expressao)}"/>' for chave, expressao in contagens)
+
+    templates_regras = {
+        REGRA_CNES: f"""
+<!-- Regra CNES (09) -->
+<xsl:template match="{_match(padroes['cnes'])}">
+  <xsl:call-template name="substituir-texto"><xsl:with-param name="valor" select="{_atributo(_literal(tabelas.cnes_padrao))}"/></xsl:call-template>
+</xsl:template>
+""",
+        REGRA_TIPO_DOCUMENTO: f"""
+<!-- Regra Tipo Documento (06) -->
+<xsl:template match="{_match(padroes['tp_documento'])}">
+  <xsl:call-template name="substituir-texto"><xsl:with-param name="valor" select="{_atributo(_literal(tabelas.tp_documento_novo))}"/></xsl:call-template>
+</xsl:template>
+""" + (f"""<xsl:template match="{_match(padroes['documento_com_nfe'])}">
+  <xsl:call-template name="copiar-removendo"><xsl:with-param name="remover" select="ptu:NFE[1]"/></xsl:call-template>
+</xsl:template>
+""" if tabelas.remover_nfe else ""),
+        REGRA_DATA_CONHECIMENTO_PROTOCOLO: f"""
+<!-- Regra Data Protocolo (08) -->
+<xsl:template match="{_match(padroes['dt_protocolo'])}">
+  <xsl:call-template name="substituir-texto">
+    <xsl:with-param name="valor" select="string(../ptu:dt_Conhecimento[1]/text()[1])"/>
+  </xsl:call-template>
+</xsl:template>
+""",
+        REGRA_TIPO_PRESTADOR: f"""
+<!-- Regra Tipo Prestador (10) -->
+<xsl:template name="novo-tp-prestador">
+  <xsl:param name="cd"/>
+  <xsl:param name="tp"/>
+  <xsl:choose>
+    {escolhas_tp_prestador}
+    <xsl:otherwise><xsl:value-of select="$tp"/></xsl:otherwise>
+  </xsl:choose>
+</xsl:template>
+<xsl:template match="{_match(padroes['tp_prestador_direto'])}">
+  <xsl:call-template name="substituir-texto">
+    <xsl:with-param name="valor">
+      <xsl:call-template name="novo-tp-prestador">
+        <xsl:with-param name="cd" select="{_atributo(_cd_prest('..'))}"/>
+        <xsl:with-param name="tp" select="{_TEXTO}"/>
+      </xsl:call-template>
+    </xsl:with-param>
+  </xsl:call-template>
+</xsl:template>
+<xsl:template match="{_match(padroes['tp_prestador_em_prestador'])}">
+  <xsl:call-template name="substituir-texto">
+    <xsl:with-param name="valor">
+      <xsl:call-template name="novo-tp-prestador">
+        <xsl:with-param name="cd" select="{_atributo(_cd_prest('../..'))}"/>
+        <xsl:with-param name="tp" select="{_TEXTO}"/>
+      </xsl:call-template>
+    </xsl:with-param>
+  </xsl:call-template>
+</xsl:template>
+<xsl:template match="{_match(padroes['contexto_com_tp_participacao'])}">
+  <xsl:call-template name="copiar-removendo"><xsl:with-param name="remover" select="ptu:tp_Participacao[1]"/></xsl:call-template>
+</xsl:template>
+<xsl:template match="{_match(padroes['tp_atendimento'])}">
+  <xsl:call-template name="substituir-texto"><xsl:with-param name="valor" select="{_atributo(_literal(tabelas.tp_atendimento_tp_fixo))}"/></xsl:call-template>
+</xsl:template>
+""",
+        REGRA_RECURSO_PROPRIO: f"""
+<!-- Regra Recurso Próprio (11) -->
+<xsl:template match="{_match(padroes['id_rec_proprio'])}">
+  <xsl:call-template name="substituir-texto">
+    <xsl:with-param name="valor">
+      <xsl:choose>
+        <xsl:when test="{_atributo(_pertence(_cd_prest('../..'), tabelas.codigos_recurso_proprio))}">S</xsl:when>
+        <xsl:otherwise>N</xsl:otherwise>
+      </xsl:choose>
+    </xsl:with-param>
+  </xsl:call-template>
+</xsl:template>
+""",
+        REGRA_DIGITOS_PACOTE: f"""
+<!-- Regra Dígitos Pacote: cd_Pacote completado com zeros à esquerda (str.zfill) -->
+<xsl:template match="{_match(padroes['cd_pacote'])}">
+  <xsl:variable name="valor" select="{_TEXTO}"/>
+  <xsl:variable name="zeros" select="substring('{'0' * tabelas.tamanho_cd_pacote}', 1, {tabelas.tamanho_cd_pacote} - string-length($valor))"/>
+  <xsl:call-template name="substituir-texto">
+    <xsl:with-param name="valor">
+      <xsl:choose>
+        <xsl:when test="starts-with($valor, '+') or starts-with($valor, '-')">
+          <xsl:value-of select="concat(substring($valor, 1, 1), $zeros, substring($valor, 2))"/>
+        </xsl:when>
+        <xsl:otherwise><xsl:value-of select="concat($zeros, $valor)"/></xsl:otherwise>
+      </xsl:choose>
+    </xsl:with-param>
+  </xsl:call-template>
+</xsl:template>
+""",
+    }
+
+    partes = [f"""<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+    xmlns:ptu="{ptu_xpath.NAMESPACE_PTU}" xmlns:exsl="http://exslt.org/common" exclude-result-prefixes="ptu exsl">
+
+<xsl:template match="/">
+  <xsl:apply-templates select="node()"/>
+  <xsl:message><xsl:text>{PREFIXO_MENSAGEM_CONTAGENS} </xsl:text>{instrucao_contagens}</xsl:message>
+</xsl:template>
+
+<xsl:template match="@*|node()">
+  <xsl:copy><xsl:apply-templates select="@*|node()"/></xsl:copy>
+</xsl:template>
+
+<!-- Troca o texto do elemento (o texto antes do primeiro filho, como elemento.text) -->
+<xsl:template name="substituir-texto">
+  <xsl:param name="valor"/>
+  <xsl:copy>
+    <xsl:apply-templates select="@*"/>
+    <xsl:value-of select="$valor"/>
+    <xsl:apply-templates select="node()[not(self::text()) or preceding-sibling::node()[not(self::text())]]"/>
+  </xsl:copy>
+</xsl:template>
+
+<!-- Copia o elemento sem os filhos em $remover nem o texto que vem logo depois deles (o 'tail' do lxml) -->
+<xsl:template name="copiar-removendo">
+  <xsl:param name="remover"/>
+  <xsl:copy>
+    <xsl:apply-templates select="@*"/>
+    <xsl:apply-templates select="node()[count(. | $remover) != count($remover)]
+        [not(self::text() and preceding-sibling::node()[not(self::text())][1][count(. | $remover) = count($remover)])]"/>
+  </xsl:copy>
+</xsl:template>
+"""]
+    partes.extend(template for id_regra, template in templates_regras.items() if id_regra in ativas)
+    if aplicar_hm_co:
+        partes.append(_folha_estilo_hm_co(codigos_cobertos))
+    partes.append("</xsl:stylesheet>\n")
+    return "".join(partes)
+
+
+def _folha_estilo_hm_co(codigos_cobertos):
+    tabela = "".join(f"<c>{_texto_xml(codigo)}</c>" for codigo in sorted(codigos_cobertos))
+    ns = ptu_xpath.NAMESPACE_PTU
+    return f"""
+<!-- Regras HM/CO: códigos cobertos indexados por xsl:key numa tabela embutida -->
+<xsl:variable name="tabela_cobertura_rtf">{tabela}</xsl:variable>
+<xsl:variable name="tabela_cobertura" select="exsl:node-set($tabela_cobertura_rtf)"/>
+<xsl:key name="codigo-coberto" match="c" use="."/>
+
+<xsl:variable name="marcas_hm_co">
+  <xsl:for-each select="//ptu:guiaConsulta/ptu:dadosGuia/ptu:procedimentos">
+    <xsl:variable name="coberto"><xsl:call-template name="contexto-coberto"><xsl:with-param name="codigos" select="ptu:cd_Servico"/></xsl:call-template></xsl:variable>
+    <xsl:if test="string($coberto) != ''">
+      <xsl:call-template name="acao-hm-co"><xsl:with-param name="s" select="ptu:vl_ServCobrado[1]"/><xsl:with-param name="c" select="ptu:vl_CO_Cobrado[1]"/></xsl:call-template>
+      <xsl:call-template name="acao-hm-co"><xsl:with-param name="s" select="ptu:tx_AdmServico[1]"/><xsl:with-param name="c" select="ptu:tx_AdmCO[1]"/></xsl:call-template>
+    </xsl:if>
+  </xsl:for-each>
+  <xsl:for-each select="//ptu:procedimentosExecutados">
+    <xsl:variable name="coberto"><xsl:call-template name="contexto-coberto"><xsl:with-param name="codigos" select="ptu:procedimentos/ptu:cd_Servico"/></xsl:call-template></xsl:variable>
+    <xsl:if test="string($coberto) != ''">
+      <xsl:call-template name="acao-hm-co"><xsl:with-param name="s" select="ptu:valores[1]/ptu:vl_ServCobrado[1]"/><xsl:with-param name="c" select="ptu:valores[1]/ptu:vl_CO_Cobrado[1]"/></xsl:call-template>
+      <xsl:call-template name="acao-hm-co"><xsl:with-param name="s" select="ptu:taxas[1]/ptu:tx_AdmServico[1]"/><xsl:with-param name="c" select="ptu:taxas[1]/ptu:tx_AdmCO[1]"/></xsl:call-template>
+    </xsl:if>
+  </xsl:for-each>
+</xsl:variable>
+
+<!-- 'S' se algum dos cd_Servico estiver na tabela de cobertura -->
+<xsl:template name="contexto-coberto">
+  <xsl:param name="codigos"/>
+  <xsl:for-each select="$codigos">
+    <xsl:variable name="codigo" select="{_TEXTO}"/>
+    <xsl:for-each select="$tabela_cobertura"><xsl:if test="key('codigo-coberto', $codigo)">S</xsl:if></xsl:for-each>
+  </xsl:for-each>
+</xsl:template>
+
+<!-- A: soma serviço + CO no nó de serviço; B: CO passa para o nó de serviço vazio ou ausente; vazio: nada -->
+<xsl:template name="acao-hm-co">
+  <xsl:param name="s"/>
+  <xsl:param name="c"/>
+  <xsl:choose>
+    <xsl:when test="{_atributo(f"$s and $c and {_numero('$s')} = {_numero('$s')} and {_numero('$c')} = {_numero('$c')}")}">A</xsl:when>
+    <xsl:when test="{_atributo(f"(not($s) or normalize-space($s/text()[1]) = '') and $c and {_numero('$c')} = {_numero('$c')}")}">B</xsl:when>
+  </xsl:choose>
+</xsl:template>
+
+<!-- Copia o elemento que contém os pares (serviço, CO) aplicando a ação de cada par -->
+<xsl:template name="copiar-recipiente-hm-co">
+  <xsl:param name="s1"/><xsl:param name="c1"/><xsl:param name="nome1"/>
+  <xsl:param name="s2" select="/.."/><xsl:param name="c2" select="/.."/><xsl:param name="nome2"/>
+  <xsl:variable name="acao1"><xsl:call-template name="acao-hm-co"><xsl:with-param name="s" select="$s1"/><xsl:with-param name="c" select="$c1"/></xsl:call-template></xsl:variable>
+  <xsl:variable name="acao2"><xsl:call-template name="acao-hm-co"><xsl:with-param name="s" select="$s2"/><xsl:with-param name="c" select="$c2"/></xsl:call-template></xsl:variable>
+  <xsl:copy>
+    <xsl:apply-templates select="@*"/>
+    <xsl:for-each select="node()">
+      <xsl:choose>
+        <xsl:when test="string($acao1) != '' and count(. | $s1) = count($s1)">
+          <xsl:call-template name="substituir-texto">
+            <xsl:with-param name="valor">
+              <xsl:choose>
+                <xsl:when test="string($acao1) = 'A'"><xsl:value-of select="{_atributo(_valor_monetario(f"{_numero('$s1')} + {_numero('$c1')}"))}"/></xsl:when>
+                <xsl:otherwise><xsl:value-of select="{_atributo(_valor_monetario(_numero('$c1')))}"/></xsl:otherwise>
+              </xsl:choose>
+            </xsl:with-param>
+          </xsl:call-template>
+        </xsl:when>
+        <xsl:when test="string($acao1) != '' and count(. | $c1) = count($c1)">
+          <xsl:if test="not($s1)"><xsl:element name="ptu:{{$nome1}}" namespace="{ns}"><xsl:value-of select="{_atributo(_valor_monetario(_numero('$c1')))}"/></xsl:element></xsl:if>
+        </xsl:when>
+        <xsl:when test="string($acao1) != '' and self::text() and preceding-sibling::node()[not(self::text())][1][count(. | $c1) = count($c1)]"/>
+        <xsl:when test="string($acao2) != '' and count(. | $s2) = count($s2)">
+          <xsl:call-template name="substituir-texto">
+            <xsl:with-param name="valor">
+              <xsl:choose>
+                <xsl:when test="string($acao2) = 'A'"><xsl:value-of select="{_atributo(_valor_monetario(f"{_numero('$s2')} + {_numero('$c2')}"))}"/></xsl:when>
+                <xsl:otherwise><xsl:value-of select="{_atributo(_valor_monetario(_numero('$c2')))}"/></xsl:otherwise>
+              </xsl:choose>
+            </xsl:with-param>
+          </xsl:call-template>
+        </xsl:when>
+        <xsl:when test="string($acao2) != '' and count(. | $c2) = count($c2)">
+          <xsl:if test="not($s2)"><xsl:element name="ptu:{{$nome2}}" namespace="{ns}"><xsl:value-of select="{_atributo(_valor_monetario(_numero('$c2')))}"/></xsl:element></xsl:if>
+        </xsl:when>
+        <xsl:when test="string($acao2) != '' and self::text() and preceding-sibling::node()[not(self::text())][1][count(. | $c2) = count($c2)]"/>
+        <xsl:otherwise><xsl:apply-templates select="."/></xsl:otherwise>
+      </xsl:choose>
+    </xsl:for-each>
+  </xsl:copy>
+</xsl:template>
+
+<!-- Guia de consulta: valores e taxas ficam direto em <procedimentos> -->
+<xsl:template match="ptu:guiaConsulta/ptu:dadosGuia/ptu:procedimentos">
+  <xsl:variable name="coberto"><xsl:call-template name="contexto-coberto"><xsl:with-param name="codigos" select="ptu:cd_Servico"/></xsl:call-template></xsl:variable>
+  <xsl:choose>
+    <xsl:when test="string($coberto) != ''">
+      <xsl:call-template name="copiar-recipiente-hm-co">
+        <xsl:with-param name="s1" select="ptu:vl_ServCobrado[1]"/><xsl:with-param name="c1" select="ptu:vl_CO_Cobrado[1]"/><xsl:with-param name="nome1" select="'vl_ServCobrado'"/>
+        <xsl:with-param name="s2" select="ptu:tx_AdmServico[1]"/><xsl:with-param name="c2" select="ptu:tx_AdmCO[1]"/><xsl:with-param name="nome2" select="'tx_AdmServico'"/>
+      </xsl:call-template>
+    </xsl:when>
+    <xsl:otherwise><xsl:copy><xsl:apply-templates select="@*|node()"/></xsl:copy></xsl:otherwise>
+  </xsl:choose>
+</xsl:template>
+
+<!-- Demais guias: <valores> e <taxas> dentro de <procedimentosExecutados>, criados vazios se faltarem -->
+<xsl:template match="ptu:procedimentosExecutados">
+  <xsl:variable name="coberto"><xsl:call-template name="contexto-coberto"><xsl:with-param name="codigos" select="ptu:procedimentos/ptu:cd_Servico"/></xsl:call-template></xsl:variable>
+  <xsl:variable name="valores" select="ptu:valores[1]"/>
+  <xsl:variable name="taxas" select="ptu:taxas[1]"/>
+  <xsl:copy>
+    <xsl:apply-templates select="@*"/>
+    <xsl:choose>
+      <xsl:when test="string($coberto) != ''">
+        <xsl:for-each select="node()">
+          <xsl:choose>
+            <xsl:when test="count(. | $valores) = count($valores)">
+              <xsl:call-template name="copiar-recipiente-hm-co">
+                <xsl:with-param name="s1" select="ptu:vl_ServCobrado[1]"/><xsl:with-param name="c1" select="ptu:vl_CO_Cobrado[1]"/><xsl:with-param name="nome1" select="'vl_ServCobrado'"/>
+              </xsl:call-template>
+            </xsl:when>
+            <xsl:when test="count(. | $taxas) = count($taxas)">
+              <xsl:call-template name="copiar-recipiente-hm-co">
+                <xsl:with-param name="s1" select="ptu:tx_AdmServico[1]"/><xsl:with-param name="c1" select="ptu:tx_AdmCO[1]"/><xsl:with-param name="nome1" select="'tx_AdmServico'"/>
+              </xsl:call-template>
+            </xsl:when>
+            <xsl:otherwise><xsl:apply-templates select="."/></xsl:otherwise>
+          </xsl:choose>
+        </xsl:for-each>
+        <xsl:if test="not($valores)"><xsl:element name="ptu:valores" namespace="{ns}"/></xsl:if>
+        <xsl:if test="not($taxas)"><xsl:element name="ptu:taxas" namespace="{ns}"/></xsl:if>
+      </xsl:when>
+      <xsl:otherwise><xsl:apply-templates select="node()"/></xsl:otherwise>
+    </xsl:choose>
+  </xsl:copy>
+</xsl:template>
+"""
+
+
+def compilar_regras_xslt(tabelas, codigos_cobertos=None):
+    """Compila a folha de estilo das regras. O objeto pode ser reaproveitado enquanto as tabelas não mudarem."""
+    folha_estilo = montar_folha_estilo_regras(tabelas, codigos_cobertos)
+    return etree.XSLT(etree.XML(folha_estilo.encode('utf-8')))
+
+
+def aplicar_regras_xslt(transformacao, raiz):
+    """
+    Aplica a transformação à árvore de 'raiz'. O XSLT produz um documento novo, que é o que
+    deve ser usado depois (gravado ou lido): devolver o resultado para dentro da árvore
+    original custaria mais que a própria transformação.
+    Retorna (nova raiz, {regra: alterações}); as contagens incluem CONTAGEM_NOS_CD_SERVICO
+    quando a regra HM/CO estiver na folha.
+    """
+    arvore = raiz.getroottree()
+    resultado = transformacao(arvore)
+    resultado.docinfo.URL = arvore.docinfo.URL # Mantém o nome do arquivo para as mensagens de log
+    contagens = {}
+    for entrada in transformacao.error_log:
+        if entrada.message.startswith(PREFIXO_MENSAGEM_CONTAGENS):
+            texto_contagens = entrada.message[len(PREFIXO_MENSAGEM_CONTAGENS):]
+            contagens = {chave: int(valor) for chave, valor in (par.split("=") for par in texto_contagens.split())}
+    return resultado.getroot(), contagens
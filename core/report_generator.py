@@ -177,6 +177,184 @@ def gerar_csv_internacao(guias_relevantes, output_folder):
         logging.exception(f"Erro inesperado ao gerar o arquivo CSV: {e}")
         return False
 
+def gerar_csv_itens_duplicados(itens_duplicados, output_folder):
+    """
+    Gera um arquivo CSV com os itens cobrados em mais de uma fatura da mesma competência
+    (registros de core/itens_duplicados.localizar_duplicados_entre_faturas).
+    """
+    if not itens_duplicados:
+        return True
+
+    output_filename = "Itens Duplicados entre Faturas.csv"
+    output_path = os.path.join(output_folder, output_filename)
+
+    headers = [
+        "Competência",
+        "Código Beneficiário",
+        "Nº Guia",
+        "Código Serviço",
+        "Tabela",
+        "Data Execução",
+        "Valor (R$)",
+        "Faturas"
+    ]
+
+    logging.info(f"Gerando CSV de itens duplicados entre faturas em: {output_path}")
+
+    try:
+        with open(output_path, 'w', newline='', encoding='utf-8-sig') as csvfile:
+            writer = csv.writer(csvfile, delimiter=';')
+            writer.writerow(headers)
+
+            for item in itens_duplicados:
+                valor_str = "{:.2f}".format(int(item.get('valor_centavos') or 0) / 100).replace('.', ',')
+                writer.writerow([
+                    item.get('competencia', ''),
+                    item.get('codigo_beneficiario', ''),
+                    item.get('numero_guia', ''),
+                    item.get('cd_servico', ''),
+                    item.get('tp_tabela', ''),
+                    _formatar_data_para_relatorio(item.get('dt_execucao', '')),
+                    valor_str,
+                    ", ".join(item.get('faturas', []))
+                ])
+        logging.info(f"Arquivo CSV '{output_filename}' gerado com sucesso com {len(itens_duplicados)} itens.")
+        return True
+    except IOError as e:
+        logging.exception(f"Erro de E/S ao tentar escrever o arquivo CSV em {output_path}: {e}")
+        return False
+    except Exception as e:
+        logging.exception(f"Erro inesperado ao gerar o arquivo CSV: {e}")
+        return False
+
+def gerar_csv_substituicao_hash(resumo_substituicao, output_folder):
+    """
+    Gera um arquivo CSV com o resumo da substituição de hash em lote: um registro por arquivo .051
+    (ver WorkflowController.executar_substituicao_hash_em_lote).
+    """
+    if not resumo_substituicao:
+        return True
+
+    output_filename = "Resumo Substituição de Hash.csv"
+    output_path = os.path.join(output_folder, output_filename)
+
+    headers = [
+        "Arquivo",
+        "Hash Antigo",
+        "Hash Novo",
+        "ZIP Gerado",
+        "Status",
+        "Mensagem"
+    ]
+
+    logging.info(f"Gerando CSV do resumo da substituição de hash em: {output_path}")
+
+    try:
+        with open(output_path, 'w', newline='', encoding='utf-8-sig') as csvfile:
+            writer = csv.writer(csvfile, delimiter=';')
+            writer.writerow(headers)
+
+            for registro in resumo_substituicao:
+                writer.writerow([
+                    registro.get('arquivo', ''),
+                    registro.get('hash_antigo', ''),
+                    registro.get('hash_novo', ''),
+                    registro.get('zip_gerado', ''),
+                    registro.get('status', ''),
+                    " ".join((registro.get('mensagem') or '').split())
+                ])
+        logging.info(f"Arquivo CSV '{output_filename}' gerado com sucesso com {len(resumo_substituicao)} arquivos.")
+        return True
+    except IOError as e:
+        logging.exception(f"Erro de E/S ao tentar escrever o arquivo CSV em {output_path}: {e}")
+        return False
+    except Exception as e:
+        logging.exception(f"Erro inesperado ao gerar o arquivo CSV: {e}")
+        return False
+
+NOME_CSV_VERIFICACAO_HASH = "Verificação de Hash.csv"
+
+def gerar_csv_verificacao_hash(faturas_a_revisar, output_folder):
+    """
+    Gera um arquivo CSV com as faturas cujo <ptu:hash> não confere, está ausente ou não pôde ser
+    verificado (registros de WorkflowController.verificar_hashes_faturas).
+    """
+    if not faturas_a_revisar:
+        return True
+
+    output_path = os.path.join(output_folder, NOME_CSV_VERIFICACAO_HASH)
+
+    headers = [
+        "Arquivo ZIP",
+        "Arquivo XML",
+        "Hash Gravado",
+        "Hash Calculado",
+        "Status",
+        "Mensagem"
+    ]
+
+    logging.info(f"Gerando CSV da verificação de hash em: {output_path}")
+
+    try:
+        with open(output_path, 'w', newline='', encoding='utf-8-sig') as csvfile:
+            writer = csv.writer(csvfile, delimiter=';')
+            writer.writerow(headers)
+
+            for registro in faturas_a_revisar:
+                writer.writerow([
+                    registro.get('arquivo', ''),
+                    registro.get('xml', ''),
+                    registro.get('hash_gravado', ''),
+                    registro.get('hash_calculado', ''),
+                    registro.get('status', ''),
+                    " ".join((registro.get('mensagem') or '').split())
+                ])
+        logging.info(f"Arquivo CSV '{NOME_CSV_VERIFICACAO_HASH}' gerado com sucesso com {len(faturas_a_revisar)} faturas.")
+        return True
+    except IOError as e:
+        logging.exception(f"Erro de E/S ao tentar escrever o arquivo CSV em {output_path}: {e}")
+        return False
+    except Exception as e:
+        logging.exception(f"Erro inesperado ao gerar o arquivo CSV: {e}")
+        return False
+
+def gerar_csv_resumo_livro_alteracoes(resumo_por_regra_e_unimed, output_folder):
+    """
+    Gera um arquivo CSV com a contagem das alterações das regras de negócio por regra e por Unimed
+    (linhas de core/livro_alteracoes.LivroAlteracoes.resumo_por_regra_e_unimed).
+    """
+    if not resumo_por_regra_e_unimed:
+        return True
+
+    output_filename = "Alterações por Regra e Unimed.csv"
+    output_path = os.path.join(output_folder, output_filename)
+
+    headers = [
+        "Regra",
+        "Unimed Destino",
+        "Alterações",
+        "Arquivos",
+        "Guias"
+    ]
+
+    logging.info(f"Gerando CSV de alterações por regra e Unimed em: {output_path}")
+
+    try:
+        with open(output_path, 'w', newline='', encoding='utf-8-sig') as csvfile:
+            writer = csv.writer(csvfile, delimiter=';')
+            writer.writerow(headers)
+
+            for regra, unimed, alteracoes, arquivos, guias in resumo_por_regra_e_unimed:
+                writer.writerow([regra, unimed or '', alteracoes, arquivos, guias])
+        logging.info(f"Arquivo CSV '{output_filename}' gerado com sucesso com {len(resumo_por_regra_e_unimed)} linhas.")
+        return True
+    except IOError as e:
+        logging.exception(f"Erro de E/S ao tentar escrever o arquivo CSV em {output_path}: {e}")
+        return False
+    except Exception as e:
+        logging.exception(f"Erro inesperado ao gerar o arquivo CSV: {e}")
+        return False
+
 if __name__ == '__main__':
     # Mantenha seu bloco de teste como estava, ou adapte para testar ambas as funções
     # ... (seu código de teste if __name__ == '__main__' que você já tinha) ...
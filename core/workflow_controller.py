@@ -1,58 +1,158 @@
 # core/workflow_controller.py (Versão Consolidada com todas as regras e correções)
 
 import os
+import io
+import hashlib
 import shutil
 import traceback
 import logging
 import json
+import time
+import sqlite3
+import concurrent.futures
 from lxml import etree
 
 from . import file_manager
 from utils import xml_parser
+from utils import rastreamento
+from utils import ptu_xpath
+from utils import gravacao_incremental
 from . import data_manager
 from . import distribution_engine
 from . import report_generator
+from . import cache_importacao
+from . import regras_config
+from . import regras_xslt
+from . import livro_alteracoes
+from . import itens_duplicados
+from . import indice_cobertura
 from core import hash_calculator
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - (controller) - %(message)s')
+_RASTRO_REGRAS = rastreamento.obter_canal(rastreamento.CANAL_REGRAS)
 
 class WorkflowController:
     VALOR_MINIMO_GUIA = 25000.0
 
-    TP_PRESTADOR_MAP = {
-        "01": {"10", "11", "13", "49", "54", "80", "82"},
-        "02": {"42", "44", "50", "51", "52"},
-        "03": {"30"},
-        "04": {"20", "21", "22", "23", "24", "25", "26", "40", "41", "43", "45", "46", "53"},
-        "05": {"12", "47"},
-        "06": {"14"},
-        "11": {"48"}
-    }
-    CD_PRESTADOR_RECURSO_PROPRIO = {"11099", "11110", "11152", "8150", "8162"}
+    # Definição das regras de negócio (ver core/regras_config.py); None = config/regras_negocio.json
+    ARQUIVO_REGRAS_NEGOCIO = None
+
+    # Modos de leitura do .051 em processar_importacao_faturas
+    MODO_LEITURA_ARVORE = "arvore"
+    MODO_LEITURA_STREAMING = "streaming"
+    MODO_LEITURA_CABECALHO = "cabecalho"
+    MODO_LEITURA_ARQUIVO_TEMPORARIO = "arquivo_temporario"
+
+    # Motor de regras: passagem única com despacho por tag (padrão), uma varredura por regra
+    # ou a folha de estilo gerada em core/regras_xslt.py, executada pelo libxslt
+    MOTOR_REGRAS_PASSAGEM_UNICA = "passagem_unica"
+    MOTOR_REGRAS_SEQUENCIAL = "sequencial"
+    MOTOR_REGRAS_XSLT = "xslt"
+    MOTOR_REGRAS = MOTOR_REGRAS_PASSAGEM_UNICA
+
+    # Gravação do XML corrigido: só os trechos alterados sobre os bytes originais
+    # (ver utils/gravacao_incremental.py) ou a árvore inteira reserializada com pretty_print
+    GRAVACAO_XML_INCREMENTAL = "incremental"
+    GRAVACAO_XML_COMPLETA = "completa"
+    GRAVACAO_XML = GRAVACAO_XML_INCREMENTAL
+
+    # Regras de negócio na importação (modos de leitura árvore e arquivo temporário): sempre
+    # aplicadas, só quando alteram alguma tag que a importação lê (ver _regras_alteram_dados_importados)
+    # ou aplicadas com o XML corrigido guardado em 'Correção XML/.xmls_corrigidos' para a etapa de
+    # correção, que então não aplica as regras de novo
+    REGRAS_IMPORTACAO_APLICAR = "aplicar"
+    REGRAS_IMPORTACAO_SE_NECESSARIO = "se_necessario"
+    REGRAS_IMPORTACAO_GUARDAR = "guardar"
+    REGRAS_IMPORTACAO = REGRAS_IMPORTACAO_SE_NECESSARIO
+
+    # Livro de alterações (core/livro_alteracoes.py): um registro por alteração das regras em
+    # 'Correção XML/.livro_alteracoes.sqlite', gravado quando o XML corrigido é produzido
+    # (correção, ou importação com REGRAS_IMPORTACAO_GUARDAR). O motor XSLT não registra.
+    REGISTRAR_LIVRO_ALTERACOES = True
+
+    # Backup dos ZIPs na importação: a cópia simples de sempre (padrão; um backup existente é
+    # mantido com um único exists()) ou por conteúdo, guardando uma vez cada fatura mesmo quando
+    # importada de pastas diferentes (ver file_manager.fazer_backup_fatura_deduplicado). O modo por
+    # conteúdo lê cada ZIP novo ou alterado para o SHA-256 e compensa quando as mesmas faturas
+    # voltam em várias importações.
+    MODO_BACKUP_DEDUPLICADO = "deduplicado"
+    MODO_BACKUP_COPIA = "copia"
+    MODO_BACKUP = MODO_BACKUP_COPIA
+    # Repositório de objetos do backup por conteúdo (None = file_manager.pasta_objetos_backup_compartilhada,
+    # ao lado das pastas de importação e compartilhado entre elas)
+    PASTA_OBJETOS_BACKUP = None
+
+    # Status de cada arquivo no resumo de executar_substituicao_hash_em_lote
+    STATUS_SUBSTITUICAO_SUCESSO = "Sucesso"
+    STATUS_SUBSTITUICAO_FALHA = "Falha"
+    STATUS_SUBSTITUICAO_NAO_PROCESSADO = "Não processado"
+
+    # Status de cada ZIP em verificar_hashes_faturas
+    STATUS_HASH_CORRETO = "Correto"
+    STATUS_HASH_DIVERGENTE = "Divergente"
+    STATUS_HASH_AUSENTE = "Sem hash"
+    STATUS_HASH_ERRO = "Erro de leitura"
+
+    # Configuração que os workers dos pools recebem do processo principal (ver _configuracao_workers),
+    # esteja ela na classe ou sobrescrita na instância: com spawn (Windows) o worker só veria os padrões
+    _ATRIBUTOS_CONFIGURACAO_WORKERS = ('VALOR_MINIMO_GUIA', 'MOTOR_REGRAS', 'GRAVACAO_XML', 'REGRAS_IMPORTACAO',
+                                       'REGISTRAR_LIVRO_ALTERACOES', 'MODO_BACKUP', 'PASTA_OBJETOS_BACKUP')
 
     NOME_ARQUIVO_REFERENCIAL_HM = "referencial_hm_list202502.json"
     NOME_ARQUIVO_REFERENCIAL_SADT = "referencial_sadt_list202502.json"
     NOME_ARQUIVO_REFERENCIAL_INSTRUCOES = "referencial_instructions_rol202502.json"
 
-    def __init__(self, log_callback=None):
+    def __init__(self, log_callback=None, log_detalhe_callback=None):
         if log_callback:
             self.log_callback = log_callback
         else:
             self.log_callback = lambda msg: (print(f"LOG_GUI_FALLBACK: {msg}"), logging.info(f"(Controller-Fallback): {msg}"))
+        # Detalhe por nó das regras (uma linha por alteração). None desliga o detalhe sem
+        # nenhum custo de formatação, o que é o recomendado em produção.
+        self.log_detalhe_callback = log_detalhe_callback
+        # Nos workers dos pools (importação, substituição de hash): se o detalhe por nó deve ser
+        # coletado e devolvido ao processo principal
+        self.registrar_detalhes = False
 
         self.lista_faturas_processadas = []
+        self.status_ultima_importacao = []
         self.pasta_faturas_importadas_atual = None
+        # Chamado com um dict de progresso (ver _reportar_progresso); usado pela interface
+        self.progresso_callback = None
+        self._cancelamento_solicitado = False
         self.nomes_auditores_ultima_distribuicao = []
         self.plano_ultima_distribuicao = {}
         self.codigos_hm_t00_a_ignorar = set()
 
-        self.dados_referencia_hm = {}
-        self.dados_referencia_sadt = {}
+        # cd_Servico cobertos das listas referenciais HM/SADT (vazio até _carregar_dados_listas_referencia)
+        self.indice_cobertura = indice_cobertura.IndiceCobertura()
         self.dados_instrucoes_gerais = None
 
         self.ttRegistrosRegraHM = []
         self.ttRegistrosRegraCO = []
+        # Itens cobrados em duplicidade no último arquivo (_remanejar_itens_duplicados_xml) e entre
+        # as faturas da última importação (ver core/itens_duplicados.py)
         self.ttRegistrosRemanejar = []
+        self.itens_duplicados_ultima_importacao = []
+        # Um registro por arquivo da última substituição de hash em lote (executar_substituicao_hash_em_lote)
+        self.resumo_ultima_substituicao_lote = []
+        # Um registro por ZIP da última verificação de hash (verificar_hashes_faturas)
+        self.resultado_ultima_verificacao_hash = []
+        # (raiz, chaves dos itens) do último remanejamento, reaproveitadas por _montar_dados_fatura
+        self._chaves_itens_ultima_raiz = None
+        # Regras padrão até a leitura de config/regras_negocio.json (_carregar_definicao_regras)
+        self.tabelas_regras = regras_config.compilar_tabelas_regras()
+        # Folha de estilo do motor XSLT e as tabelas com que foi gerada (recompilada quando mudam)
+        self._regras_xslt_compiladas = None
+        self._chave_regras_xslt = None
+        # Registro das alterações feitas pelas regras, para a gravação incremental (None = não registrar)
+        self._registro_alteracoes = None
+        # Registros do livro de alterações do arquivo em andamento (None = não registrar) e a regra
+        # que está sendo aplicada (nome do método do modo sequencial)
+        self._alteracoes_livro = None
+        self._regra_em_execucao = None
+        # Chave de _chave_regras_aplicadas e as tabelas com que foi calculada
+        self._chave_regras_aplicadas_cache = (None, None)
 
         self.log_callback("Controller: WorkflowController inicializando...")
         try:
@@ -78,190 +178,282 @@ class WorkflowController:
             else:
                 self.log_callback("Controller: Dados das Unimeds já estavam carregados.")
 
+            self._carregar_definicao_regras()
             self._carregar_dados_listas_referencia()
 
         except Exception as e:
             self.log_callback(f"Controller ERRO CRÍTICO na inicialização: {e}\n{traceback.format_exc()}")
         self.log_callback("WorkflowController inicializado e pronto.")
 
+    def solicitar_cancelamento(self):
+        """Pede a interrupção da operação em andamento; é verificada entre uma fatura e outra."""
+        self._cancelamento_solicitado = True
+
+    def _reportar_progresso(self, arquivo_atual, concluidos, total, bytes_processados=0, bytes_total=0):
+        if self.progresso_callback:
+            self.progresso_callback({'arquivo_atual': arquivo_atual, 'concluidos': concluidos, 'total': total,
+                                     'bytes_processados': bytes_processados, 'bytes_total': bytes_total})
+
+    def _carregar_definicao_regras(self):
+        caminho_arquivo = self.ARQUIVO_REGRAS_NEGOCIO or regras_config.ARQUIVO_REGRAS_PADRAO
+        self.log_callback(f"Controller: Carregando definição das regras de negócio de '{os.path.basename(caminho_arquivo)}'...")
+        try:
+            self.tabelas_regras = regras_config.compilar_tabelas_regras(regras_config.carregar_definicao_regras(caminho_arquivo))
+            inativas = [id_regra for id_regra in regras_config.REGRAS if id_regra not in self.tabelas_regras.regras_ativas]
+            self.log_callback(f"Controller: {len(self.tabelas_regras.regras_ativas)} regras de negócio ativas"
+                              + (f" (inativas: {', '.join(inativas)})." if inativas else "."))
+        except ValueError as e:
+            self.log_callback(f"Controller ERRO: Definição de regras inválida em '{caminho_arquivo}': {e}. Usando as regras padrão.")
+            self.tabelas_regras = regras_config.compilar_tabelas_regras()
+
     def _carregar_dados_listas_referencia(self):
         self.log_callback("Controller: Carregando dados das Listas Referenciais HM, SADT e Instruções...")
         base_dir_config = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                                        '..', 'config', 'reference_list')
+        self._carregar_indice_cobertura(base_dir_config)
+        if not self.indice_cobertura.carregado:
+            self.log_callback(f"Controller AVISO: Nenhum código ('{indice_cobertura.CHAVE_CODIGO}') lido das listas referenciais HM/SADT; "
+                              "a regra HM/CO não será aplicada.")
+
+        nome_arquivo = self.NOME_ARQUIVO_REFERENCIAL_INSTRUCOES
+        dados_json = self._ler_lista_referencia(base_dir_config, nome_arquivo)
+        if isinstance(dados_json, (list, dict)):
+            self.dados_instrucoes_gerais = dados_json
+            self.log_callback(f"Controller: Dados gerais carregados de '{nome_arquivo}'.")
+        elif dados_json is not None:
+            self.log_callback(f"Controller AVISO: Estrutura inesperada em '{nome_arquivo}'.")
+
+    def _ler_lista_referencia(self, base_dir_config, nome_arquivo):
+        """JSON de uma lista referencial, ou None (com o erro no log) se não puder ser lido."""
+        caminho_arquivo = os.path.join(base_dir_config, nome_arquivo)
+        if not os.path.exists(caminho_arquivo):
+            self.log_callback(f"Controller ERRO: Arquivo '{nome_arquivo}' não encontrado em '{base_dir_config}'.")
+            return None
+        try:
+            with open(caminho_arquivo, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            self.log_callback(f"Controller ERRO ao carregar '{nome_arquivo}': {e}")
+            logging.exception(f"Falha ao carregar {nome_arquivo}")
+            return None
 
-        arquivos_a_carregar = [
-            (self.NOME_ARQUIVO_REFERENCIAL_HM, 'dados_referencia_hm', 'COD_PROCEDIMENTO'),
-            (self.NOME_ARQUIVO_REFERENCIAL_SADT, 'dados_referencia_sadt', 'COD_PROCEDIMENTO'),
-            (self.NOME_ARQUIVO_REFERENCIAL_INSTRUCOES, 'dados_instrucoes_gerais', None)
-        ]
-        for nome_arquivo, atributo_controller, chave_dicionario in arquivos_a_carregar:
-            try:
-                caminho_arquivo = os.path.join(base_dir_config, nome_arquivo)
-                if os.path.exists(caminho_arquivo):
-                    with open(caminho_arquivo, 'r', encoding='utf-8') as f:
-                        dados_json = json.load(f)
-                        if chave_dicionario and isinstance(dados_json, list):
-                            # [PONTO DE ATENÇÃO MENCIONADO ANTERIORMENTE]
-                            # Se 'COD_PROCEDIMENTO' não existe, mas outra chave serve como ID,
-                            # esta linha pode precisar ser ajustada (ex: usar outra chave como ID)
-                            dados_dict = {str(proc.get(chave_dicionario,'')).strip(): proc
-                                          for proc in dados_json if proc.get(chave_dicionario)}
-                            setattr(self, atributo_controller, dados_dict)
-                            self.log_callback(f"Controller: {len(dados_dict)} registros carregados de '{nome_arquivo}'.")
-                        elif isinstance(dados_json, (list, dict)) and chave_dicionario is None :
-                            setattr(self, atributo_controller, dados_json)
-                            self.log_callback(f"Controller: Dados gerais carregados de '{nome_arquivo}'.")
-                        else:
-                            self.log_callback(f"Controller AVISO: Estrutura inesperada em '{nome_arquivo}'.")
-                else:
-                    self.log_callback(f"Controller ERRO: Arquivo '{nome_arquivo}' não encontrado em '{base_dir_config}'.")
-            except Exception as e:
-                self.log_callback(f"Controller ERRO ao carregar '{nome_arquivo}': {e}")
-                logging.exception(f"Falha ao carregar {nome_arquivo}")
+    def _carregar_indice_cobertura(self, base_dir_config):
+        """
+        Índice de cobertura HM/SADT (ver core/indice_cobertura.py): reaproveita o índice gravado se as
+        listas não mudaram; senão lê os JSONs, compila e grava o índice (só quando as duas listas foram lidas).
+        """
+        caminhos_listas = [os.path.join(base_dir_config, nome) for nome in (self.NOME_ARQUIVO_REFERENCIAL_HM, self.NOME_ARQUIVO_REFERENCIAL_SADT)]
+        caminho_indice = indice_cobertura.caminho_indice(base_dir_config)
+        impressao = indice_cobertura.impressao_listas(*caminhos_listas)
+        indice = indice_cobertura.ler_indice(caminho_indice, impressao)
+        if indice is not None:
+            self.indice_cobertura = indice
+            self.log_callback(f"Controller: Índice de cobertura HM/SADT reaproveitado ({indice.quantidade_hm} + {indice.quantidade_sadt} "
+                              f"códigos, {len(indice.codigos_cobertos)} cobertos).")
+            return
+
+        registros_listas = []
+        for caminho_lista in caminhos_listas:
+            nome_arquivo = os.path.basename(caminho_lista)
+            dados_json = self._ler_lista_referencia(base_dir_config, nome_arquivo)
+            if dados_json is not None and not isinstance(dados_json, list):
+                self.log_callback(f"Controller AVISO: Estrutura inesperada em '{nome_arquivo}'.")
+                dados_json = None
+            registros_listas.append(dados_json)
+        self.indice_cobertura = indice = indice_cobertura.compilar_indice(*registros_listas)
+        for nome_arquivo, registros, quantidade in zip(map(os.path.basename, caminhos_listas), registros_listas,
+                                                      (indice.quantidade_hm, indice.quantidade_sadt)):
+            if registros is not None: self.log_callback(f"Controller: {quantidade} registros carregados de '{nome_arquivo}'.")
+        self.log_callback(f"Controller: Índice de cobertura HM/SADT compilado: {len(indice.codigos_cobertos)} códigos cobertos.")
+        if any(registros is None for registros in registros_listas): return
+        try:
+            indice_cobertura.gravar_indice(caminho_indice, indice, impressao)
+        except OSError as e:
+            self.log_callback(f"Controller AVISO: Índice de cobertura não gravado em '{caminho_indice}': {e}")
 
     def _aplicar_regra_cnes(self, raiz_xml, namespaces):
         regras_aplicadas_nesta_funcao = 0
-        xpath_cnes = './/ptu:contratadoExecutante/ptu:CNES | .//ptu:dadosExecutante/ptu:CNES | .//ptu:dadosHospital/ptu:CNES'
-        nos_cnes = raiz_xml.xpath(xpath_cnes, namespaces=namespaces)
+        nos_cnes = self.tabelas_regras.xpath_contextos[regras_config.REGRA_CNES](raiz_xml)
         if nos_cnes:
             for no_cnes in nos_cnes:
-                if no_cnes is not None and (not no_cnes.text or no_cnes.text.strip() in ('', '0')):
-                    valor_antigo = no_cnes.text.strip() if no_cnes.text else "vazio"
-                    no_cnes.text = '9999999'
-                    self.log_callback(f"    - Regra CNES (09) aplicada. CNES antigo: '{valor_antigo}', Novo: '9999999'.")
-                    regras_aplicadas_nesta_funcao += 1
+                regras_aplicadas_nesta_funcao += self._regra_cnes_no(no_cnes, namespaces, self.log_detalhe_callback)
         return regras_aplicadas_nesta_funcao
 
+    def _regra_cnes_no(self, no_cnes, namespaces, registrar_detalhe):
+        tabelas = self.tabelas_regras
+        if no_cnes is not None and (not no_cnes.text or no_cnes.text.strip() in tabelas.cnes_valores_vazios):
+            valor_antigo = no_cnes.text.strip() if no_cnes.text else "vazio"
+            self._definir_texto(no_cnes, tabelas.cnes_padrao)
+            if registrar_detalhe: registrar_detalhe(f"    - Regra CNES (09) aplicada. CNES antigo: '{valor_antigo}', Novo: '{tabelas.cnes_padrao}'.")
+            return 1
+        return 0
+
     def _aplicar_regra_tipo_documento(self, raiz_xml, namespaces):
         regras_aplicadas_nesta_funcao = 0
-        elementos_documento = raiz_xml.xpath('.//ptu:Cobranca/ptu:documento1 | .//ptu:Cobranca/ptu:documento2', namespaces=namespaces)
+        elementos_documento = self.tabelas_regras.xpath_contextos[regras_config.REGRA_TIPO_DOCUMENTO](raiz_xml)
         for doc_element in elementos_documento:
-            if doc_element is None: continue
-            tp_documento_node = doc_element.find('./ptu:tp_Documento', namespaces=namespaces)
-            if tp_documento_node is not None and tp_documento_node.text and tp_documento_node.text.strip() == '3':
-                tp_documento_node.text = '1'
-                self.log_callback(f"    - Regra Tipo Documento (06) aplicada: tp_Documento alterado de '3' para '1'.")
-                regras_aplicadas_nesta_funcao += 1
-                nfe_node = doc_element.find('./ptu:NFE', namespaces=namespaces)
-                if nfe_node is not None:
-                    doc_element.remove(nfe_node)
-                    self.log_callback(f"    - Regra Tipo Documento (06): Tag <NFE> removida.")
+            regras_aplicadas_nesta_funcao += self._regra_tipo_documento_no(doc_element, namespaces, self.log_detalhe_callback)
         return regras_aplicadas_nesta_funcao
 
+    def _regra_tipo_documento_no(self, doc_element, namespaces, registrar_detalhe):
+        if doc_element is None: return 0
+        tabelas = self.tabelas_regras
+        tp_documento_node = doc_element.find(ptu_xpath.TAG_TP_DOCUMENTO)
+        if tp_documento_node is not None and tp_documento_node.text and tp_documento_node.text.strip() == tabelas.tp_documento_original:
+            self._definir_texto(tp_documento_node, tabelas.tp_documento_novo)
+            if registrar_detalhe: registrar_detalhe(f"    - Regra Tipo Documento (06) aplicada: tp_Documento alterado de '{tabelas.tp_documento_original}' para '{tabelas.tp_documento_novo}'.")
+            nfe_node = doc_element.find(ptu_xpath.TAG_NFE) if tabelas.remover_nfe else None
+            if nfe_node is not None:
+                self._remover_no(doc_element, nfe_node)
+                if registrar_detalhe: registrar_detalhe(f"    - Regra Tipo Documento (06): Tag <NFE> removida.")
+            return 1
+        return 0
+
     def _aplicar_regra_data_conhecimento_protocolo(self, raiz_xml, namespaces):
         regras_aplicadas_nesta_funcao = 0
-        guias_com_dados_guia = raiz_xml.xpath('.//ptu:dadosGuia', namespaces=namespaces)
+        guias_com_dados_guia = self.tabelas_regras.xpath_contextos[regras_config.REGRA_DATA_CONHECIMENTO_PROTOCOLO](raiz_xml)
         for dados_guia_node in guias_com_dados_guia:
-            if dados_guia_node is None: continue
-            dt_conhecimento_node = dados_guia_node.find('./ptu:dt_Conhecimento', namespaces=namespaces)
-            dt_protocolo_node = dados_guia_node.find('./ptu:dt_Protocolo', namespaces=namespaces)
-            if dt_conhecimento_node is not None and dt_protocolo_node is not None and \
-               dt_conhecimento_node.text is not None:
-                if dt_protocolo_node.text != dt_conhecimento_node.text:
-                    valor_antigo_protocolo = dt_protocolo_node.text if dt_protocolo_node.text is not None else "vazio/None"
-                    dt_protocolo_node.text = dt_conhecimento_node.text
-                    self.log_callback(f"    - Regra Data Protocolo (08) aplicada: dt_Protocolo ('{valor_antigo_protocolo}') atualizada para '{dt_conhecimento_node.text}'.")
-                    regras_aplicadas_nesta_funcao += 1
+            regras_aplicadas_nesta_funcao += self._regra_data_conhecimento_protocolo_no(dados_guia_node, namespaces, self.log_detalhe_callback)
         return regras_aplicadas_nesta_funcao
 
+    def _regra_data_conhecimento_protocolo_no(self, dados_guia_node, namespaces, registrar_detalhe):
+        if dados_guia_node is None: return 0
+        dt_conhecimento_node = dados_guia_node.find(ptu_xpath.TAG_DT_CONHECIMENTO)
+        dt_protocolo_node = dados_guia_node.find(ptu_xpath.TAG_DT_PROTOCOLO)
+        if dt_conhecimento_node is not None and dt_protocolo_node is not None and \
+           dt_conhecimento_node.text is not None:
+            if dt_protocolo_node.text != dt_conhecimento_node.text:
+                valor_antigo_protocolo = dt_protocolo_node.text if dt_protocolo_node.text is not None else "vazio/None"
+                self._definir_texto(dt_protocolo_node, dt_conhecimento_node.text)
+                if registrar_detalhe: registrar_detalhe(f"    - Regra Data Protocolo (08) aplicada: dt_Protocolo ('{valor_antigo_protocolo}') atualizada para '{dt_conhecimento_node.text}'.")
+                return 1
+        return 0
+
     def _aplicar_regra_tipo_prestador(self, raiz_xml, namespaces):
         regras_aplicadas_nesta_funcao = 0
-        elementos_prestador_contexto = raiz_xml.xpath(
-            './/ptu:contratadoExecutante | .//ptu:contratadoSolicitante | .//ptu:dadosExecutante | .//ptu:equipe_Profissional/ptu:Prestador',
-            namespaces=namespaces
-        )
+        elementos_prestador_contexto = self.tabelas_regras.xpath_contextos[regras_config.REGRA_TIPO_PRESTADOR](raiz_xml)
         for contexto_node in elementos_prestador_contexto:
-            if contexto_node is None: continue
-            cd_prest_node = contexto_node.find('./ptu:UnimedPrestador/ptu:cd_Prest', namespaces)
-            if cd_prest_node is None:
-                cd_prest_node = contexto_node.find('./ptu:cd_Prest', namespaces)
-
-            tp_prestador_node = contexto_node.find('./ptu:prestador/ptu:tp_Prestador', namespaces)
-            if tp_prestador_node is None:
-                tp_prestador_node = contexto_node.find('./ptu:tp_Prestador', namespaces)
-
-            if not (cd_prest_node is not None and tp_prestador_node is not None): continue
-
-            cd_prest_atual = cd_prest_node.text.strip() if cd_prest_node.text else ""
-            tp_prest_original = tp_prestador_node.text.strip() if tp_prestador_node.text else ""
-            novo_tp_prest = tp_prest_original
-
-            if cd_prest_atual == "11110":
-                novo_tp_prest = "08"
-                tp_participacao_node = contexto_node.find('./ptu:tp_Participacao', namespaces)
-                if tp_participacao_node is None and cd_prest_node.getparent() is not None and cd_prest_node.getparent().tag.endswith("UnimedPrestador"):
-                     pai_unimed_prest = cd_prest_node.getparent()
-                     if pai_unimed_prest.getparent() is not None:
-                        tp_participacao_node = pai_unimed_prest.getparent().find('./ptu:tp_Participacao', namespaces)
-
-                if tp_participacao_node is not None:
-                    pai_participacao = tp_participacao_node.getparent()
-                    if pai_participacao is not None:
-                        pai_participacao.remove(tp_participacao_node)
-                        self.log_callback(f"    - Regra Tipo Prestador (10): tp_Participacao removida para cd_Prest {cd_prest_atual}.")
-            else:
-                for novo_valor, codigos_originais in self.TP_PRESTADOR_MAP.items():
-                    if tp_prest_original in codigos_originais: novo_tp_prest = novo_valor; break
-
-            if novo_tp_prest != tp_prest_original:
-                tp_prestador_node.text = novo_tp_prest
-                self.log_callback(f"    - Regra Tipo Prestador (10): cd_Prest '{cd_prest_atual}', tp_Prestador de '{tp_prest_original}' para '{novo_tp_prest}'.")
-                regras_aplicadas_nesta_funcao += 1
-
-            if novo_tp_prest == "08":
-                guia_pai_list = contexto_node.xpath('ancestor::ptu:guiaConsulta | ancestor::ptu:guiaSADT | ancestor::ptu:guiaInternacao | ancestor::ptu:guiaHonorarios', namespaces=namespaces)
-                if guia_pai_list:
-                    guia_pai = guia_pai_list[0]
-                    if guia_pai is None: continue
-                    dados_atendimento_node = guia_pai.find('.//ptu:dadosAtendimento/ptu:tp_Atendimento', namespaces=namespaces)
-                    if dados_atendimento_node is not None and dados_atendimento_node.text is not None and dados_atendimento_node.text.strip() != "06":
-                        valor_antigo_tp_atend = dados_atendimento_node.text.strip()
-                        dados_atendimento_node.text = "06"
-                        self.log_callback(f"    - Regra Tipo Prestador (10): tp_Atendimento ('{valor_antigo_tp_atend}') alterado para '06'.")
-                        regras_aplicadas_nesta_funcao += 1
+            regras_aplicadas_nesta_funcao += self._regra_tipo_prestador_no(contexto_node, namespaces, self.log_detalhe_callback)
         return regras_aplicadas_nesta_funcao
 
+    def _regra_tipo_prestador_no(self, contexto_node, namespaces, registrar_detalhe):
+        regras_aplicadas_neste_no = 0
+        if contexto_node is None: return 0
+        cd_prest_node = contexto_node.find(ptu_xpath.CAMINHO_UNIMED_PRESTADOR_CD_PREST)
+        if cd_prest_node is None:
+            cd_prest_node = contexto_node.find(ptu_xpath.TAG_CD_PREST)
+
+        tp_prestador_node = contexto_node.find(ptu_xpath.CAMINHO_PRESTADOR_TP_PRESTADOR)
+        if tp_prestador_node is None:
+            tp_prestador_node = contexto_node.find(ptu_xpath.TAG_TP_PRESTADOR)
+
+        if not (cd_prest_node is not None and tp_prestador_node is not None): return 0
+
+        cd_prest_atual = cd_prest_node.text.strip() if cd_prest_node.text else ""
+        tp_prest_original = tp_prestador_node.text.strip() if tp_prestador_node.text else ""
+        novo_tp_prest = tp_prest_original
+
+        tabelas = self.tabelas_regras
+        if cd_prest_atual == tabelas.cd_prest_tp_fixo:
+            novo_tp_prest = tabelas.tp_prestador_fixo
+            tp_participacao_node = contexto_node.find(ptu_xpath.TAG_TP_PARTICIPACAO)
+            if tp_participacao_node is None and cd_prest_node.getparent() is not None and cd_prest_node.getparent().tag.endswith("UnimedPrestador"):
+                 pai_unimed_prest = cd_prest_node.getparent()
+                 if pai_unimed_prest.getparent() is not None:
+                    tp_participacao_node = pai_unimed_prest.getparent().find(ptu_xpath.TAG_TP_PARTICIPACAO)
+
+            if tp_participacao_node is not None:
+                pai_participacao = tp_participacao_node.getparent()
+                if pai_participacao is not None:
+                    self._remover_no(pai_participacao, tp_participacao_node)
+                    if registrar_detalhe: registrar_detalhe(f"    - Regra Tipo Prestador (10): tp_Participacao removida para cd_Prest {cd_prest_atual}.")
+        else:
+            novo_tp_prest = tabelas.tp_prestador_por_original.get(tp_prest_original, tp_prest_original)
+
+        if novo_tp_prest != tp_prest_original:
+            self._definir_texto(tp_prestador_node, novo_tp_prest)
+            if registrar_detalhe: registrar_detalhe(f"    - Regra Tipo Prestador (10): cd_Prest '{cd_prest_atual}', tp_Prestador de '{tp_prest_original}' para '{novo_tp_prest}'.")
+            regras_aplicadas_neste_no += 1
+
+        if novo_tp_prest == tabelas.tp_prestador_fixo:
+            guia_pai_list = ptu_xpath.XPATH_GUIA_ANCESTRAL(contexto_node)
+            if guia_pai_list:
+                guia_pai = guia_pai_list[0]
+                if guia_pai is None: return regras_aplicadas_neste_no
+                dados_atendimento_node = guia_pai.find(ptu_xpath.CAMINHO_DESC_TP_ATENDIMENTO)
+                if dados_atendimento_node is not None and dados_atendimento_node.text is not None and dados_atendimento_node.text.strip() != tabelas.tp_atendimento_tp_fixo:
+                    valor_antigo_tp_atend = dados_atendimento_node.text.strip()
+                    self._definir_texto(dados_atendimento_node, tabelas.tp_atendimento_tp_fixo)
+                    if registrar_detalhe: registrar_detalhe(f"    - Regra Tipo Prestador (10): tp_Atendimento ('{valor_antigo_tp_atend}') alterado para '{tabelas.tp_atendimento_tp_fixo}'.")
+                    regras_aplicadas_neste_no += 1
+        return regras_aplicadas_neste_no
+
     def _aplicar_regra_recurso_proprio(self, raiz_xml, namespaces):
         regras_aplicadas_nesta_funcao = 0
-        elementos_prestador_contexto = raiz_xml.xpath(
-            './/ptu:contratadoExecutante | .//ptu:contratadoSolicitante | .//ptu:dadosExecutante', namespaces=namespaces
-        )
+        elementos_prestador_contexto = self.tabelas_regras.xpath_contextos[regras_config.REGRA_RECURSO_PROPRIO](raiz_xml)
         for contexto_node in elementos_prestador_contexto:
-            if contexto_node is None: continue
-            cd_prest_node = contexto_node.find('./ptu:UnimedPrestador/ptu:cd_Prest', namespaces)
-            if cd_prest_node is None:
-                cd_prest_node = contexto_node.find('./ptu:cd_Prest', namespaces)
-
-            id_rec_proprio_node = contexto_node.find('./ptu:prestador/ptu:id_RecProprio', namespaces=namespaces)
-
-            if cd_prest_node is not None and id_rec_proprio_node is not None:
-                cd_prest_atual = cd_prest_node.text.strip() if cd_prest_node.text else ""
-                novo_valor_rec_proprio = "S" if cd_prest_atual in self.CD_PRESTADOR_RECURSO_PROPRIO else "N"
-                if id_rec_proprio_node.text is None or id_rec_proprio_node.text.strip() != novo_valor_rec_proprio:
-                    valor_antigo = id_rec_proprio_node.text.strip() if id_rec_proprio_node.text else "vazio"
-                    id_rec_proprio_node.text = novo_valor_rec_proprio
-                    self.log_callback(f"    - Regra Recurso Próprio (11): cd_Prest '{cd_prest_atual}', id_RecProprio de '{valor_antigo}' para '{novo_valor_rec_proprio}'.")
-                    regras_aplicadas_nesta_funcao += 1
+            regras_aplicadas_nesta_funcao += self._regra_recurso_proprio_no(contexto_node, namespaces, self.log_detalhe_callback)
         return regras_aplicadas_nesta_funcao
 
+    def _regra_recurso_proprio_no(self, contexto_node, namespaces, registrar_detalhe):
+        if contexto_node is None: return 0
+        cd_prest_node = contexto_node.find(ptu_xpath.CAMINHO_UNIMED_PRESTADOR_CD_PREST)
+        if cd_prest_node is None:
+            cd_prest_node = contexto_node.find(ptu_xpath.TAG_CD_PREST)
+
+        id_rec_proprio_node = contexto_node.find(ptu_xpath.CAMINHO_PRESTADOR_ID_REC_PROPRIO)
+
+        if cd_prest_node is not None and id_rec_proprio_node is not None:
+            cd_prest_atual = cd_prest_node.text.strip() if cd_prest_node.text else ""
+            novo_valor_rec_proprio = "S" if cd_prest_atual in self.tabelas_regras.codigos_recurso_proprio else "N"
+            if id_rec_proprio_node.text is None or id_rec_proprio_node.text.strip() != novo_valor_rec_proprio:
+                valor_antigo = id_rec_proprio_node.text.strip() if id_rec_proprio_node.text else "vazio"
+                self._definir_texto(id_rec_proprio_node, novo_valor_rec_proprio)
+                if registrar_detalhe: registrar_detalhe(f"    - Regra Recurso Próprio (11): cd_Prest '{cd_prest_atual}', id_RecProprio de '{valor_antigo}' para '{novo_valor_rec_proprio}'.")
+                return 1
+        return 0
+
     def _aplicar_regra_digitos_pacote(self, raiz_xml, namespaces):
         regras_aplicadas_nesta_funcao = 0
-        procedimentos_executados_nodes = raiz_xml.xpath('.//ptu:procedimentosExecutados', namespaces=namespaces)
+        procedimentos_executados_nodes = self.tabelas_regras.xpath_contextos[regras_config.REGRA_DIGITOS_PACOTE](raiz_xml)
         for proc_exec_node in procedimentos_executados_nodes:
-            if proc_exec_node is None: continue
-            id_pacote_node = proc_exec_node.find('./ptu:id_Pacote', namespaces=namespaces)
-            cd_pacote_node = proc_exec_node.find('./ptu:cd_Pacote', namespaces=namespaces)
-            if id_pacote_node is not None and cd_pacote_node is not None:
-                id_pacote_text = id_pacote_node.text.strip() if id_pacote_node.text else ""
-                cd_pacote_text_original = cd_pacote_node.text.strip() if cd_pacote_node.text else ""
-                if id_pacote_text.upper() == "S" and cd_pacote_text_original and len(cd_pacote_text_original) < 8:
-                    novo_cd_pacote = cd_pacote_text_original.zfill(8)
-                    if cd_pacote_node.text != novo_cd_pacote:
-                         cd_pacote_node.text = novo_cd_pacote
-                         self.log_callback(f"    - Regra Dígitos Pacote: cd_Pacote '{cd_pacote_text_original}' para '{novo_cd_pacote}'.")
-                         regras_aplicadas_nesta_funcao += 1
+            regras_aplicadas_nesta_funcao += self._regra_digitos_pacote_no(proc_exec_node, namespaces, self.log_detalhe_callback)
         return regras_aplicadas_nesta_funcao
 
+    def _regra_digitos_pacote_no(self, proc_exec_node, namespaces, registrar_detalhe):
+        if proc_exec_node is None: return 0
+        id_pacote_node = proc_exec_node.find(ptu_xpath.TAG_ID_PACOTE)
+        cd_pacote_node = proc_exec_node.find(ptu_xpath.TAG_CD_PACOTE)
+        if id_pacote_node is not None and cd_pacote_node is not None:
+            id_pacote_text = id_pacote_node.text.strip() if id_pacote_node.text else ""
+            cd_pacote_text_original = cd_pacote_node.text.strip() if cd_pacote_node.text else ""
+            tamanho_cd_pacote = self.tabelas_regras.tamanho_cd_pacote
+            if id_pacote_text.upper() == self.tabelas_regras.id_pacote and cd_pacote_text_original and len(cd_pacote_text_original) < tamanho_cd_pacote:
+                novo_cd_pacote = cd_pacote_text_original.zfill(tamanho_cd_pacote)
+                if cd_pacote_node.text != novo_cd_pacote:
+                     self._definir_texto(cd_pacote_node, novo_cd_pacote)
+                     if registrar_detalhe: registrar_detalhe(f"    - Regra Dígitos Pacote: cd_Pacote '{cd_pacote_text_original}' para '{novo_cd_pacote}'.")
+                     return 1
+        return 0
+
+    def _definir_texto(self, no, valor):
+        if self._registro_alteracoes is not None: self._registro_alteracoes.texto_alterado(no)
+        if self._alteracoes_livro is not None: self._registrar_no_livro(no, livro_alteracoes.OPERACAO_TEXTO, no.text, valor)
+        no.text = valor
+
+    def _remover_no(self, pai, no):
+        if self._registro_alteracoes is not None: self._registro_alteracoes.removido(no)
+        if self._alteracoes_livro is not None: self._registrar_no_livro(no, livro_alteracoes.OPERACAO_REMOVER, no.text, None)
+        pai.remove(no)
+
+    def _registrar_no_inserido(self, no):
+        if self._registro_alteracoes is not None: self._registro_alteracoes.inserido(no)
+        if self._alteracoes_livro is not None: self._registrar_no_livro(no, livro_alteracoes.OPERACAO_INSERIR, None, no.text)
+
+    def _registrar_no_livro(self, no, operacao, valor_antigo, valor_novo):
+        numero_guia, caminho = livro_alteracoes.localizar_no(no)
+        self._alteracoes_livro.append((self._regra_em_execucao, numero_guia, caminho, operacao, valor_antigo, valor_novo))
+
     def _get_node_text_as_float(self, node, default_if_none=None):
         if node is not None and node.text and node.text.strip():
             try:
@@ -275,15 +467,15 @@ class WorkflowController:
             self.log_callback(f"      - AVISO: Tentativa de atualizar/criar nó '{tag_name_sem_prefixo}' em um parent_node Nulo.")
             return None
 
-        tag_name_com_prefixo_ns = f"{{{namespaces['ptu']}}}{tag_name_sem_prefixo}"
-        node = parent_node.find(f'./ptu:{tag_name_sem_prefixo}', namespaces=namespaces)
+        tag_name_com_prefixo_ns = ptu_xpath.tag_ptu(tag_name_sem_prefixo)
+        node = parent_node.find(tag_name_com_prefixo_ns)
 
         formatted_value = new_value
         if isinstance(new_value, (int, float)):
             formatted_value = f"{new_value:.2f}".replace('.', ',', 1) # Usar 1 para substituir apenas a primeira ocorrência
 
         if node is not None:
-            node.text = formatted_value
+            self._definir_texto(node, formatted_value)
         else:
             node = etree.Element(tag_name_com_prefixo_ns, attrib=None, nsmap=None)
             node.text = formatted_value
@@ -295,161 +487,444 @@ class WorkflowController:
                     parent_node.append(node)
             else:
                 parent_node.append(node)
+            self._registrar_no_inserido(node)
         return node
 
     def _aplicar_modificacoes_regras_hm_co_xml(self, raiz_xml, namespaces):
         regras_aplicadas_nesta_funcao_total = 0
         self.log_callback("    - Iniciando aplicação de regras HM/CO (baseado em JSONs)...")
 
-        if not self.dados_referencia_hm and not self.dados_referencia_sadt:
+        if not self.indice_cobertura.carregado:
             self.log_callback("    - AVISO: Dados de referência HM/SADT não carregados. Regras HM/CO não podem ser aplicadas.")
             return 0
 
-        xpath_cd_servico = ".//ptu:procedimentos/ptu:cd_Servico | .//ptu:procedimentosExecutados/ptu:procedimentos/ptu:cd_Servico"
-        todos_nos_cd_servico_xml = raiz_xml.xpath(xpath_cd_servico, namespaces=namespaces)
+        todos_nos_cd_servico_xml = self.tabelas_regras.xpath_contextos[regras_config.REGRA_HM_CO](raiz_xml)
 
         for no_cd_servico_xml in todos_nos_cd_servico_xml:
-            if no_cd_servico_xml is None: continue
-            cd_servico_xml = no_cd_servico_xml.text.strip() if no_cd_servico_xml.text else None
-            if not cd_servico_xml: continue
-
-            dados_proc_ref = self.dados_referencia_hm.get(cd_servico_xml)
-            if not dados_proc_ref:
-                dados_proc_ref = self.dados_referencia_sadt.get(cd_servico_xml)
-
-            if dados_proc_ref:
-                no_procedimentos_tag = no_cd_servico_xml.getparent()
-                if no_procedimentos_tag is None: continue
-
-                no_contexto_valores_e_taxas = None
-                if no_procedimentos_tag.tag == etree.QName(namespaces['ptu'], 'procedimentos'): # GuiaConsulta
-                    no_procedimentos_pai = no_procedimentos_tag.getparent()
-                    if no_procedimentos_pai is not None and no_procedimentos_pai.tag == etree.QName(namespaces['ptu'], 'dadosGuia'):
-                        guia_node = no_procedimentos_pai.getparent()
-                        if guia_node is not None and guia_node.tag == etree.QName(namespaces['ptu'], 'guiaConsulta'):
-                             no_contexto_valores_e_taxas = no_procedimentos_tag
-
-                if no_contexto_valores_e_taxas is None:
-                    no_procedimentos_exec_pai = no_procedimentos_tag.getparent()
-                    if no_procedimentos_exec_pai is not None and \
-                       no_procedimentos_exec_pai.tag == etree.QName(namespaces['ptu'], 'procedimentosExecutados'):
-                        no_contexto_valores_e_taxas = no_procedimentos_exec_pai
-
-                if no_contexto_valores_e_taxas is None: continue
-
-                coberto_status = dados_proc_ref.get("COBERTO_UNIMED_CG", "NAO").upper()
-
-                if coberto_status == "SIM":
-                    regras_aplicadas_neste_item = 0
-                    vl_serv_node, vl_co_node, tx_adm_serv_node, tx_adm_co_node = None, None, None, None
-                    contexto_para_val = no_contexto_valores_e_taxas
-                    contexto_para_tax = no_contexto_valores_e_taxas
-
-                    if no_contexto_valores_e_taxas.tag == etree.QName(namespaces['ptu'], 'procedimentos'): # GuiaConsulta
-                        vl_serv_node = no_contexto_valores_e_taxas.find('./ptu:vl_ServCobrado', namespaces)
-                        vl_co_node = no_contexto_valores_e_taxas.find('./ptu:vl_CO_Cobrado', namespaces)
-                        tx_adm_serv_node = no_contexto_valores_e_taxas.find('./ptu:tx_AdmServico', namespaces)
-                        tx_adm_co_node = no_contexto_valores_e_taxas.find('./ptu:tx_AdmCO', namespaces)
-                    elif no_contexto_valores_e_taxas.tag == etree.QName(namespaces['ptu'], 'procedimentosExecutados'):
-                        valores_node = no_contexto_valores_e_taxas.find('./ptu:valores', namespaces)
-                        taxas_node = no_contexto_valores_e_taxas.find('./ptu:taxas', namespaces)
-
-                        if valores_node is not None:
-                            vl_serv_node = valores_node.find('./ptu:vl_ServCobrado', namespaces)
-                            vl_co_node = valores_node.find('./ptu:vl_CO_Cobrado', namespaces)
-                            contexto_para_val = valores_node
-                        else: # Cria <valores> se não existir
-                            valores_node = etree.SubElement(no_contexto_valores_e_taxas, f"{{{namespaces['ptu']}}}valores", attrib=None, nsmap=None)
-                            contexto_para_val = valores_node
-
-                        if taxas_node is not None:
-                            tx_adm_serv_node = taxas_node.find('./ptu:tx_AdmServico', namespaces)
-                            tx_adm_co_node = taxas_node.find('./ptu:tx_AdmCO', namespaces)
-                            contexto_para_tax = taxas_node
-                        else: # Cria <taxas> se não existir
-                            taxas_node = etree.SubElement(no_contexto_valores_e_taxas, f"{{{namespaces['ptu']}}}taxas", attrib=None, nsmap=None)
-                            contexto_para_tax = taxas_node
-                    else: continue
-
-                    val_serv = self._get_node_text_as_float(vl_serv_node)
-                    val_co = self._get_node_text_as_float(vl_co_node)
-
-                    if vl_serv_node is not None and vl_co_node is not None and val_serv is not None and val_co is not None:
-                        novo_val_serv = val_serv + val_co
-                        vl_serv_node.text = f"{novo_val_serv:.2f}".replace('.', ',')
-                        parent_co = vl_co_node.getparent();
-                        if parent_co is not None: parent_co.remove(vl_co_node)
-                        regras_aplicadas_neste_item += 1
-                    elif (vl_serv_node is None or not (vl_serv_node.text and vl_serv_node.text.strip())) and \
-                         (vl_co_node is not None and val_co is not None):
-                        self._update_or_create_node(contexto_para_val, "vl_ServCobrado", val_co, namespaces, insert_before_node=vl_co_node)
-                        if vl_co_node is not None :
-                            parent_co = vl_co_node.getparent();
-                            if parent_co is not None: parent_co.remove(vl_co_node)
-                        regras_aplicadas_neste_item += 1
-
-                    taxa_serv = self._get_node_text_as_float(tx_adm_serv_node)
-                    taxa_co = self._get_node_text_as_float(tx_adm_co_node)
-
-                    if tx_adm_serv_node is not None and tx_adm_co_node is not None and taxa_serv is not None and taxa_co is not None:
-                        nova_taxa_serv = taxa_serv + taxa_co
-                        tx_adm_serv_node.text = f"{nova_taxa_serv:.2f}".replace('.', ',')
-                        parent_taxa_co = tx_adm_co_node.getparent();
-                        if parent_taxa_co is not None: parent_taxa_co.remove(tx_adm_co_node)
-                        regras_aplicadas_neste_item += 1
-                    elif (tx_adm_serv_node is None or not (tx_adm_serv_node.text and tx_adm_serv_node.text.strip())) and \
-                         (tx_adm_co_node is not None and taxa_co is not None):
-                        self._update_or_create_node(contexto_para_tax, "tx_AdmServico", taxa_co, namespaces, insert_before_node=tx_adm_co_node)
-                        if tx_adm_co_node is not None:
-                            parent_taxa_co = tx_adm_co_node.getparent();
-                            if parent_taxa_co is not None: parent_taxa_co.remove(tx_adm_co_node)
-                        regras_aplicadas_neste_item += 1
-
-                    if regras_aplicadas_neste_item > 0:
-                        self.log_callback(f"        - Modificações HM/CO aplicadas para o procedimento: {cd_servico_xml}")
-                        regras_aplicadas_nesta_funcao_total += regras_aplicadas_neste_item
-
-        if regras_aplicadas_nesta_funcao_total == 0 and len(todos_nos_cd_servico_xml) > 0 :
+            regras_aplicadas_nesta_funcao_total += self._regra_hm_co_no(no_cd_servico_xml, namespaces, self.log_detalhe_callback)
+
+        self._log_resumo_regras_hm_co(regras_aplicadas_nesta_funcao_total, len(todos_nos_cd_servico_xml))
+        return regras_aplicadas_nesta_funcao_total
+
+    def _log_resumo_regras_hm_co(self, regras_aplicadas_nesta_funcao_total, quantidade_nos_cd_servico):
+        if regras_aplicadas_nesta_funcao_total == 0 and quantidade_nos_cd_servico > 0 :
              self.log_callback("    - Nenhuma modificação específica de regra HM/CO foi aplicada.")
         elif regras_aplicadas_nesta_funcao_total > 0:
             self.log_callback(f"    - {regras_aplicadas_nesta_funcao_total} modificações de regras HM/CO aplicadas ao XML.")
 
-        return regras_aplicadas_nesta_funcao_total
+    def _regra_hm_co_no(self, no_cd_servico_xml, namespaces, registrar_detalhe):
+        if no_cd_servico_xml is None: return 0
+        cd_servico_xml = no_cd_servico_xml.text.strip() if no_cd_servico_xml.text else None
+        if not cd_servico_xml: return 0
+
+        if cd_servico_xml not in self.indice_cobertura.codigos_cobertos: return 0
+
+        no_procedimentos_tag = no_cd_servico_xml.getparent()
+        if no_procedimentos_tag is None: return 0
+
+        no_contexto_valores_e_taxas = None
+        if no_procedimentos_tag.tag == ptu_xpath.TAG_PROCEDIMENTOS: # GuiaConsulta
+            no_procedimentos_pai = no_procedimentos_tag.getparent()
+            if no_procedimentos_pai is not None and no_procedimentos_pai.tag == ptu_xpath.TAG_DADOS_GUIA:
+                guia_node = no_procedimentos_pai.getparent()
+                if guia_node is not None and guia_node.tag == ptu_xpath.TAG_GUIA_CONSULTA:
+                     no_contexto_valores_e_taxas = no_procedimentos_tag
+
+        if no_contexto_valores_e_taxas is None:
+            no_procedimentos_exec_pai = no_procedimentos_tag.getparent()
+            if no_procedimentos_exec_pai is not None and \
+               no_procedimentos_exec_pai.tag == ptu_xpath.TAG_PROCEDIMENTOS_EXECUTADOS:
+                no_contexto_valores_e_taxas = no_procedimentos_exec_pai
+
+        if no_contexto_valores_e_taxas is None: return 0
+
+        regras_aplicadas_neste_item = 0
+        vl_serv_node, vl_co_node, tx_adm_serv_node, tx_adm_co_node = None, None, None, None
+        contexto_para_val = no_contexto_valores_e_taxas
+        contexto_para_tax = no_contexto_valores_e_taxas
+
+        if no_contexto_valores_e_taxas.tag == ptu_xpath.TAG_PROCEDIMENTOS: # GuiaConsulta
+            vl_serv_node = no_contexto_valores_e_taxas.find(ptu_xpath.TAG_VL_SERV_COBRADO)
+            vl_co_node = no_contexto_valores_e_taxas.find(ptu_xpath.TAG_VL_CO_COBRADO)
+            tx_adm_serv_node = no_contexto_valores_e_taxas.find(ptu_xpath.TAG_TX_ADM_SERVICO)
+            tx_adm_co_node = no_contexto_valores_e_taxas.find(ptu_xpath.TAG_TX_ADM_CO)
+        elif no_contexto_valores_e_taxas.tag == ptu_xpath.TAG_PROCEDIMENTOS_EXECUTADOS:
+            valores_node = no_contexto_valores_e_taxas.find(ptu_xpath.TAG_VALORES)
+            taxas_node = no_contexto_valores_e_taxas.find(ptu_xpath.TAG_TAXAS)
+
+            if valores_node is not None:
+                vl_serv_node = valores_node.find(ptu_xpath.TAG_VL_SERV_COBRADO)
+                vl_co_node = valores_node.find(ptu_xpath.TAG_VL_CO_COBRADO)
+                contexto_para_val = valores_node
+            else: # Cria <valores> se não existir
+                valores_node = etree.SubElement(no_contexto_valores_e_taxas, ptu_xpath.TAG_VALORES, attrib=None, nsmap=None)
+                self._registrar_no_inserido(valores_node)
+                contexto_para_val = valores_node
+
+            if taxas_node is not None:
+                tx_adm_serv_node = taxas_node.find(ptu_xpath.TAG_TX_ADM_SERVICO)
+                tx_adm_co_node = taxas_node.find(ptu_xpath.TAG_TX_ADM_CO)
+                contexto_para_tax = taxas_node
+            else: # Cria <taxas> se não existir
+                taxas_node = etree.SubElement(no_contexto_valores_e_taxas, ptu_xpath.TAG_TAXAS, attrib=None, nsmap=None)
+                self._registrar_no_inserido(taxas_node)
+                contexto_para_tax = taxas_node
+        else: return 0
+
+        val_serv = self._get_node_text_as_float(vl_serv_node)
+        val_co = self._get_node_text_as_float(vl_co_node)
+
+        if vl_serv_node is not None and vl_co_node is not None and val_serv is not None and val_co is not None:
+            novo_val_serv = val_serv + val_co
+            self._definir_texto(vl_serv_node, f"{novo_val_serv:.2f}".replace('.', ','))
+            parent_co = vl_co_node.getparent();
+            if parent_co is not None: self._remover_no(parent_co, vl_co_node)
+            regras_aplicadas_neste_item += 1
+        elif (vl_serv_node is None or not (vl_serv_node.text and vl_serv_node.text.strip())) and \
+             (vl_co_node is not None and val_co is not None):
+            self._update_or_create_node(contexto_para_val, "vl_ServCobrado", val_co, namespaces, insert_before_node=vl_co_node)
+            if vl_co_node is not None :
+                parent_co = vl_co_node.getparent();
+                if parent_co is not None: self._remover_no(parent_co, vl_co_node)
+            regras_aplicadas_neste_item += 1
+
+        taxa_serv = self._get_node_text_as_float(tx_adm_serv_node)
+        taxa_co = self._get_node_text_as_float(tx_adm_co_node)
+
+        if tx_adm_serv_node is not None and tx_adm_co_node is not None and taxa_serv is not None and taxa_co is not None:
+            nova_taxa_serv = taxa_serv + taxa_co
+            self._definir_texto(tx_adm_serv_node, f"{nova_taxa_serv:.2f}".replace('.', ','))
+            parent_taxa_co = tx_adm_co_node.getparent();
+            if parent_taxa_co is not None: self._remover_no(parent_taxa_co, tx_adm_co_node)
+            regras_aplicadas_neste_item += 1
+        elif (tx_adm_serv_node is None or not (tx_adm_serv_node.text and tx_adm_serv_node.text.strip())) and \
+             (tx_adm_co_node is not None and taxa_co is not None):
+            self._update_or_create_node(contexto_para_tax, "tx_AdmServico", taxa_co, namespaces, insert_before_node=tx_adm_co_node)
+            if tx_adm_co_node is not None:
+                parent_taxa_co = tx_adm_co_node.getparent();
+                if parent_taxa_co is not None: self._remover_no(parent_taxa_co, tx_adm_co_node)
+            regras_aplicadas_neste_item += 1
+
+        if regras_aplicadas_neste_item > 0:
+            if registrar_detalhe: registrar_detalhe(f"        - Modificações HM/CO aplicadas para o procedimento: {cd_servico_xml}")
+        return regras_aplicadas_neste_item
 
     def _remanejar_itens_duplicados_xml(self, raiz_xml, namespaces):
-        regras_aplicadas_nesta_funcao = 0
-        # Futuramente: Carregar self.ttRegistrosRemanejar de um JSON ou outra fonte
+        """
+        Localiza os itens (procedimentosExecutados) cobrados mais de uma vez no arquivo, pelo índice
+        de core/itens_duplicados.py, e os guarda em self.ttRegistrosRemanejar para a auditoria.
+        O XML não é alterado: retorna 0.
+        """
+        indice = itens_duplicados.indexar_itens(raiz_xml)
+        self._chaves_itens_ultima_raiz = (raiz_xml, [itens_duplicados.chave_para_texto(chave) for chave in indice])
+        duplicados = itens_duplicados.duplicados_no_indice(indice)
+        self.ttRegistrosRemanejar = [itens_duplicados.registro_da_chave(chave, quantidade=len(itens)) for chave, itens in duplicados]
         if self.ttRegistrosRemanejar:
-            self.log_callback("    - AVISO: _remanejar_itens_duplicados_xml não implementado em detalhe.")
-        return regras_aplicadas_nesta_funcao
+            self.log_callback(f"    - AVISO: {len(self.ttRegistrosRemanejar)} item(ns) cobrado(s) mais de uma vez no arquivo (mesmo beneficiário, guia, serviço, tabela, data e valor).")
+            if self.log_detalhe_callback:
+                for registro in self.ttRegistrosRemanejar:
+                    self.log_detalhe_callback(f"        - Guia {registro['numero_guia']}, cd_Servico {registro['cd_servico']}, execução {registro['dt_execucao']}: {registro['quantidade']} cobranças.")
+        return 0
+
+    # Regra de config/regras_negocio.json -> (método do modo sequencial, função aplicada a cada nó)
+    _FUNCOES_REGRAS = {
+        regras_config.REGRA_CNES: ('_aplicar_regra_cnes', '_regra_cnes_no'),
+        regras_config.REGRA_TIPO_DOCUMENTO: ('_aplicar_regra_tipo_documento', '_regra_tipo_documento_no'),
+        regras_config.REGRA_DATA_CONHECIMENTO_PROTOCOLO: ('_aplicar_regra_data_conhecimento_protocolo', '_regra_data_conhecimento_protocolo_no'),
+        regras_config.REGRA_TIPO_PRESTADOR: ('_aplicar_regra_tipo_prestador', '_regra_tipo_prestador_no'),
+        regras_config.REGRA_RECURSO_PROPRIO: ('_aplicar_regra_recurso_proprio', '_regra_recurso_proprio_no'),
+        regras_config.REGRA_DIGITOS_PACOTE: ('_aplicar_regra_digitos_pacote', '_regra_digitos_pacote_no'),
+        regras_config.REGRA_HM_CO: ('_aplicar_modificacoes_regras_hm_co_xml', '_regra_hm_co_no'),
+    }
+    _REGRA_POR_METODO = {nome_regra: id_regra for id_regra, (nome_regra, _) in _FUNCOES_REGRAS.items()}
+
+    def _montar_despacho_regras(self, namespaces):
+        """
+        Tabela do motor de passagem única: tag (notação Clark) -> lista de
+        (tags aceitas para o pai ou None, nome da regra, função do nó), montada a partir dos
+        contextos de cada regra ativa em self.tabelas_regras, na ordem do modo sequencial.
+        """
+        despacho = {}
+        for id_regra in regras_config.REGRAS:
+            if id_regra not in self.tabelas_regras.regras_ativas: continue
+            if id_regra == regras_config.REGRA_HM_CO and not self.indice_cobertura.carregado: continue
+            nome_regra, nome_funcao_no = self._FUNCOES_REGRAS[id_regra]
+            funcao_no = getattr(self, nome_funcao_no)
+            for tag, pais_aceitos in self.tabelas_regras.contextos[id_regra]:
+                despacho.setdefault(tag, []).append((pais_aceitos, nome_regra, funcao_no))
+        return despacho
+
+    def _aplicar_regras_passagem_unica(self, raiz, namespaces):
+        """
+        Motor de regras de passagem única: percorre a árvore uma vez, coletando só os elementos
+        que interessam a alguma regra, e entrega cada um às regras registradas para a sua tag
+        (ver _montar_despacho_regras). As regras não criam nem removem elementos que outra
+        regra visita, e cada uma só lê os campos que ela mesma altera, então o resultado é o
+        mesmo da aplicação regra a regra. O detalhe por nó é acumulado por regra e emitido na
+        ordem do modo sequencial. Retorna {nome da regra: alterações}.
+        """
+        despacho = self._montar_despacho_regras(namespaces)
+        nomes_regras = [regra.__name__ for regra in self._regras_em_ordem()]
+        alteracoes_por_regra = dict.fromkeys(nomes_regras, 0)
+        detalhes_por_regra = {nome: [] for nome in nomes_regras} if self.log_detalhe_callback else None
+        quantidade_nos_cd_servico = 0
+        tag_cd_servico = ptu_xpath.TAG_CD_SERVICO
+
+        # Coleta antes de despachar: algumas regras removem ou criam nós durante a aplicação
+        elementos = [elemento for elemento in raiz.iter(*despacho) if elemento is not raiz]
+        for elemento in elementos:
+            pai = elemento.getparent()
+            tag_pai = pai.tag if pai is not None else None
+            for pais_aceitos, nome_regra, funcao_no in despacho[elemento.tag]:
+                if pais_aceitos is not None and tag_pai not in pais_aceitos: continue
+                if elemento.tag == tag_cd_servico: quantidade_nos_cd_servico += 1
+                if self._alteracoes_livro is not None: self._regra_em_execucao = nome_regra
+                registrar_detalhe = detalhes_por_regra[nome_regra].append if detalhes_por_regra is not None else None
+                alteracoes_por_regra[nome_regra] += funcao_no(elemento, namespaces, registrar_detalhe)
+
+        for nome_regra in nomes_regras:
+            if nome_regra == '_aplicar_modificacoes_regras_hm_co_xml':
+                self.log_callback("    - Iniciando aplicação de regras HM/CO (baseado em JSONs)...")
+                if not self.indice_cobertura.carregado:
+                    self.log_callback("    - AVISO: Dados de referência HM/SADT não carregados. Regras HM/CO não podem ser aplicadas.")
+                    continue
+            if detalhes_por_regra is not None:
+                for mensagem in detalhes_por_regra[nome_regra]: self.log_detalhe_callback(mensagem)
+            if nome_regra == '_aplicar_modificacoes_regras_hm_co_xml':
+                self._log_resumo_regras_hm_co(alteracoes_por_regra[nome_regra], quantidade_nos_cd_servico)
+            elif nome_regra == '_remanejar_itens_duplicados_xml':
+                self._regra_em_execucao = nome_regra
+                alteracoes_por_regra[nome_regra] += self._remanejar_itens_duplicados_xml(raiz, namespaces)
+        return alteracoes_por_regra
+
+    def _obter_regras_xslt(self):
+        codigos_cobertos = self.indice_cobertura.codigos_cobertos if self.indice_cobertura.carregado else None
+        chave = (self.tabelas_regras.chave, codigos_cobertos)
+        if self._regras_xslt_compiladas is None or chave != self._chave_regras_xslt:
+            self._regras_xslt_compiladas = regras_xslt.compilar_regras_xslt(self.tabelas_regras, codigos_cobertos)
+            self._chave_regras_xslt = chave
+        return self._regras_xslt_compiladas
+
+    def _aplicar_regras_xslt(self, raiz, namespaces):
+        """
+        Motor XSLT: aplica todas as regras de uma vez com a folha de estilo de core/regras_xslt.py.
+        Não há detalhe por nó; com o detalhe ligado sai uma linha por regra com a contagem.
+        Retorna (raiz do documento transformado, {nome da regra: alterações}).
+        """
+        raiz, contagens = regras_xslt.aplicar_regras_xslt(self._obter_regras_xslt(), raiz)
+        nomes_regras = [regra.__name__ for regra in self._regras_em_ordem()]
+        alteracoes_por_regra = dict.fromkeys(nomes_regras, 0)
+        for nome_regra in nomes_regras:
+            if nome_regra == '_aplicar_modificacoes_regras_hm_co_xml':
+                self.log_callback("    - Iniciando aplicação de regras HM/CO (baseado em JSONs)...")
+                if not self.indice_cobertura.carregado:
+                    self.log_callback("    - AVISO: Dados de referência HM/SADT não carregados. Regras HM/CO não podem ser aplicadas.")
+                    continue
+            if nome_regra == '_remanejar_itens_duplicados_xml':
+                alteracoes_por_regra[nome_regra] += self._remanejar_itens_duplicados_xml(raiz, namespaces)
+                continue
+            alteracoes_por_regra[nome_regra] = contagens.get(self._REGRA_POR_METODO[nome_regra], 0)
+            if self.log_detalhe_callback and alteracoes_por_regra[nome_regra]:
+                self.log_detalhe_callback(f"    - {nome_regra} (XSLT): {alteracoes_por_regra[nome_regra]} alteraçõe(s).")
+            if nome_regra == '_aplicar_modificacoes_regras_hm_co_xml':
+                self._log_resumo_regras_hm_co(alteracoes_por_regra[nome_regra], contagens.get(regras_xslt.CONTAGEM_NOS_CD_SERVICO, 0))
+        return raiz, alteracoes_por_regra
+
+    def _regras_em_ordem(self):
+        """Métodos do modo sequencial das regras ativas, na ordem de aplicação, e o remanejamento ao final."""
+        regras = [getattr(self, self._FUNCOES_REGRAS[id_regra][0]) for id_regra in regras_config.REGRAS
+                  if id_regra in self.tabelas_regras.regras_ativas]
+        return (*regras, self._remanejar_itens_duplicados_xml)
+
+    def _aplicar_regras_na_raiz(self, raiz):
+        """
+        Aplica todas as regras de negócio sobre uma árvore já carregada.
+        Retorna (total de alterações, raiz): os motores em Python alteram a própria árvore e
+        devolvem a mesma raiz; o motor XSLT devolve a raiz do documento transformado.
+        """
+        namespaces = ptu_xpath.NAMESPACES
+        motor = self.MOTOR_REGRAS
+        if motor == self.MOTOR_REGRAS_XSLT and not self.tabelas_regras.contextos_padrao:
+            # A folha de estilo tem os caminhos das regras fixos; só os valores vêm da definição
+            self.log_callback("    - AVISO: Contextos das regras alterados em regras_negocio.json não são suportados pelo motor XSLT. Usando a passagem única.")
+            motor = self.MOTOR_REGRAS_PASSAGEM_UNICA
+
+        if motor in (self.MOTOR_REGRAS_PASSAGEM_UNICA, self.MOTOR_REGRAS_XSLT):
+            inicio = time.perf_counter() if _RASTRO_REGRAS.ativo else 0.0
+            if motor == self.MOTOR_REGRAS_XSLT:
+                raiz, alteracoes_por_regra = self._aplicar_regras_xslt(raiz, namespaces)
+            else:
+                alteracoes_por_regra = self._aplicar_regras_passagem_unica(raiz, namespaces)
+            if _RASTRO_REGRAS.ativo:
+                for nome_regra, alteracoes in alteracoes_por_regra.items():
+                    _RASTRO_REGRAS.registrar("regra_aplicada", arquivo=xml_parser.nome_base_origem(raiz), regra=nome_regra,
+                                             alteracoes=alteracoes, motor=motor)
+                _RASTRO_REGRAS.registrar("regras_concluidas", arquivo=xml_parser.nome_base_origem(raiz), motor=motor,
+                                         duracao_s=round(time.perf_counter() - inicio, 6))
+            return sum(alteracoes_por_regra.values()), raiz
+
+        regras_aplicadas_total = 0
+        for regra in self._regras_em_ordem():
+            self._regra_em_execucao = regra.__name__
+            if not _RASTRO_REGRAS.ativo:
+                regras_aplicadas_total += regra(raiz, namespaces)
+                continue
+            inicio = time.perf_counter()
+            alteracoes = regra(raiz, namespaces)
+            _RASTRO_REGRAS.registrar("regra_aplicada", arquivo=xml_parser.nome_base_origem(raiz), regra=regra.__name__,
+                                     alteracoes=alteracoes, duracao_s=round(time.perf_counter() - inicio, 6))
+            regras_aplicadas_total += alteracoes
+        return regras_aplicadas_total, raiz
+
+    def _ler_xml_para_gravacao(self, caminho_arquivo_xml, nome_arquivo=None):
+        """
+        Lê o XML guardando os bytes originais, para que _gravar_xml possa aplicar só os trechos alterados.
+        'nome_arquivo' (padrão: o próprio caminho) é o nome registrado na árvore para as mensagens.
+        Retorna (bytes, raiz, registro de alterações ou None quando a gravação será completa).
+        """
+        with open(caminho_arquivo_xml, 'rb') as arquivo:
+            dados_xml = arquivo.read()
+        return (dados_xml, *self._carregar_xml_para_gravacao(dados_xml, nome_arquivo or caminho_arquivo_xml))
+
+    def _carregar_xml_para_gravacao(self, dados_xml, nome_arquivo):
+        """(raiz, registro de alterações ou None) de um XML já lido; ver _ler_xml_para_gravacao."""
+        raiz = xml_parser.carregar_arvore_xml(io.BytesIO(dados_xml), nome_arquivo=nome_arquivo).getroot()
+        registro = gravacao_incremental.RegistroAlteracoes() if self.GRAVACAO_XML == self.GRAVACAO_XML_INCREMENTAL else None
+        return raiz, registro
+
+    def _gravar_xml(self, caminho_arquivo_xml, dados_xml, raiz, registro):
+        """
+        Grava a árvore alterada em 'caminho_arquivo_xml': só os trechos registrados, sobre os bytes
+        originais, ou (sem registro, ou se os trechos não puderem ser aplicados) o documento inteiro.
+        """
+        if registro is not None:
+            try:
+                trechos = gravacao_incremental.gravar_alteracoes(dados_xml, raiz, registro, caminho_arquivo_xml)
+                if self.log_detalhe_callback: self.log_detalhe_callback(f"    - XML gravado de forma incremental: {trechos} trecho(s) alterado(s).")
+                return
+            except gravacao_incremental.GravacaoIncrementalIndisponivel as e:
+                self.log_callback(f"  AVISO: Gravação incremental indisponível para '{os.path.basename(caminho_arquivo_xml)}' ({e}); regravando o XML completo.")
+        raiz.getroottree().write(caminho_arquivo_xml, encoding='latin-1', xml_declaration=True, pretty_print=True)
+
+    def _escrever_xml(self, arquivo, nome_arquivo, dados_xml, raiz, registro):
+        """Como _gravar_xml, mas escreve num arquivo binário já aberto (ex: a entrada de um ZIP)."""
+        if registro is not None:
+            try:
+                edicoes = gravacao_incremental.montar_edicoes(dados_xml, raiz, registro)
+            except gravacao_incremental.GravacaoIncrementalIndisponivel as e:
+                self.log_callback(f"  AVISO: Gravação incremental indisponível para '{nome_arquivo}' ({e}); regravando o XML completo.")
+            else:
+                gravacao_incremental.escrever_edicoes(dados_xml, edicoes, arquivo)
+                if self.log_detalhe_callback: self.log_detalhe_callback(f"    - XML gravado de forma incremental: {len(edicoes)} trecho(s) alterado(s).")
+                return
+        raiz.getroottree().write(arquivo, encoding='latin-1', xml_declaration=True, pretty_print=True)
+
+    def _caminho_livro_alteracoes(self, pasta_raiz_correcao_xml):
+        """Banco do livro de alterações em 'Correção XML', ou None com o livro desligado."""
+        if not self.REGISTRAR_LIVRO_ALTERACOES: return None
+        return livro_alteracoes.caminho_livro(pasta_raiz_correcao_xml)
+
+    def _iniciar_livro_alteracoes(self, caminho_livro):
+        """Lista para os registros do livro do arquivo, ou None (sem livro, ou motor XSLT, que não altera nó a nó)."""
+        if caminho_livro is None: return None
+        if self.MOTOR_REGRAS == self.MOTOR_REGRAS_XSLT:
+            self.log_callback("    - AVISO: O motor XSLT não registra as alterações no livro de alterações.")
+            return None
+        return []
+
+    def _gravar_livro_alteracoes(self, caminho_livro, nome_arquivo, raiz, alteracoes):
+        """Grava no livro os registros das regras aplicadas a 'nome_arquivo', com o id da regra de regras_config."""
+        nome_arquivo = os.path.basename(nome_arquivo)
+        registros = [(self._REGRA_POR_METODO.get(nome_regra, nome_regra), *registro) for nome_regra, *registro in alteracoes]
+        try:
+            with livro_alteracoes.LivroAlteracoes(caminho_livro) as livro:
+                livro.acrescentar(nome_arquivo, livro_alteracoes.unimed_destino(raiz), registros)
+        except (sqlite3.Error, OSError) as e:
+            self.log_callback(f"  AVISO: Falha ao gravar o livro de alterações de '{nome_arquivo}'. Erro: {e}")
+            return
+        if self.log_detalhe_callback: self.log_detalhe_callback(f"    - Livro de alterações: {len(registros)} registro(s) de '{nome_arquivo}'.")
+
+    def gerar_resumo_livro_alteracoes(self, pasta_raiz_correcao_xml):
+        """
+        Resumo do livro de alterações de 'Correção XML' (alterações por regra e por Unimed, da última
+        gravação de cada arquivo) gravado em CSV na própria pasta. Retorna as linhas do resumo
+        ([] sem livro ou sem alterações).
+        """
+        caminho_livro = self._caminho_livro_alteracoes(pasta_raiz_correcao_xml)
+        if caminho_livro is None or not os.path.exists(caminho_livro): return []
+        try:
+            with livro_alteracoes.LivroAlteracoes(caminho_livro) as livro:
+                resumo = livro.resumo_por_regra_e_unimed()
+        except sqlite3.Error as e:
+            self.log_callback(f"AVISO: Falha ao ler o livro de alterações '{caminho_livro}'. Erro: {e}")
+            return []
+        if not resumo: return resumo
+        self.log_callback(f"Livro de alterações: {sum(linha[2] for linha in resumo)} alteração(ões) em {len(resumo)} combinação(ões) de regra e Unimed.")
+        if report_generator.gerar_csv_resumo_livro_alteracoes(resumo, pasta_raiz_correcao_xml):
+            self.log_callback(f"CSV de alterações por regra e Unimed gerado em: {pasta_raiz_correcao_xml}")
+        else: self.log_callback("ERRO ao gerar CSV de alterações por regra e Unimed.")
+        return resumo
+
+    def _aplicar_regras_no_xml_lido(self, raiz, registro, caminho_livro=None):
+        """
+        Aplica as regras a um XML lido por _ler_xml_para_gravacao, sem gravar nada.
+        Retorna (total de alterações, raiz, registro, registros do livro ou None); o registro
+        vira None com o motor XSLT, que devolve um documento novo.
+        """
+        # O motor XSLT devolve um documento novo: não há o que localizar nos bytes originais
+        if self.MOTOR_REGRAS == self.MOTOR_REGRAS_XSLT: registro = None
+        self._registro_alteracoes = registro
+        self._alteracoes_livro = alteracoes_livro = self._iniciar_livro_alteracoes(caminho_livro)
+        try:
+            regras_aplicadas_total, raiz = self._aplicar_regras_na_raiz(raiz)
+        finally:
+            self._registro_alteracoes = self._alteracoes_livro = None
+        return regras_aplicadas_total, raiz, registro, alteracoes_livro
+
+    def _aplicar_regras_em_memoria(self, caminho_arquivo_xml, dados_xml, raiz, registro, caminho_livro=None):
+        """
+        _aplicar_regras_de_negocio sem regravar o arquivo: as regras ficam na árvore lida de
+        'dados_xml', que segue para o hash e a gravação no ZIP. Retorna (sucesso, raiz, registro);
+        se as regras falham, a árvore é lida de novo dos bytes, sem nenhuma regra aplicada.
+        """
+        nome_arquivo = os.path.basename(caminho_arquivo_xml)
+        self.log_callback(f"  Aplicando regras de negócio ao arquivo: {nome_arquivo}...")
+        try:
+            regras_aplicadas_total, raiz, registro, alteracoes_livro = self._aplicar_regras_no_xml_lido(raiz, registro, caminho_livro)
+        except Exception as e:
+            self.log_callback(f"  ERRO CRÍTICO ao aplicar regras de negócio em '{nome_arquivo}'. Erro: {e}")
+            logging.exception(f"Falha em _aplicar_regras_em_memoria para {caminho_arquivo_xml}")
+            self._chaves_itens_ultima_raiz = None
+            return (False, *self._carregar_xml_para_gravacao(dados_xml, caminho_arquivo_xml))
 
-    def _aplicar_regras_de_negocio(self, caminho_arquivo_xml):
+        if regras_aplicadas_total > 0:
+            self.log_callback(f"  {regras_aplicadas_total} alteraçõe(s) de regras aplicadas; o XML será gravado junto com o hash.")
+        else:
+            self.log_callback("  Nenhuma regra de negócio estrutural precisou ser aplicada neste arquivo.")
+        if alteracoes_livro is not None: self._gravar_livro_alteracoes(caminho_livro, caminho_arquivo_xml, raiz, alteracoes_livro)
+        self._chaves_itens_ultima_raiz = None
+        return True, raiz, registro
+
+    def _aplicar_regras_de_negocio(self, caminho_arquivo_xml, caminho_livro=None):
+        """
+        Aplica as regras ao XML em disco e o regrava se houve alteração. Com 'caminho_livro', as
+        alterações são gravadas no livro de alterações (ver _caminho_livro_alteracoes).
+        """
         self.log_callback(f"  Aplicando regras de negócio ao arquivo: {os.path.basename(caminho_arquivo_xml)}...")
         try:
-            parser_xml = etree.XMLParser(recover=True, strip_cdata=False, resolve_entities=False)
-            arvore_xml = etree.parse(caminho_arquivo_xml, parser=parser_xml)
-            raiz = arvore_xml.getroot()
+            dados_xml, raiz, registro = self._ler_xml_para_gravacao(caminho_arquivo_xml)
             if raiz is None:
                 self.log_callback(f"  ERRO CRÍTICO: Raiz do XML não pôde ser lida em '{os.path.basename(caminho_arquivo_xml)}'.")
                 return False
 
-            namespaces = {'ptu': 'http://ptu.unimed.coop.br/schemas/V3_0'}
-            regras_aplicadas_total = 0
-
-            regras_aplicadas_total += self._aplicar_regra_cnes(raiz, namespaces)
-            regras_aplicadas_total += self._aplicar_regra_tipo_documento(raiz, namespaces)
-            regras_aplicadas_total += self._aplicar_regra_data_conhecimento_protocolo(raiz, namespaces)
-            regras_aplicadas_total += self._aplicar_regra_tipo_prestador(raiz, namespaces)
-            regras_aplicadas_total += self._aplicar_regra_recurso_proprio(raiz, namespaces)
-            regras_aplicadas_total += self._aplicar_regra_digitos_pacote(raiz, namespaces)
-            regras_aplicadas_total += self._aplicar_modificacoes_regras_hm_co_xml(raiz, namespaces)
-            regras_aplicadas_total += self._remanejar_itens_duplicados_xml(raiz, namespaces)
-
+            regras_aplicadas_total, raiz, registro, alteracoes_livro = self._aplicar_regras_no_xml_lido(raiz, registro, caminho_livro)
             if regras_aplicadas_total > 0:
-                arvore_xml.write(caminho_arquivo_xml, encoding='latin-1', xml_declaration=True, pretty_print=True)
+                self._gravar_xml(caminho_arquivo_xml, dados_xml, raiz, registro)
                 self.log_callback(f"  Arquivo XML modificado e salvo com {regras_aplicadas_total} alteraçõe(s) de regras aplicadas.")
             else:
                 self.log_callback("  Nenhuma regra de negócio estrutural precisou ser aplicada neste arquivo.")
+            if alteracoes_livro is not None: self._gravar_livro_alteracoes(caminho_livro, caminho_arquivo_xml, raiz, alteracoes_livro)
+            self._chaves_itens_ultima_raiz = None
             return True
         except etree.XMLSyntaxError as exsyn:
             self.log_callback(f"  ERRO DE SINTAXE XML em '{os.path.basename(caminho_arquivo_xml)}': {exsyn}")
@@ -460,10 +935,386 @@ class WorkflowController:
             logging.exception(f"Falha em _aplicar_regras_de_negocio para {caminho_arquivo_xml}")
             return False
 
-    def processar_importacao_faturas(self, caminho_da_pasta_selecionada):
+    def _tags_alteradas_pelas_regras(self):
+        """Nomes locais das tags que as regras ativas podem alterar (HM/CO só com as listas referenciais carregadas)."""
+        tags = set()
+        for id_regra in self.tabelas_regras.regras_ativas:
+            if id_regra == regras_config.REGRA_HM_CO and not self.indice_cobertura.carregado: continue
+            tags |= regras_config.TAGS_ALTERADAS_POR_REGRA[id_regra]
+        return tags
+
+    def _regras_alteram_dados_importados(self):
+        """Se alguma regra ativa escreve em tags lidas pela importação (cabeçalho ou guias de internação)."""
+        # O remanejamento de itens só aponta duplicidades, sem alterar tags
+        tags_lidas = ptu_xpath.TAGS_LIDAS_CABECALHO | ptu_xpath.TAGS_LIDAS_GUIAS_INTERNACAO
+        return not self._tags_alteradas_pelas_regras().isdisjoint(tags_lidas)
+
+    def _aplicar_regras_na_importacao(self):
+        if self.REGRAS_IMPORTACAO == self.REGRAS_IMPORTACAO_SE_NECESSARIO:
+            return self._regras_alteram_dados_importados()
+        return True
+
+    def _chave_regras_aplicadas(self):
+        """
+        Identifica a definição das regras e as listas referenciais em uso: um XML corrigido guardado
+        na importação só é reaproveitado na correção se a chave for a mesma.
+        """
+        dados = (self.tabelas_regras, self.indice_cobertura)
+        chave_dados, chave = self._chave_regras_aplicadas_cache
+        if chave_dados is None or any(a is not b for a, b in zip(chave_dados, dados)):
+            chave = cache_importacao.calcular_versao_dados(self.tabelas_regras.definicao, self.indice_cobertura.versao)[:16]
+            self._chave_regras_aplicadas_cache = (dados, chave)
+        return chave
+
+    def _guardar_xml_corrigido_em_memoria(self, dados_xml, raiz, registro, regras_aplicadas_total, sha256_original,
+                                          pasta_xmls_corrigidos, nome_arquivo):
+        if regras_aplicadas_total == 0:
+            file_manager.guardar_xml_corrigido(pasta_xmls_corrigidos, sha256_original, self._chave_regras_aplicadas())
+            return
+        os.makedirs(pasta_xmls_corrigidos, exist_ok=True)
+        caminho_temporario = os.path.join(pasta_xmls_corrigidos, f"{sha256_original}.{os.getpid()}.tmp")
+        try:
+            self._gravar_xml(caminho_temporario, dados_xml, raiz, registro)
+            if file_manager.guardar_xml_corrigido(pasta_xmls_corrigidos, sha256_original, self._chave_regras_aplicadas(),
+                                                  caminho_temporario):
+                self.log_callback(f"  XML corrigido de '{nome_arquivo}' guardado para a etapa de correção.")
+        finally:
+            file_manager.remover_arquivo_se_existe(caminho_temporario)
+
+    def _carregar_e_aplicar_regras_em_memoria(self, origem_xml, nome_arquivo, pasta_xmls_corrigidos=None):
+        """
+        Modo de parse único: carrega o XML uma vez (de um caminho ou de um stream aberto
+        dentro do ZIP) e aplica as regras sobre a árvore em memória, se a importação depender
+        delas (ver REGRAS_IMPORTACAO).
+        Retorna a raiz (com as regras aplicadas) para leitura de cabeçalho e guias, ou None se o
+        XML não puder ser lido. Nada é gravado em disco, exceto com 'pasta_xmls_corrigidos': o
+        XML corrigido (ou um marcador, se as regras não alteraram nada) fica guardado ali com o
+        hash do conteúdo original, para executar_substituicao_hash não aplicar as regras de novo.
+        """
+        aplicar_regras = pasta_xmls_corrigidos is not None or self._aplicar_regras_na_importacao()
+        if aplicar_regras:
+            self.log_callback(f"  Aplicando regras de negócio em memória ao arquivo: {nome_arquivo}...")
+        else:
+            self.log_callback(f"  Regras de negócio não alteram os dados importados de '{nome_arquivo}'; aplicação deixada para a etapa de correção.")
+        dados_xml = registro = sha256_original = None
+        try:
+            if pasta_xmls_corrigidos is not None:
+                if hasattr(origem_xml, 'read'): dados_xml = origem_xml.read()
+                else:
+                    with open(origem_xml, 'rb') as arquivo: dados_xml = arquivo.read()
+                origem_xml = io.BytesIO(dados_xml)
+                sha256_original = hashlib.sha256(dados_xml).hexdigest()
+                if self.GRAVACAO_XML == self.GRAVACAO_XML_INCREMENTAL and self.MOTOR_REGRAS != self.MOTOR_REGRAS_XSLT:
+                    registro = gravacao_incremental.RegistroAlteracoes()
+            raiz = xml_parser.carregar_arvore_xml(origem_xml, nome_arquivo=nome_arquivo).getroot()
+        except etree.XMLSyntaxError as exsyn:
+            self.log_callback(f"  ERRO DE SINTAXE XML em '{nome_arquivo}': {exsyn}")
+            logging.exception(f"XMLSyntaxError em _carregar_e_aplicar_regras_em_memoria para {nome_arquivo}")
+            return None
+        if raiz is None:
+            self.log_callback(f"  ERRO CRÍTICO: Raiz do XML não pôde ser lida em '{nome_arquivo}'.")
+            return None
+        if not aplicar_regras: return raiz
+        # O livro só registra o que vai para o XML corrigido: sem guardá-lo, a correção aplica as regras de novo
+        caminho_livro = self._caminho_livro_alteracoes(os.path.dirname(pasta_xmls_corrigidos)) if pasta_xmls_corrigidos is not None else None
+        try:
+            self._registro_alteracoes = registro
+            self._alteracoes_livro = alteracoes_livro = self._iniciar_livro_alteracoes(caminho_livro)
+            try:
+                regras_aplicadas_total, raiz = self._aplicar_regras_na_raiz(raiz)
+            finally:
+                self._registro_alteracoes = self._alteracoes_livro = None
+            self.log_callback(f"  {regras_aplicadas_total} alteraçõe(s) de regras aplicadas em memória.")
+            if pasta_xmls_corrigidos is not None:
+                self._guardar_xml_corrigido_em_memoria(dados_xml, raiz, registro, regras_aplicadas_total, sha256_original,
+                                                       pasta_xmls_corrigidos, nome_arquivo)
+            if alteracoes_livro is not None: self._gravar_livro_alteracoes(caminho_livro, nome_arquivo, raiz, alteracoes_livro)
+        except Exception as e:
+            self.log_callback(f"  AVISO: Problemas ao aplicar regras em '{nome_arquivo}'. Erro: {e}")
+            logging.exception(f"Falha em _carregar_e_aplicar_regras_em_memoria para {nome_arquivo}")
+        return raiz
+
+    def _completar_dados_fatura(self, dados_fatura_xml, caminho_zip_fatura):
+        """Acrescenta ao dicionário do cabeçalho os dados do ZIP e o nome da Unimed destino."""
+        dados_fatura_xml['caminho_zip_original'] = caminho_zip_fatura
+        dados_fatura_xml['nome_zip'] = os.path.basename(caminho_zip_fatura)
+        codigo_unimed_original_xml = dados_fatura_xml.get('codigo_unimed_destino')
+        codigo_unimed_para_busca = codigo_unimed_original_xml
+        if codigo_unimed_original_xml:
+            try: codigo_unimed_para_busca = f"{int(str(codigo_unimed_original_xml).strip()):03d}"
+            except (ValueError, TypeError): self.log_callback(f"  AVISO: Código Unimed '{codigo_unimed_original_xml}' inválido.")
+            nome_unimed = data_manager.obter_nome_unimed(codigo_unimed_para_busca)
+            dados_fatura_xml['codigo_unimed_destino'] = codigo_unimed_para_busca
+            dados_fatura_xml['nome_unimed_destino'] = nome_unimed
+            self.log_callback(f"  Unimed Destino: {codigo_unimed_para_busca} - {nome_unimed}")
+        else:
+            dados_fatura_xml['nome_unimed_destino'] = "NÃO ENCONTRADO NO XML"
+            dados_fatura_xml['codigo_unimed_destino'] = ""
+            self.log_callback(f"  AVISO: Código da Unimed Destino não encontrado.")
+
+    def _anexar_guias_internacao(self, dados_fatura_xml, origem_xml, nome_xml, streaming=False):
+        """Busca as guias de internação relevantes (na árvore ou em streaming) e as anexa à fatura."""
+        numero_fatura_atual = dados_fatura_xml.get('numero_fatura')
+        if numero_fatura_atual and origem_xml is not None:
+            self.log_callback(f"  Buscando guias de internação em '{nome_xml}'...")
+            if streaming:
+                guias_relevantes = xml_parser.extrair_guias_internacao_streaming(
+                    origem_xml, numero_fatura_atual,
+                    self.codigos_hm_t00_a_ignorar, valor_minimo_guia=self.VALOR_MINIMO_GUIA, nome_arquivo=nome_xml
+                )
+            else:
+                guias_relevantes = xml_parser.extrair_guias_internacao_relevantes(
+                    origem_xml, numero_fatura_atual,
+                    self.codigos_hm_t00_a_ignorar, valor_minimo_guia=self.VALOR_MINIMO_GUIA
+                )
+            if guias_relevantes: self.log_callback(f"  {len(guias_relevantes)} guia(s) de internação relevante(s) encontrada(s).")
+            dados_fatura_xml['guias_internacao_relevantes'] = guias_relevantes if guias_relevantes else []
+        else:
+            self.log_callback(f"  AVISO: Não foi possível buscar guias."); dados_fatura_xml['guias_internacao_relevantes'] = []
+
+    def _log_dados_processados(self, dados_fatura_xml):
+        self.log_callback(f"  Dados processados: Fatura {dados_fatura_xml.get('numero_fatura', 'N/A')}, Valor: {dados_fatura_xml.get('valor_total_documento', 'N/A')}")
+
+    def _montar_dados_fatura(self, origem_xml, nome_xml, caminho_zip_fatura):
+        """
+        Lê cabeçalho e guias de internação de 'origem_xml' (caminho ou raiz já carregada)
+        e completa com os dados do ZIP e da Unimed destino. Retorna o dicionário da fatura
+        ou None se o cabeçalho não puder ser lido.
+        """
+        self.log_callback(f"  Lendo dados do cabeçalho do XML '{nome_xml}' (após regras)...")
+        dados_fatura_xml = xml_parser.extrair_dados_fatura_xml(origem_xml)
+        if not dados_fatura_xml or not any(dados_fatura_xml.values()):
+            self.log_callback(f"  ERRO: Não foi possível ler dados do XML '{os.path.basename(caminho_zip_fatura)}'. Pulando.")
+            return None
+        self._completar_dados_fatura(dados_fatura_xml, caminho_zip_fatura)
+        self._anexar_guias_internacao(dados_fatura_xml, origem_xml, nome_xml)
+        # Chaves dos itens para cruzar as faturas do lote (_verificar_itens_duplicados_entre_faturas), só com a árvore já em memória
+        if xml_parser.is_arvore_ja_carregada(origem_xml):
+            raiz = xml_parser.obter_raiz(origem_xml)
+            raiz_indexada, chaves = self._chaves_itens_ultima_raiz or (None, None)
+            dados_fatura_xml['itens_cobrados'] = chaves if raiz_indexada is raiz else itens_duplicados.chaves_itens_cobrados(raiz)
+        self._chaves_itens_ultima_raiz = None
+        self._log_dados_processados(dados_fatura_xml)
+        return dados_fatura_xml
+
+    def _importar_fatura_do_zip_em_memoria(self, caminho_zip_fatura, pasta_xmls_corrigidos=None):
+        """
+        Lê o .051 diretamente do ZIP (stream, sem arquivo temporário), faz um único parse
+        e devolve o dicionário da fatura, ou None em caso de falha.
+        """
+        nome_arquivo_zip = os.path.basename(caminho_zip_fatura)
+        self.log_callback(f"  Lendo XML de '{nome_arquivo_zip}' diretamente do ZIP...")
+        with file_manager.abrir_xml_fatura_do_zip(caminho_zip_fatura) as (nome_xml, stream_xml):
+            if stream_xml is None:
+                self.log_callback(f"  ERRO: Não foi possível ler XML de '{nome_arquivo_zip}'. Pulando.")
+                return None
+            raiz = self._carregar_e_aplicar_regras_em_memoria(stream_xml, nome_xml, pasta_xmls_corrigidos)
+        if raiz is None:
+            self.log_callback(f"  ERRO: Não foi possível ler o XML '{nome_xml}'. Pulando.")
+            return None
+        return self._montar_dados_fatura(raiz, nome_xml, caminho_zip_fatura)
+
+    def _importar_fatura_em_streaming(self, caminho_zip_fatura, buscar_guias=True):
+        """
+        Lê o .051 direto do ZIP com iterparse, sem montar a árvore e sem aplicar regras:
+        o cabeçalho é lido até o fim de <ptu:cabecalho> e, se 'buscar_guias', o membro é
+        relido em streaming para as guias de internação (memória constante).
+        """
+        nome_arquivo_zip = os.path.basename(caminho_zip_fatura)
+        with file_manager.abrir_xml_fatura_do_zip(caminho_zip_fatura) as (nome_xml, stream_xml):
+            if stream_xml is None:
+                self.log_callback(f"  ERRO: Não foi possível ler XML de '{nome_arquivo_zip}'. Pulando.")
+                return None
+            self.log_callback(f"  Lendo dados do cabeçalho do XML '{nome_xml}' (streaming)...")
+            dados_fatura_xml = xml_parser.extrair_dados_cabecalho_streaming(stream_xml, nome_arquivo=nome_xml)
+            if not dados_fatura_xml or not any(dados_fatura_xml.values()):
+                self.log_callback(f"  ERRO: Não foi possível ler dados do XML '{nome_arquivo_zip}'. Pulando.")
+                return None
+            self._completar_dados_fatura(dados_fatura_xml, caminho_zip_fatura)
+            if buscar_guias:
+                stream_xml.seek(0)
+                self._anexar_guias_internacao(dados_fatura_xml, stream_xml, nome_xml, streaming=True)
+            else:
+                self.log_callback(f"  Importação somente de cabeçalho: guias de internação não buscadas.")
+                dados_fatura_xml['guias_internacao_relevantes'] = []
+        self._log_dados_processados(dados_fatura_xml)
+        return dados_fatura_xml
+
+    def _importar_fatura_via_arquivo_temporario(self, caminho_zip_fatura, pasta_temp_extracao_import, pasta_xmls_corrigidos=None):
+        """
+        Fluxo antigo: extrai o .051 para disco, grava as regras no arquivo e o relê a cada etapa.
+        Com 'pasta_xmls_corrigidos', o arquivo corrigido é movido para lá em vez de removido.
+        """
+        nome_arquivo_zip = os.path.basename(caminho_zip_fatura)
+        self.log_callback(f"  Extraindo XML de '{nome_arquivo_zip}'...")
+        caminho_xml_extraido = file_manager.extrair_xml_fatura_do_zip(caminho_zip_fatura, pasta_temp_extracao_import)
+        if not caminho_xml_extraido: self.log_callback(f"  ERRO: Não foi possível extrair XML de '{nome_arquivo_zip}'. Pulando."); return None
+        nome_xml_extraido = os.path.basename(caminho_xml_extraido)
+        self.log_callback(f"  XML '{nome_xml_extraido}' extraído para '{pasta_temp_extracao_import}'.")
+        sha256_original = file_manager.hash_conteudo_arquivo(caminho_xml_extraido) if pasta_xmls_corrigidos is not None else None
+        regras_aplicadas = False
+        if pasta_xmls_corrigidos is not None or self._aplicar_regras_na_importacao():
+            caminho_livro = self._caminho_livro_alteracoes(os.path.dirname(pasta_xmls_corrigidos)) if pasta_xmls_corrigidos is not None else None
+            regras_aplicadas = self._aplicar_regras_de_negocio(caminho_xml_extraido, caminho_livro)
+            if not regras_aplicadas: self.log_callback(f"  AVISO: Problemas ao aplicar regras em '{nome_xml_extraido}'.")
+        else:
+            self.log_callback(f"  Regras de negócio não alteram os dados importados de '{nome_xml_extraido}'; aplicação deixada para a etapa de correção.")
+        dados_fatura_xml = self._montar_dados_fatura(caminho_xml_extraido, nome_xml_extraido, caminho_zip_fatura)
+        if sha256_original and regras_aplicadas:
+            alterado = file_manager.hash_conteudo_arquivo(caminho_xml_extraido) != sha256_original
+            if file_manager.guardar_xml_corrigido(pasta_xmls_corrigidos, sha256_original, self._chave_regras_aplicadas(),
+                                                  caminho_xml_extraido if alterado else None) and alterado:
+                self.log_callback(f"  XML corrigido de '{nome_xml_extraido}' guardado para a etapa de correção.")
+        file_manager.remover_arquivo_se_existe(caminho_xml_extraido)
+        self.log_callback(f"  Arquivo XML temporário '{nome_xml_extraido}' removido.")
+        return dados_fatura_xml
+
+    def _fazer_backup_fatura(self, caminho_zip_fatura, pasta_backup):
+        if self.MODO_BACKUP == self.MODO_BACKUP_DEDUPLICADO:
+            pasta_objetos = self.PASTA_OBJETOS_BACKUP or file_manager.pasta_objetos_backup_compartilhada(pasta_backup)
+            return file_manager.fazer_backup_fatura_deduplicado(caminho_zip_fatura, pasta_backup, pasta_objetos)
+        return file_manager.fazer_backup_fatura(caminho_zip_fatura, pasta_backup)
+
+    def _importar_fatura(self, caminho_zip_fatura, pasta_backup, modo_leitura=MODO_LEITURA_ARVORE,
+                         pasta_temp_extracao_import=None, pasta_xmls_corrigidos=None):
+        """
+        Backup + leitura de uma única fatura. Usado tanto no loop sequencial quanto nos workers.
+        'pasta_xmls_corrigidos' (REGRAS_IMPORTACAO_GUARDAR) só vale para os modos que aplicam regras.
+        """
+        nome_arquivo_zip = os.path.basename(caminho_zip_fatura)
+        if self._fazer_backup_fatura(caminho_zip_fatura, pasta_backup): self.log_callback(f"  Backup de '{nome_arquivo_zip}' criado/verificado.")
+        else: self.log_callback(f"  AVISO: Falha ao criar backup para '{nome_arquivo_zip}'.")
+        if modo_leitura == self.MODO_LEITURA_STREAMING:
+            return self._importar_fatura_em_streaming(caminho_zip_fatura)
+        if modo_leitura == self.MODO_LEITURA_CABECALHO:
+            return self._importar_fatura_em_streaming(caminho_zip_fatura, buscar_guias=False)
+        if modo_leitura == self.MODO_LEITURA_ARQUIVO_TEMPORARIO:
+            return self._importar_fatura_via_arquivo_temporario(caminho_zip_fatura, pasta_temp_extracao_import, pasta_xmls_corrigidos)
+        return self._importar_fatura_do_zip_em_memoria(caminho_zip_fatura, pasta_xmls_corrigidos)
+
+    def _versao_dados_importacao(self):
+        """
+        Versão dos dados de referência que influenciam o dicionário da fatura; com o modo de leitura,
+        forma a chave do cache de importação.
+        """
+        return cache_importacao.calcular_versao_dados(
+            self.VALOR_MINIMO_GUIA, self.codigos_hm_t00_a_ignorar, data_manager.mapa_unimeds,
+            self.tabelas_regras.definicao, self.indice_cobertura.versao, self.dados_instrucoes_gerais)
+
+    def _abrir_cache_importacao(self, modo_leitura):
+        try:
+            cache = cache_importacao.CacheImportacao(self.pasta_faturas_importadas_atual, self._versao_dados_importacao(), modo_leitura)
+        except (sqlite3.Error, OSError) as e:
+            self.log_callback(f"AVISO: Cache de importação indisponível, todas as faturas serão lidas. Erro: {e}")
+            return None
+        removidas = cache.remover_versoes_antigas()
+        if removidas: self.log_callback(f"Cache de importação: {removidas} entrada(s) de dados de referência antigos descartada(s).")
+        return cache
+
+    def _buscar_faturas_no_cache(self, cache, arquivos_zip, pasta_backup):
+        """Retorna {caminho_zip: dados} das faturas cujo ZIP não mudou desde a última importação."""
+        faturas_do_cache = {}
+        for caminho_zip_fatura in arquivos_zip:
+            try:
+                dados_fatura_xml = cache.obter(caminho_zip_fatura)
+            except (sqlite3.Error, OSError) as e:
+                self.log_callback(f"  AVISO: Falha ao consultar o cache para '{os.path.basename(caminho_zip_fatura)}'. Erro: {e}")
+                continue
+            if not dados_fatura_xml: continue
+            if not self._fazer_backup_fatura(caminho_zip_fatura, pasta_backup):
+                self.log_callback(f"  AVISO: Falha ao criar backup para '{os.path.basename(caminho_zip_fatura)}'.")
+            faturas_do_cache[caminho_zip_fatura] = dados_fatura_xml
+        return faturas_do_cache
+
+    def _gravar_faturas_no_cache(self, cache, resultados):
+        for caminho_zip_fatura, dados_fatura_xml in resultados:
+            if not dados_fatura_xml: continue
+            try:
+                cache.gravar(caminho_zip_fatura, dados_fatura_xml)
+            except (sqlite3.Error, OSError) as e:
+                self.log_callback(f"  AVISO: Falha ao gravar '{os.path.basename(caminho_zip_fatura)}' no cache de importação. Erro: {e}")
+
+    def _configuracao_workers(self):
+        """
+        (atributos de configuração, definição das regras, índice de cobertura) deste controller, para o
+        initializer dos pools: os workers aplicam as mesmas regras, com os mesmos modos, que uma
+        execução serial (ver _criar_controller_worker).
+        """
+        atributos = {atributo: getattr(self, atributo) for atributo in self._ATRIBUTOS_CONFIGURACAO_WORKERS}
+        return atributos, self.tabelas_regras.definicao, self.indice_cobertura
+
+    def _importar_faturas_em_paralelo(self, arquivos_zip, pasta_backup, num_workers, modo_leitura, tamanhos_zip,
+                                      progresso_base=(0, None, 0, None), pasta_xmls_corrigidos=None):
+        """
+        Distribui as faturas entre 'num_workers' processos. Cada worker carrega os dados de
+        referência uma única vez (no initializer) e devolve o dicionário da fatura junto com
+        as mensagens de log geradas. O resultado segue a ordem de 'arquivos_zip',
+        independentemente da ordem de conclusão. Se o cancelamento for solicitado, as faturas
+        ainda não iniciadas são descartadas e ficam fora do resultado.
+        'progresso_base' = (concluídas, total, bytes processados, bytes total) já contabilizados
+        antes (ex: faturas vindas do cache); None nos totais usa os desta chamada.
+        """
+        concluidas_base, total_faturas, bytes_processados, bytes_total = progresso_base
+        if total_faturas is None: total_faturas = len(arquivos_zip)
+        if bytes_total is None: bytes_total = sum(tamanhos_zip)
+        resultados = [None] * len(arquivos_zip)
+        processadas = [False] * len(arquivos_zip)
+        self.log_callback(f"Importação paralela com {num_workers} processo(s).")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers,
+                                                    initializer=_inicializar_worker_importacao,
+                                                    initargs=(self._configuracao_workers(), self.log_detalhe_callback is not None)) as executor:
+            futuros = {executor.submit(_importar_fatura_em_worker, caminho_zip, pasta_backup, modo_leitura, pasta_xmls_corrigidos): indice
+                       for indice, caminho_zip in enumerate(arquivos_zip)}
+            concluidas = concluidas_base
+            for futuro in concurrent.futures.as_completed(futuros):
+                if futuro.cancelled(): continue
+                indice = futuros[futuro]
+                nome_arquivo_zip = os.path.basename(arquivos_zip[indice])
+                concluidas += 1; processadas[indice] = True
+                bytes_processados += tamanhos_zip[indice]
+                try:
+                    dados_fatura_xml, mensagens = futuro.result()
+                except Exception as e:
+                    dados_fatura_xml, mensagens = None, [(f"  ERRO: Falha no processo de importação de '{nome_arquivo_zip}': {e}", False)]
+                    logging.exception(f"Worker de importação falhou para {nome_arquivo_zip}")
+                self.log_callback(f"--- Fatura {concluidas}/{total_faturas} concluída: {nome_arquivo_zip} ---")
+                for mensagem, detalhe in mensagens:
+                    if not detalhe: self.log_callback(mensagem)
+                    elif self.log_detalhe_callback: self.log_detalhe_callback(mensagem)
+                resultados[indice] = dados_fatura_xml
+                self._reportar_progresso(nome_arquivo_zip, concluidas, total_faturas, bytes_processados, bytes_total)
+                if self._cancelamento_solicitado:
+                    for futuro_pendente in futuros: futuro_pendente.cancel()
+        return [(caminho_zip, dados) for caminho_zip, dados, processada in zip(arquivos_zip, resultados, processadas) if processada]
+
+    def processar_importacao_faturas(self, caminho_da_pasta_selecionada, modo_leitura=MODO_LEITURA_ARVORE, num_workers=1,
+                                     usar_cache=True):
+        """
+        Importa todas as faturas ZIP da pasta selecionada. 'modo_leitura' define como o .051 é lido:
+          - MODO_LEITURA_ARVORE (padrão): lido direto do ZIP, sem arquivo temporário, e parseado
+            uma única vez; regras, cabeçalho e guias de internação usam a mesma árvore.
+          - MODO_LEITURA_STREAMING: cabeçalho e guias lidos com iterparse direto do ZIP, sem
+            aplicar regras e com memória constante (faturas hospitalares muito grandes).
+          - MODO_LEITURA_CABECALHO: apenas o cabeçalho em streaming (suficiente para distribuição
+            e relatório Excel), sem regras e sem guias de internação para o CSV.
+          - MODO_LEITURA_ARQUIVO_TEMPORARIO: fluxo antigo (extração para '.TempExtracaoXMLImport',
+            regras gravadas no arquivo e releitura a cada etapa).
+        Nos modos que aplicam regras, REGRAS_IMPORTACAO define se elas são sempre aplicadas,
+        só quando alteram o que a importação lê, ou aplicadas com o XML corrigido guardado em
+        'Correção XML/.xmls_corrigidos' para executar_substituicao_hash. Faturas vindas do
+        cache de importação não passam pelas regras: na correção, elas são aplicadas normalmente.
+        'num_workers' > 1 distribui as faturas entre processos (exceto no fluxo de arquivo
+        temporário); None ou 0 usa todos os núcleos. O status de cada fatura fica em
+        'status_ultima_importacao'.
+        Com 'usar_cache', o dicionário de cada fatura é guardado em um SQLite na própria pasta
+        (ver core/cache_importacao.py): ao reimportar, ZIPs com o mesmo conteúdo e os mesmos
+        dados de referência são carregados do cache e só os novos ou alterados são lidos.
+        """
+        self._cancelamento_solicitado = False
         self.pasta_faturas_importadas_atual = caminho_da_pasta_selecionada
         self.log_callback(f"Iniciando importação da pasta: {self.pasta_faturas_importadas_atual}")
         self.lista_faturas_processadas = []
+        self.status_ultima_importacao = []
         self.log_callback("Listando arquivos ZIP...")
         arquivos_zip = file_manager.listar_arquivos_zip(self.pasta_faturas_importadas_atual)
         if not arquivos_zip: self.log_callback(f"Nenhum arquivo .zip encontrado."); return
@@ -474,63 +1325,88 @@ class WorkflowController:
         pasta_raiz_correcao = file_manager.criar_pasta_raiz_correcao_xml(self.pasta_faturas_importadas_atual)
         if not pasta_raiz_correcao: self.log_callback("ERRO CRÍTICO: Não foi possível criar pasta 'Correção XML'."); return
         self.log_callback(f"Pasta raiz para correção de XMLs pronta em: {pasta_raiz_correcao}")
-        pasta_temp_extracao_import = os.path.join(self.pasta_faturas_importadas_atual, ".TempExtracaoXMLImport")
-        os.makedirs(pasta_temp_extracao_import, exist_ok=True)
-        self.log_callback(f"Pasta de extração temporária criada/pronta em: {pasta_temp_extracao_import}")
+        pasta_temp_extracao_import = None
+        if modo_leitura == self.MODO_LEITURA_ARQUIVO_TEMPORARIO:
+            pasta_temp_extracao_import = os.path.join(self.pasta_faturas_importadas_atual, ".TempExtracaoXMLImport")
+            os.makedirs(pasta_temp_extracao_import, exist_ok=True)
+            self.log_callback(f"Pasta de extração temporária criada/pronta em: {pasta_temp_extracao_import}")
+        pasta_xmls_corrigidos = None
+        if self.REGRAS_IMPORTACAO == self.REGRAS_IMPORTACAO_GUARDAR and modo_leitura in (self.MODO_LEITURA_ARVORE, self.MODO_LEITURA_ARQUIVO_TEMPORARIO):
+            pasta_xmls_corrigidos = file_manager.pasta_xmls_corrigidos(pasta_raiz_correcao)
+            self.log_callback(f"XMLs corrigidos pelas regras serão guardados em: {pasta_xmls_corrigidos}")
         total_faturas = len(arquivos_zip); faturas_com_sucesso = 0
-        for i, caminho_zip_fatura in enumerate(arquivos_zip):
-            nome_arquivo_zip = os.path.basename(caminho_zip_fatura)
-            self.log_callback(f"--- Processando fatura {i+1}/{total_faturas}: {nome_arquivo_zip} ---")
-            if file_manager.fazer_backup_fatura(caminho_zip_fatura, pasta_backup): self.log_callback(f"  Backup de '{nome_arquivo_zip}' criado/verificado.")
-            else: self.log_callback(f"  AVISO: Falha ao criar backup para '{nome_arquivo_zip}'.")
-            self.log_callback(f"  Extraindo XML de '{nome_arquivo_zip}'...")
-            caminho_xml_extraido = file_manager.extrair_xml_fatura_do_zip(caminho_zip_fatura, pasta_temp_extracao_import)
-            if not caminho_xml_extraido: self.log_callback(f"  ERRO: Não foi possível extrair XML de '{nome_arquivo_zip}'. Pulando."); continue
-            nome_xml_extraido = os.path.basename(caminho_xml_extraido)
-            self.log_callback(f"  XML '{nome_xml_extraido}' extraído para '{pasta_temp_extracao_import}'.")
-            if not self._aplicar_regras_de_negocio(caminho_xml_extraido):
-                self.log_callback(f"  AVISO: Problemas ao aplicar regras em '{nome_xml_extraido}'.")
-            self.log_callback(f"  Lendo dados do cabeçalho do XML '{nome_xml_extraido}' (após regras)...")
-            dados_fatura_xml = xml_parser.extrair_dados_fatura_xml(caminho_xml_extraido)
-            if not dados_fatura_xml or not any(dados_fatura_xml.values()):
-                self.log_callback(f"  ERRO: Não foi possível ler dados do XML '{nome_arquivo_zip}'. Pulando.")
-                file_manager.remover_arquivo_se_existe(caminho_xml_extraido); continue
-            dados_fatura_xml['caminho_zip_original'] = caminho_zip_fatura
-            dados_fatura_xml['nome_zip'] = nome_arquivo_zip
-            codigo_unimed_original_xml = dados_fatura_xml.get('codigo_unimed_destino')
-            codigo_unimed_para_busca = codigo_unimed_original_xml
-            if codigo_unimed_original_xml:
-                try: codigo_unimed_para_busca = f"{int(str(codigo_unimed_original_xml).strip()):03d}"
-                except (ValueError, TypeError): self.log_callback(f"  AVISO: Código Unimed '{codigo_unimed_original_xml}' inválido.")
-                nome_unimed = data_manager.obter_nome_unimed(codigo_unimed_para_busca)
-                dados_fatura_xml['codigo_unimed_destino'] = codigo_unimed_para_busca
-                dados_fatura_xml['nome_unimed_destino'] = nome_unimed
-                self.log_callback(f"  Unimed Destino: {codigo_unimed_para_busca} - {nome_unimed}")
-            else:
-                dados_fatura_xml['nome_unimed_destino'] = "NÃO ENCONTRADO NO XML"
-                dados_fatura_xml['codigo_unimed_destino'] = ""
-                self.log_callback(f"  AVISO: Código da Unimed Destino não encontrado.")
-            numero_fatura_atual = dados_fatura_xml.get('numero_fatura')
-            if numero_fatura_atual and caminho_xml_extraido:
-                self.log_callback(f"  Buscando guias de internação em '{nome_xml_extraido}'...")
-                guias_relevantes = xml_parser.extrair_guias_internacao_relevantes(
-                    caminho_xml_extraido, numero_fatura_atual,
-                    self.codigos_hm_t00_a_ignorar, valor_minimo_guia=self.VALOR_MINIMO_GUIA
-                )
-                if guias_relevantes: self.log_callback(f"  {len(guias_relevantes)} guia(s) de internação relevante(s) encontrada(s).")
-                dados_fatura_xml['guias_internacao_relevantes'] = guias_relevantes if guias_relevantes else []
-            else:
-                self.log_callback(f"  AVISO: Não foi possível buscar guias."); dados_fatura_xml['guias_internacao_relevantes'] = []
-            self.log_callback(f"  Dados processados: Fatura {dados_fatura_xml.get('numero_fatura', 'N/A')}, Valor: {dados_fatura_xml.get('valor_total_documento', 'N/A')}")
+        tamanhos_zip = [os.path.getsize(caminho_zip) if os.path.isfile(caminho_zip) else 0 for caminho_zip in arquivos_zip]
+        bytes_total = sum(tamanhos_zip)
+        self._reportar_progresso("", 0, total_faturas, 0, bytes_total)
+
+        cache = self._abrir_cache_importacao(modo_leitura) if usar_cache else None
+        faturas_do_cache = self._buscar_faturas_no_cache(cache, arquivos_zip, pasta_backup) if cache else {}
+        if faturas_do_cache:
+            self.log_callback(f"{len(faturas_do_cache)} fatura(s) inalterada(s) carregada(s) do cache de importação.")
+        indices_a_ler = [i for i, caminho_zip in enumerate(arquivos_zip) if caminho_zip not in faturas_do_cache]
+        concluidas = total_faturas - len(indices_a_ler)
+        bytes_processados = bytes_total - sum(tamanhos_zip[i] for i in indices_a_ler)
+        if concluidas: self._reportar_progresso("", concluidas, total_faturas, bytes_processados, bytes_total)
+
+        if not num_workers or num_workers < 1: num_workers = os.cpu_count() or 1
+        num_workers = min(num_workers, len(indices_a_ler))
+        if modo_leitura != self.MODO_LEITURA_ARQUIVO_TEMPORARIO and num_workers > 1:
+            resultados = self._importar_faturas_em_paralelo([arquivos_zip[i] for i in indices_a_ler], pasta_backup, num_workers,
+                                                            modo_leitura, [tamanhos_zip[i] for i in indices_a_ler],
+                                                            progresso_base=(concluidas, total_faturas, bytes_processados, bytes_total),
+                                                            pasta_xmls_corrigidos=pasta_xmls_corrigidos)
+        else:
+            resultados = []
+            for i in indices_a_ler:
+                if self._cancelamento_solicitado: break
+                caminho_zip_fatura = arquivos_zip[i]
+                nome_arquivo_zip = os.path.basename(caminho_zip_fatura)
+                self.log_callback(f"--- Processando fatura {i+1}/{total_faturas}: {nome_arquivo_zip} ---")
+                dados_fatura_xml = self._importar_fatura(caminho_zip_fatura, pasta_backup, modo_leitura, pasta_temp_extracao_import,
+                                                         pasta_xmls_corrigidos)
+                resultados.append((caminho_zip_fatura, dados_fatura_xml))
+                if dados_fatura_xml: self.log_callback(f"--- Fim do processamento para: {nome_arquivo_zip} ---")
+                concluidas += 1; bytes_processados += tamanhos_zip[i]
+                self._reportar_progresso(nome_arquivo_zip, concluidas, total_faturas, bytes_processados, bytes_total)
+        if cache:
+            self._gravar_faturas_no_cache(cache, resultados)
+            cache.fechar()
+        if faturas_do_cache:
+            # Mantém a ordem de listagem dos ZIPs, intercalando as faturas do cache com as lidas agora
+            lidas = dict(resultados)
+            resultados = [(caminho_zip, faturas_do_cache.get(caminho_zip, lidas.get(caminho_zip))) for caminho_zip in arquivos_zip
+                          if caminho_zip in faturas_do_cache or caminho_zip in lidas]
+        if self._cancelamento_solicitado:
+            self.log_callback(f"AVISO: Importação cancelada pelo usuário. {len(resultados)}/{total_faturas} fatura(s) processada(s) antes do cancelamento.")
+        for caminho_zip_fatura, dados_fatura_xml in resultados:
+            self.status_ultima_importacao.append({'nome_zip': os.path.basename(caminho_zip_fatura),
+                                                  'sucesso': bool(dados_fatura_xml)})
+            if not dados_fatura_xml: continue
             self.lista_faturas_processadas.append(dados_fatura_xml); faturas_com_sucesso += 1
-            file_manager.remover_arquivo_se_existe(caminho_xml_extraido)
-            self.log_callback(f"  Arquivo XML temporário '{nome_xml_extraido}' removido.")
-            self.log_callback(f"--- Fim do processamento para: {nome_arquivo_zip} ---")
+        for status in self.status_ultima_importacao:
+            if not status['sucesso']: self.log_callback(f"  FALHA na importação: {status['nome_zip']}")
         self.log_callback(f"Importação de faturas concluída. {faturas_com_sucesso}/{total_faturas} faturas processadas.")
-        try:
-            if os.path.exists(pasta_temp_extracao_import): shutil.rmtree(pasta_temp_extracao_import)
-            self.log_callback(f"Pasta de extração temporária '{pasta_temp_extracao_import}' removida.")
-        except Exception as e_clean: self.log_callback(f"AVISO: Falha ao remover pasta temporária '{pasta_temp_extracao_import}'. Erro: {e_clean}")
+        self._verificar_itens_duplicados_entre_faturas(pasta_raiz_correcao)
+        if pasta_xmls_corrigidos: self.gerar_resumo_livro_alteracoes(pasta_raiz_correcao)
+        if pasta_temp_extracao_import:
+            try:
+                if os.path.exists(pasta_temp_extracao_import): shutil.rmtree(pasta_temp_extracao_import)
+                self.log_callback(f"Pasta de extração temporária '{pasta_temp_extracao_import}' removida.")
+            except Exception as e_clean: self.log_callback(f"AVISO: Falha ao remover pasta temporária '{pasta_temp_extracao_import}'. Erro: {e_clean}")
+
+    def _verificar_itens_duplicados_entre_faturas(self, pasta_relatorio):
+        """
+        Aponta os itens cobrados em mais de uma fatura da mesma competência no lote importado, a partir
+        das chaves guardadas em cada fatura (sem reler os XMLs), e gera o CSV em 'pasta_relatorio'.
+        """
+        self.itens_duplicados_ultima_importacao = itens_duplicados.localizar_duplicados_entre_faturas(self.lista_faturas_processadas)
+        sem_chaves = sum(1 for fatura in self.lista_faturas_processadas if 'itens_cobrados' not in fatura)
+        if sem_chaves: self.log_callback(f"AVISO: {sem_chaves} fatura(s) lida(s) sem a árvore completa ficaram fora da verificação de itens duplicados entre faturas.")
+        if not self.itens_duplicados_ultima_importacao: return
+        self.log_callback(f"AVISO: {len(self.itens_duplicados_ultima_importacao)} item(ns) cobrado(s) em mais de uma fatura da mesma competência.")
+        if report_generator.gerar_csv_itens_duplicados(self.itens_duplicados_ultima_importacao, pasta_relatorio):
+            self.log_callback(f"CSV de itens duplicados entre faturas gerado em: {pasta_relatorio}")
+        else: self.log_callback("ERRO ao gerar CSV de itens duplicados entre faturas.")
 
     def preparar_distribuicao_faturas(self, numero_auditores, nomes_auditores):
         self.log_callback(f"Distribuindo faturas para {numero_auditores} auditor(es): {', '.join(nomes_auditores)}.")
@@ -586,7 +1462,12 @@ class WorkflowController:
         self.log_callback(f"Preparação de XMLs para '{nome_auditor_selecionado}' concluída.")
 
     # [MÉTODO MODIFICADO]
-    def executar_substituicao_hash(self, caminho_arquivo_ptu):
+    def executar_substituicao_hash(self, caminho_arquivo_ptu, resumo=None):
+        """
+        Aplica as regras, recalcula o <ptu:hash> e cria o novo ZIP em 'Validação CMB'. Retorna
+        (sucesso, mensagem). Se 'resumo' (dict) for passado, recebe 'hash_antigo', 'hash_novo' e
+        'zip_gerado' à medida que as etapas são concluídas (ver executar_substituicao_hash_em_lote).
+        """
         self.log_callback(f"Controller: Iniciando substituição de hash para: {caminho_arquivo_ptu}")
         if not caminho_arquivo_ptu: return (False, "Nenhum arquivo fornecido.")
 
@@ -617,49 +1498,63 @@ class WorkflowController:
         os.makedirs(pasta_validacao_cmb, exist_ok=True)
 
         try:
-            # 4. Aplicar regras de negócio ao XML (in-place na cópia temporária extraída)
-            self.log_callback(f"Controller: Aplicando regras em '{nome_xml_extraido}' antes do cálculo do hash...")
-            if not self._aplicar_regras_de_negocio(caminho_arquivo_ptu):
-                 self.log_callback(f"Controller: Aviso - Problemas ao aplicar algumas regras em '{nome_xml_extraido}'. Hash será calculado sobre o estado atual.")
-
-            # 5. Calcular o novo Hash
-            parser = etree.XMLParser(recover=True, strip_cdata=False, resolve_entities=False)
-            arvore = etree.parse(caminho_arquivo_ptu, parser)
-            raiz = arvore.getroot()
+            # 4. Ler o XML uma única vez: o resultado das mesmas regras guardado pela importação para este
+            # conteúdo, se houver, ou a cópia temporária extraída. Regras, hash e gravação no ZIP
+            # trabalham sobre essa árvore, sem passar pelo disco.
+            pasta_raiz_correcao_xml = os.path.join(pasta_raiz_importacao, "Correção XML")
+            pasta_xmls_corrigidos = file_manager.pasta_xmls_corrigidos(pasta_raiz_correcao_xml)
+            caminho_xml_corrigido, xml_inalterado = file_manager.localizar_xml_corrigido(
+                pasta_xmls_corrigidos, caminho_arquivo_ptu, self._chave_regras_aplicadas())
+            dados_xml, raiz, registro = self._ler_xml_para_gravacao(caminho_xml_corrigido or caminho_arquivo_ptu, nome_arquivo=caminho_arquivo_ptu)
             if raiz is None:
                 self.log_callback(f"  ERRO CRÍTICO: Raiz do XML não pôde ser lida em '{nome_xml_extraido}' para cálculo do hash.")
                 return (False, f"Não foi possível ler a raiz do XML em '{nome_xml_extraido}' para o hash.")
 
+            # 5. Aplicar regras de negócio na árvore, a menos que a importação já o tenha feito.
+            # As regras não podem ser aplicadas duas vezes (ex: tp_Prestador 48 -> 11 e depois 11 -> 01).
+            if caminho_xml_corrigido:
+                self.log_callback(f"Controller: Regras já aplicadas na importação; usando o XML corrigido guardado para '{nome_xml_extraido}'.")
+            elif xml_inalterado:
+                self.log_callback(f"Controller: Regras já verificadas na importação; nenhuma alteração necessária em '{nome_xml_extraido}'.")
+            else:
+                self.log_callback(f"Controller: Aplicando regras em '{nome_xml_extraido}' antes do cálculo do hash...")
+                regras_ok, raiz, registro = self._aplicar_regras_em_memoria(caminho_arquivo_ptu, dados_xml, raiz, registro,
+                                                                            self._caminho_livro_alteracoes(pasta_raiz_correcao_xml))
+                if not regras_ok:
+                     self.log_callback(f"Controller: Aviso - Problemas ao aplicar algumas regras em '{nome_xml_extraido}'. Hash será calculado sobre o estado atual.")
+
+            # 6. Calcular o novo Hash sobre a árvore em memória
             novo_hash = hash_calculator.calcular_hash_moderno(raiz)
             if not novo_hash: return (False, "Falha ao calcular o hash moderno.")
 
-            # 6. Inserir/Substituir o novo Hash no XML
-            namespaces = {'ptu': 'http://ptu.unimed.coop.br/schemas/V3_0'}
-            no_hash_list = raiz.xpath('/ptu:ptuA500/ptu:hash', namespaces=namespaces)
+            # 7. Inserir/Substituir o novo Hash no XML
+            no_hash_list = ptu_xpath.XPATH_HASH_PTUA500(raiz)
+            if resumo is not None:
+                resumo['hash_antigo'] = no_hash_list[0].text.strip() if no_hash_list and no_hash_list[0].text else ""
 
             if no_hash_list:
+                if registro is not None: registro.texto_alterado(no_hash_list[0])
                 no_hash_list[0].text = novo_hash
                 self.log_callback(f"  Hash antigo substituído por: {novo_hash}")
             else:
                 self.log_callback(f"  AVISO: Tag <ptu:hash> não encontrada. Criando com: {novo_hash}")
-                elemento_raiz_ptuA500 = raiz.xpath('/ptu:ptuA500', namespaces=namespaces)
+                elemento_raiz_ptuA500 = ptu_xpath.XPATH_RAIZ_PTUA500(raiz)
                 if elemento_raiz_ptuA500:
-                    nova_tag_hash = etree.Element(f"{{{namespaces['ptu']}}}hash", attrib=None, nsmap=None)
+                    nova_tag_hash = etree.Element(ptu_xpath.TAG_HASH, attrib=None, nsmap=None)
                     nova_tag_hash.text = novo_hash
                     elemento_raiz_ptuA500[0].insert(0, nova_tag_hash)
+                    if registro is not None: registro.inserido(nova_tag_hash)
                 else:
                     self.log_callback("  ERRO: Raiz <ptuA500> não encontrada para adicionar <ptu:hash>.")
                     return (False, "Raiz <ptuA500> não encontrada.")
+            # Só com a tag gravada na árvore o novo hash entra no resumo
+            if resumo is not None: resumo['hash_novo'] = novo_hash
 
-            # 7. Salvar o XML modificado de volta no CAMINHO TEMPORÁRIO (o mesmo caminho_arquivo_ptu)
-            # Isso é necessário para que file_manager.recriar_zip_com_novo_xml possa lê-lo do disco.
-            arvore.write(caminho_arquivo_ptu, encoding='latin-1', xml_declaration=True, pretty_print=True)
-            self.log_callback(f"  XML modificado temporariamente salvo em '{os.path.basename(caminho_arquivo_ptu)}' para reintegração no ZIP.")
-
-            # 8. Chamar a nova função do file_manager para criar o NOVO ZIP na pasta "Validação CMB"
-            sucesso_recriacao, caminho_novo_zip_criado_ou_erro = file_manager.recriar_zip_com_novo_xml(
+            # 8. Criar o NOVO ZIP na pasta "Validação CMB" com o XML serializado uma única vez, direto na
+            # entrada do ZIP (os trechos alterados sobre os bytes lidos, ou a árvore inteira)
+            sucesso_recriacao, caminho_novo_zip_criado_ou_erro = file_manager.recriar_zip_gravando_xml(
                 caminho_zip_original,
-                caminho_arquivo_ptu, # O XML modificado está salvo aqui agora
+                lambda arquivo_xml: self._escrever_xml(arquivo_xml, nome_xml_extraido, dados_xml, raiz, registro),
                 nome_xml_extraido,   # O nome do XML dentro do ZIP (ex: N0123456.051)
                 pasta_validacao_cmb  # Pasta de destino 'Validação CMB'
             )
@@ -670,6 +1565,7 @@ class WorkflowController:
             self.log_callback(f"  Arquivo XML extraído de correção '{os.path.basename(caminho_arquivo_ptu)}' removido após processamento.")
 
             if sucesso_recriacao:
+                if resumo is not None: resumo['zip_gerado'] = caminho_novo_zip_criado_ou_erro
                 self.log_callback(f"  Sucesso: Nova fatura ZIP criada em '{os.path.basename(pasta_validacao_cmb)}'.")
                 return (True, f"Fatura atualizada e nova ZIP criada com sucesso em:\n{caminho_novo_zip_criado_ou_erro}")
             else:
@@ -683,4 +1579,248 @@ class WorkflowController:
         except Exception as e:
             self.log_callback(f"Controller ERRO: Substituição de hash falhou para '{nome_xml_extraido}': {e}")
             logging.exception("Erro crítico no workflow de substituição de hash.")
-            return (False, f"Erro inesperado: {e}")
\ No newline at end of file
+            return (False, f"Erro inesperado: {e}")
+
+    def _substituicoes_hash_concluidas(self, arquivos_051, num_workers):
+        """
+        Gera (índice, (sucesso, mensagem), resumo, mensagens) de cada arquivo de 'arquivos_051' à medida
+        que é concluído. Com 'num_workers' > 1 os arquivos são distribuídos entre processos e as mensagens
+        de log de cada um voltam em 'mensagens' como (texto, é_detalhe); em sequência elas já foram
+        para o log. Se o cancelamento for solicitado, os arquivos ainda não iniciados são descartados.
+        """
+        if num_workers < 2:
+            for indice, caminho_arquivo_ptu in enumerate(arquivos_051):
+                if self._cancelamento_solicitado: return
+                self.log_callback(f"--- Processando arquivo {indice+1}/{len(arquivos_051)}: {os.path.basename(caminho_arquivo_ptu)} ---")
+                resumo = {}
+                yield indice, self.executar_substituicao_hash(caminho_arquivo_ptu, resumo), resumo, []
+            return
+        self.log_callback(f"Substituição de hash em paralelo com {num_workers} processo(s).")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers,
+                                                    initializer=_inicializar_worker_substituicao_hash,
+                                                    initargs=(self._configuracao_workers(), self.log_detalhe_callback is not None)) as executor:
+            futuros = {executor.submit(_substituir_hash_em_worker, caminho_arquivo_ptu): indice
+                       for indice, caminho_arquivo_ptu in enumerate(arquivos_051)}
+            for futuro in concurrent.futures.as_completed(futuros):
+                if futuro.cancelled(): continue
+                indice = futuros[futuro]
+                try:
+                    resultado, resumo, mensagens = futuro.result()
+                except Exception as e:
+                    nome_arquivo = os.path.basename(arquivos_051[indice])
+                    resultado, resumo, mensagens = (False, f"Falha no processo de substituição: {e}"), {}, []
+                    logging.exception(f"Worker de substituição de hash falhou para {nome_arquivo}")
+                yield indice, resultado, resumo, mensagens
+                if self._cancelamento_solicitado:
+                    for futuro_pendente in futuros: futuro_pendente.cancel()
+
+    def _registro_substituicao_lote(self, caminho_arquivo_ptu, status, mensagem="", resumo=None):
+        # Linhas com falha não mostram um hash novo: ele não chegou a um ZIP gerado
+        resumo = resumo or {}
+        hash_novo = resumo.get('hash_novo', "") if status == self.STATUS_SUBSTITUICAO_SUCESSO else ""
+        return {'arquivo': os.path.basename(caminho_arquivo_ptu), 'hash_antigo': resumo.get('hash_antigo', ""),
+                'hash_novo': hash_novo, 'zip_gerado': resumo.get('zip_gerado', ""),
+                'status': status, 'mensagem': mensagem}
+
+    def executar_substituicao_hash_em_lote(self, pasta_xmls_auditor, num_workers=None):
+        """
+        executar_substituicao_hash (regras, hash e novo ZIP) para todos os .051 de 'pasta_xmls_auditor'
+        (ex: 'Correção XML/<auditor>'). 'num_workers' > 1 distribui os arquivos entre processos, que
+        recebem a definição das regras e o índice de cobertura deste; None ou 0 usa todos os núcleos.
+        O progresso é reportado a cada arquivo concluído.
+        Retorna o resumo, um registro por arquivo na ordem da listagem ('arquivo', 'hash_antigo',
+        'hash_novo', 'zip_gerado', 'status', 'mensagem'), que também fica em
+        'resumo_ultima_substituicao_lote' e é gravado em CSV na pasta 'Validação CMB'.
+        """
+        self._cancelamento_solicitado = False
+        self.resumo_ultima_substituicao_lote = []
+        self.log_callback(f"Iniciando substituição de hash em lote na pasta: {pasta_xmls_auditor}")
+        arquivos_051 = file_manager.listar_arquivos_051(pasta_xmls_auditor)
+        if not arquivos_051: self.log_callback("Nenhum arquivo .051 encontrado."); return []
+        total_arquivos = len(arquivos_051)
+        self.log_callback(f"{total_arquivos} arquivo(s) .051 encontrado(s).")
+        tamanhos_051 = [os.path.getsize(caminho) if os.path.isfile(caminho) else 0 for caminho in arquivos_051]
+        bytes_total = sum(tamanhos_051)
+        resumo_lote = [self._registro_substituicao_lote(caminho, self.STATUS_SUBSTITUICAO_NAO_PROCESSADO, "Operação cancelada antes do arquivo.")
+                       for caminho in arquivos_051]
+        self._reportar_progresso("", 0, total_arquivos, 0, bytes_total)
+
+        if not num_workers or num_workers < 1: num_workers = os.cpu_count() or 1
+        num_workers = min(num_workers, total_arquivos)
+        concluidos = 0; bytes_processados = 0
+        for indice, (sucesso, mensagem), resumo, mensagens in self._substituicoes_hash_concluidas(arquivos_051, num_workers):
+            nome_arquivo = os.path.basename(arquivos_051[indice])
+            concluidos += 1; bytes_processados += tamanhos_051[indice]
+            if num_workers > 1: self.log_callback(f"--- Arquivo {concluidos}/{total_arquivos} concluído: {nome_arquivo} ---")
+            for texto, detalhe in mensagens:
+                if not detalhe: self.log_callback(texto)
+                elif self.log_detalhe_callback: self.log_detalhe_callback(texto)
+            if sucesso: resumo_lote[indice] = self._registro_substituicao_lote(arquivos_051[indice], self.STATUS_SUBSTITUICAO_SUCESSO, resumo=resumo)
+            else: resumo_lote[indice] = self._registro_substituicao_lote(arquivos_051[indice], self.STATUS_SUBSTITUICAO_FALHA, mensagem, resumo)
+            self._reportar_progresso(nome_arquivo, concluidos, total_arquivos, bytes_processados, bytes_total)
+
+        self.resumo_ultima_substituicao_lote = resumo_lote
+        if self._cancelamento_solicitado:
+            self.log_callback(f"AVISO: Substituição em lote cancelada pelo usuário. {concluidos}/{total_arquivos} arquivo(s) processado(s) antes do cancelamento.")
+        for registro in resumo_lote:
+            if registro['status'] == self.STATUS_SUBSTITUICAO_FALHA: self.log_callback(f"  FALHA na substituição: {registro['arquivo']}")
+        sucessos = sum(1 for registro in resumo_lote if registro['status'] == self.STATUS_SUBSTITUICAO_SUCESSO)
+        self.log_callback(f"Substituição de hash em lote concluída. {sucessos}/{total_arquivos} arquivo(s) com novo ZIP.")
+        pasta_validacao_cmb = os.path.join(os.path.abspath(os.path.join(pasta_xmls_auditor, '..', '..')), "Validação CMB")
+        os.makedirs(pasta_validacao_cmb, exist_ok=True)
+        if report_generator.gerar_csv_substituicao_hash(resumo_lote, pasta_validacao_cmb):
+            self.log_callback(f"CSV do resumo da substituição de hash gerado em: {pasta_validacao_cmb}")
+        else: self.log_callback("ERRO ao gerar CSV do resumo da substituição de hash.")
+        self.gerar_resumo_livro_alteracoes(os.path.dirname(os.path.abspath(pasta_xmls_auditor)))
+        return resumo_lote
+
+    def _verificacoes_hash_concluidas(self, arquivos_zip, num_workers):
+        """
+        Gera (índice, resultado de _verificar_hash_da_fatura) de cada ZIP à medida que é concluído,
+        distribuindo os ZIPs entre 'num_workers' processos quando for mais de um. Se o cancelamento
+        for solicitado, os ZIPs ainda não iniciados são descartados.
+        """
+        if num_workers < 2:
+            for indice, caminho_zip in enumerate(arquivos_zip):
+                if self._cancelamento_solicitado: return
+                yield indice, _verificar_hash_da_fatura(caminho_zip)
+            return
+        self.log_callback(f"Verificação de hash em paralelo com {num_workers} processo(s).")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futuros = {executor.submit(_verificar_hash_da_fatura, caminho_zip): indice for indice, caminho_zip in enumerate(arquivos_zip)}
+            for futuro in concurrent.futures.as_completed(futuros):
+                if futuro.cancelled(): continue
+                indice = futuros[futuro]
+                try:
+                    resultado = futuro.result()
+                except Exception as e:
+                    resultado = _registro_verificacao_hash(arquivos_zip[indice], self.STATUS_HASH_ERRO,
+                                                           mensagem=f"Falha no processo de verificação: {e}")
+                    logging.exception(f"Worker de verificação de hash falhou para {os.path.basename(arquivos_zip[indice])}")
+                yield indice, resultado
+                if self._cancelamento_solicitado:
+                    for futuro_pendente in futuros: futuro_pendente.cancel()
+
+    def verificar_hashes_faturas(self, caminho_pasta_faturas, num_workers=None):
+        """
+        Confere o <ptu:hash> das faturas ZIP de 'caminho_pasta_faturas' sem alterar nada: o .051 é lido
+        direto do ZIP, o hash é calculado por hash_calculator.calcular_hash_moderno (o mesmo da
+        substituição) e comparado com /ptu:ptuA500/ptu:hash. 'num_workers' > 1 distribui os ZIPs entre
+        processos; None ou 0 usa todos os núcleos.
+        Retorna um registro por ZIP verificado, na ordem da listagem ('arquivo', 'xml', 'hash_gravado',
+        'hash_calculado', 'status', 'mensagem'), também guardado em 'resultado_ultima_verificacao_hash'.
+        Os ZIPs com hash divergente, sem hash ou ilegíveis vão para 'Verificação de Hash.csv' na pasta.
+        """
+        self._cancelamento_solicitado = False
+        self.resultado_ultima_verificacao_hash = []
+        self.log_callback(f"Iniciando verificação de hash da pasta: {caminho_pasta_faturas}")
+        arquivos_zip = sorted(file_manager.listar_arquivos_zip(caminho_pasta_faturas))
+        if not arquivos_zip: self.log_callback("Nenhum arquivo .zip encontrado."); return []
+        total_faturas = len(arquivos_zip)
+        self.log_callback(f"{total_faturas} arquivo(s) .zip encontrado(s).")
+        tamanhos_zip = [os.path.getsize(caminho_zip) if os.path.isfile(caminho_zip) else 0 for caminho_zip in arquivos_zip]
+        bytes_total = sum(tamanhos_zip)
+        resultados = [None] * total_faturas
+        self._reportar_progresso("", 0, total_faturas, 0, bytes_total)
+
+        if not num_workers or num_workers < 1: num_workers = os.cpu_count() or 1
+        num_workers = min(num_workers, total_faturas)
+        concluidas = 0; bytes_processados = 0
+        for indice, resultado in self._verificacoes_hash_concluidas(arquivos_zip, num_workers):
+            concluidas += 1; bytes_processados += tamanhos_zip[indice]
+            resultados[indice] = resultado
+            if resultado['status'] != self.STATUS_HASH_CORRETO:
+                self.log_callback(f"  {resultado['status'].upper()}: {resultado['arquivo']}" + (f" - {resultado['mensagem']}" if resultado['mensagem'] else ""))
+            self._reportar_progresso(resultado['arquivo'], concluidas, total_faturas, bytes_processados, bytes_total)
+
+        self.resultado_ultima_verificacao_hash = resultados = [resultado for resultado in resultados if resultado is not None]
+        if self._cancelamento_solicitado:
+            self.log_callback(f"AVISO: Verificação de hash cancelada pelo usuário. {concluidas}/{total_faturas} fatura(s) verificada(s) antes do cancelamento.")
+        a_revisar = [resultado for resultado in resultados if resultado['status'] != self.STATUS_HASH_CORRETO]
+        self.log_callback(f"Verificação de hash concluída. {len(resultados) - len(a_revisar)}/{len(resultados)} fatura(s) com hash correto.")
+        if not a_revisar:
+            # Não deixa na pasta o relatório de uma verificação anterior
+            file_manager.remover_arquivo_se_existe(os.path.join(caminho_pasta_faturas, report_generator.NOME_CSV_VERIFICACAO_HASH))
+        elif report_generator.gerar_csv_verificacao_hash(a_revisar, caminho_pasta_faturas):
+            self.log_callback(f"CSV com {len(a_revisar)} fatura(s) a revisar gerado em: {caminho_pasta_faturas}")
+        else: self.log_callback("ERRO ao gerar CSV da verificação de hash.")
+        return resultados
+
+
+# --- Workers dos pools ---
+# Cada processo do pool mantém um único WorkflowController, criado no initializer: Unimeds e códigos
+# HM Tabela 00 são carregados uma vez por processo; os modos, a definição das regras e o índice de
+# cobertura vêm do processo principal (WorkflowController._configuracao_workers), para que todos os
+# arquivos passem pelas mesmas regras que numa execução serial.
+def _criar_controller_worker(configuracao, registrar_detalhes=False):
+    atributos, definicao_regras, indice_cobertura_referencia = configuracao
+    controller = WorkflowController(log_callback=lambda msg: None)
+    for atributo, valor in atributos.items(): setattr(controller, atributo, valor)
+    controller.tabelas_regras = regras_config.compilar_tabelas_regras(definicao_regras)
+    controller.indice_cobertura = indice_cobertura_referencia
+    controller.registrar_detalhes = registrar_detalhes
+    return controller
+
+
+# --- Workers da importação paralela ---
+_controller_worker_importacao = None
+
+def _inicializar_worker_importacao(configuracao, registrar_detalhes=False):
+    global _controller_worker_importacao
+    _controller_worker_importacao = _criar_controller_worker(configuracao, registrar_detalhes)
+
+def _importar_fatura_em_worker(caminho_zip_fatura, pasta_backup, modo_leitura, pasta_xmls_corrigidos=None):
+    # Mensagens voltam ao processo principal como (texto, é_detalhe), na ordem em que foram geradas
+    mensagens = []
+    _controller_worker_importacao.log_callback = lambda msg: mensagens.append((msg, False))
+    if _controller_worker_importacao.registrar_detalhes:
+        _controller_worker_importacao.log_detalhe_callback = lambda msg: mensagens.append((msg, True))
+    dados_fatura_xml = _controller_worker_importacao._importar_fatura(caminho_zip_fatura, pasta_backup, modo_leitura,
+                                                                      pasta_xmls_corrigidos=pasta_xmls_corrigidos)
+    return dados_fatura_xml, mensagens
+
+
+# --- Verificação de hash (também executada nos workers do pool) ---
+def _registro_verificacao_hash(caminho_zip, status, nome_xml="", hash_gravado="", hash_calculado="", mensagem=""):
+    return {'arquivo': os.path.basename(caminho_zip), 'xml': nome_xml or "", 'hash_gravado': hash_gravado,
+            'hash_calculado': hash_calculado or "", 'status': status, 'mensagem': mensagem}
+
+def _verificar_hash_da_fatura(caminho_zip):
+    """Lê o .051 de dentro do ZIP, calcula o hash e o compara com o gravado; retorna o registro do ZIP."""
+    try:
+        with file_manager.abrir_xml_fatura_do_zip(caminho_zip) as (nome_xml, stream_xml):
+            if stream_xml is None:
+                return _registro_verificacao_hash(caminho_zip, WorkflowController.STATUS_HASH_ERRO, mensagem="ZIP ilegível ou sem arquivo .051.")
+            raiz = xml_parser.carregar_arvore_xml(stream_xml, nome_arquivo=nome_xml).getroot()
+    except Exception as e:
+        return _registro_verificacao_hash(caminho_zip, WorkflowController.STATUS_HASH_ERRO, mensagem=f"Falha ao ler o XML: {e}")
+    if raiz is None or not ptu_xpath.XPATH_RAIZ_PTUA500(raiz):
+        return _registro_verificacao_hash(caminho_zip, WorkflowController.STATUS_HASH_ERRO, nome_xml, mensagem="Raiz <ptuA500> não encontrada no XML.")
+    hash_calculado = hash_calculator.calcular_hash_moderno(raiz)
+    if not hash_calculado:
+        return _registro_verificacao_hash(caminho_zip, WorkflowController.STATUS_HASH_ERRO, nome_xml, mensagem="Falha ao calcular o hash.")
+    nos_hash = ptu_xpath.XPATH_HASH_PTUA500(raiz)
+    if not nos_hash or not (nos_hash[0].text or "").strip():
+        return _registro_verificacao_hash(caminho_zip, WorkflowController.STATUS_HASH_AUSENTE, nome_xml, hash_calculado=hash_calculado,
+                                          mensagem="Tag <ptu:hash> ausente ou vazia.")
+    hash_gravado = nos_hash[0].text.strip()
+    status = WorkflowController.STATUS_HASH_CORRETO if hash_gravado.lower() == hash_calculado else WorkflowController.STATUS_HASH_DIVERGENTE
+    return _registro_verificacao_hash(caminho_zip, status, nome_xml, hash_gravado, hash_calculado)
+
+
+# --- Workers da substituição de hash em lote ---
+_controller_worker_substituicao_hash = None
+
+def _inicializar_worker_substituicao_hash(configuracao, registrar_detalhes=False):
+    global _controller_worker_substituicao_hash
+    _controller_worker_substituicao_hash = _criar_controller_worker(configuracao, registrar_detalhes)
+
+def _substituir_hash_em_worker(caminho_arquivo_ptu):
+    # Retorna ((sucesso, mensagem), resumo do arquivo, mensagens como (texto, é_detalhe))
+    mensagens = []
+    controller = _controller_worker_substituicao_hash
+    controller.log_callback = lambda msg: mensagens.append((msg, False))
+    controller.log_detalhe_callback = (lambda msg: mensagens.append((msg, True))) if controller.registrar_detalhes else None
+    resumo = {}
+    resultado = controller.executar_substituicao_hash(caminho_arquivo_ptu, resumo)
+    return resultado, resumo, mensagens
@@ -0,0 +1,75 @@
+# gui/log_sink.py
+
+import sys
+import threading
+from collections import deque
+from PyQt6.QtCore import QObject, QTimer
+
+# Níveis de severidade (mesmos valores numéricos do módulo logging)
+NIVEL_DETALHE = 10
+NIVEL_INFO = 20
+NIVEL_AVISO = 30
+NIVEL_ERRO = 40
+
+
+def _inferir_nivel(mensagem):
+    """As mensagens do controller já trazem 'ERRO'/'AVISO' no texto; o resto é informativo."""
+    if "ERRO" in mensagem:
+        return NIVEL_ERRO
+    if "AVISO" in mensagem:
+        return NIVEL_AVISO
+    return NIVEL_INFO
+
+
+class LogSinkBuffer(QObject):
+    """
+    Destino de log com buffer para a área de texto da janela principal.
+
+    'registrar' pode ser chamado de qualquer thread (inclusive da TarefaControllerThread):
+    apenas enfileira a mensagem. Um QTimer na thread da interface descarrega a fila a cada
+    'intervalo_ms', com um único append no QTextEdit, em vez de um repaint por mensagem.
+    Mensagens abaixo de 'nivel_minimo' são descartadas já no registro.
+    """
+
+    def __init__(self, area_texto, intervalo_ms=200, nivel_minimo=NIVEL_INFO, max_linhas_area=20000,
+                 espelhar_stdout=True, parent=None):
+        super().__init__(parent)
+        self.area_texto = area_texto
+        self.nivel_minimo = nivel_minimo
+        self.espelhar_stdout = espelhar_stdout
+        self._pendentes = deque()
+        self._trava = threading.Lock()
+
+        if max_linhas_area:
+            self.area_texto.document().setMaximumBlockCount(max_linhas_area)
+
+        self._timer = QTimer(self)
+        self._timer.setInterval(intervalo_ms)
+        self._timer.timeout.connect(self.descarregar)
+        self._timer.start()
+
+    def registrar(self, mensagem, nivel=None):
+        if nivel is None:
+            nivel = _inferir_nivel(mensagem)
+        if nivel < self.nivel_minimo:
+            return
+        with self._trava:
+            self._pendentes.append(mensagem)
+
+    def registrar_detalhe(self, mensagem):
+        self.registrar(mensagem, NIVEL_DETALHE)
+
+    def detalhe_habilitado(self):
+        return self.nivel_minimo <= NIVEL_DETALHE
+
+    def descarregar(self):
+        """Escreve de uma vez tudo o que estiver pendente. Deve rodar na thread da interface."""
+        with self._trava:
+            if not self._pendentes:
+                return
+            mensagens = list(self._pendentes)
+            self._pendentes.clear()
+        texto = "\n".join(mensagens)
+        self.area_texto.append(texto)
+        if self.espelhar_stdout:
+            sys.stdout.write("".join(f"LOG_GUI: {mensagem}\n" for mensagem in mensagens))
@@ -2,22 +2,48 @@
 
 import sys
 import os
+import functools
 from PyQt6.QtWidgets import (QMainWindow, QPushButton, QVBoxLayout, QHBoxLayout, QWidget,
                              QTextEdit, QFileDialog, QMessageBox, QSizePolicy,
-                             QApplication, QInputDialog)
-from PyQt6.QtCore import Qt, QFile, QTextStream
+                             QApplication, QInputDialog, QProgressBar, QLabel, QDialog,
+                             QTableWidget, QTableWidgetItem, QHeaderView, QDialogButtonBox)
+from PyQt6.QtCore import Qt, QFile, QTextStream, pyqtSignal
 from PyQt6.QtGui import QIcon
 
 try:
     from core.workflow_controller import WorkflowController
+    from gui.tarefa_controller import TarefaControllerThread
+    from gui.log_sink import LogSinkBuffer, NIVEL_INFO, NIVEL_DETALHE
 except ImportError:
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
     from core.workflow_controller import WorkflowController
+    from gui.tarefa_controller import TarefaControllerThread
+    from gui.log_sink import LogSinkBuffer, NIVEL_INFO, NIVEL_DETALHE
 
 
 class MainWindow(QMainWindow):
+    # O controller roda em outra thread: o progresso chega à interface por sinal e o log
+    # pelo LogSinkBuffer, que agrupa as mensagens e escreve no QTextEdit em lote
+    sinal_progresso = pyqtSignal(dict)
+
+    # Nível mínimo exibido na área de log. NIVEL_DETALHE inclui uma linha por nó alterado
+    # pelas regras de correção (milhares por arquivo); em produção fica em NIVEL_INFO.
+    NIVEL_LOG_MINIMO = NIVEL_INFO
+    INTERVALO_ATUALIZACAO_LOG_MS = 200
+
+    # Processos usados na importação paralela (None = todos os núcleos)
+    NUM_PROCESSOS_IMPORTACAO = None
+    # Processos usados na substituição de hash em lote (None = todos os núcleos)
+    NUM_PROCESSOS_SUBSTITUICAO_HASH = None
+    # Processos usados na verificação de hash (None = todos os núcleos)
+    NUM_PROCESSOS_VERIFICACAO_HASH = None
+
     def __init__(self):
         super().__init__()
+        self._tarefa_atual = None
+        # Saída confirmada com uma operação em andamento: a janela fecha quando a tarefa terminar
+        self._encerrando = False
+        self.sinal_progresso.connect(self._atualizar_progresso)
 
         self.setWindowTitle("Audit+ Sistema de Auditoria Automatizada")
         
@@ -39,9 +65,16 @@ class MainWindow(QMainWindow):
         self.log_area = QTextEdit()
         self.log_area.setReadOnly(True)
         self.log_area.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
+        self.log_sink = LogSinkBuffer(self.log_area, intervalo_ms=self.INTERVALO_ATUALIZACAO_LOG_MS,
+                                      nivel_minimo=self.NIVEL_LOG_MINIMO, parent=self)
 
         try:
-            self.controller = WorkflowController(log_callback=self.log_message)
+            log_detalhe_callback = None
+            if self.log_sink.detalhe_habilitado():
+                log_detalhe_callback = functools.partial(self.log_sink.registrar, nivel=NIVEL_DETALHE)
+            self.controller = WorkflowController(log_callback=self.log_sink.registrar,
+                                                 log_detalhe_callback=log_detalhe_callback)
+            self.controller.progresso_callback = self.sinal_progresso.emit
         except Exception as e:
             self.log_message(f"ERRO CRÍTICO ao inicializar WorkflowController: {e}")
             self.controller = None
@@ -52,19 +85,35 @@ class MainWindow(QMainWindow):
         self.btn_distribuir_faturas = QPushButton("Distribuir Faturas")
         self.btn_correcao_xml = QPushButton("Correção XML")
         self.btn_substituir_051 = QPushButton("Substituir 051")
+        self.btn_substituir_pasta_051 = QPushButton("Substituir Pasta 051")
+        self.btn_verificar_hash = QPushButton("Verificar Hash")
         self.btn_sair = QPushButton("Sair")
 
         botoes_layout.addWidget(self.btn_importar_faturas)
         botoes_layout.addWidget(self.btn_distribuir_faturas)
         botoes_layout.addWidget(self.btn_correcao_xml)
         botoes_layout.addWidget(self.btn_substituir_051)
+        botoes_layout.addWidget(self.btn_substituir_pasta_051)
+        botoes_layout.addWidget(self.btn_verificar_hash)
         botoes_layout.addStretch()
         botoes_layout.addWidget(self.btn_sair)
 
+        progresso_layout = QHBoxLayout()
+        self.label_progresso = QLabel("")
+        self.barra_progresso = QProgressBar()
+        self.barra_progresso.setVisible(False)
+        self.btn_cancelar = QPushButton("Cancelar")
+        self.btn_cancelar.setEnabled(False)
+        progresso_layout.addWidget(self.label_progresso, 1)
+        progresso_layout.addWidget(self.barra_progresso, 1)
+        progresso_layout.addWidget(self.btn_cancelar)
+
         self.main_layout.addLayout(botoes_layout)
+        self.main_layout.addLayout(progresso_layout)
         self.main_layout.addWidget(self.log_area, 1)
 
         self.btn_sair.clicked.connect(self.close)
+        self.btn_cancelar.clicked.connect(self.cancelar_tarefa_atual)
         self.btn_importar_faturas.clicked.connect(self.abrir_dialogo_importar_faturas)
         self.btn_distribuir_faturas.clicked.connect(self.iniciar_processo_distribuicao)
         self.btn_correcao_xml.clicked.connect(self.iniciar_preparacao_correcao_xml)
@@ -72,6 +121,8 @@ class MainWindow(QMainWindow):
         # --- ALTERAÇÃO 1: CONEXÃO DO BOTÃO ---
         # O TODO foi substituído pela conexão real com a nova função.
         self.btn_substituir_051.clicked.connect(self.iniciar_substituicao_arquivo_051)
+        self.btn_substituir_pasta_051.clicked.connect(self.iniciar_substituicao_pasta_051)
+        self.btn_verificar_hash.clicked.connect(self.iniciar_verificacao_hash)
 
         if self.controller:
             self.log_message("Audit+ interface iniciada. Bem-vindo!")
@@ -79,9 +130,80 @@ class MainWindow(QMainWindow):
             self.log_message("Audit+ interface iniciada com ERRO no controlador. Funcionalidades limitadas.")
 
     def log_message(self, mensagem):
-        if hasattr(self, 'log_area'):
-            self.log_area.append(mensagem)
-        print(f"LOG_GUI: {mensagem}")
+        if hasattr(self, 'log_sink'):
+            self.log_sink.registrar(mensagem)
+        else:
+            print(f"LOG_GUI: {mensagem}")
+
+    def _executar_em_segundo_plano(self, descricao, funcao, *args, ao_concluir=None, permite_cancelar=False, **kwargs):
+        """
+        Roda 'funcao' do controller em uma TarefaControllerThread, desabilitando os botões
+        de ação até o fim. 'ao_concluir' recebe o retorno da função, já na thread da interface.
+        """
+        if self._tarefa_atual is not None:
+            QMessageBox.information(self, "Aguarde", "Já existe uma operação em andamento.")
+            return False
+
+        self._definir_botoes_acao_habilitados(False)
+        self.btn_cancelar.setEnabled(permite_cancelar)
+        self.label_progresso.setText(f"{descricao}...")
+        self.barra_progresso.setRange(0, 0) # Indeterminado até o primeiro progresso
+        self.barra_progresso.setVisible(True)
+
+        tarefa = TarefaControllerThread(descricao, funcao, *args, parent=self, **kwargs)
+        # Descarrega o log pendente antes de 'ao_concluir' abrir qualquer diálogo
+        tarefa.concluida.connect(self.log_sink.descarregar)
+        if ao_concluir:
+            tarefa.concluida.connect(functools.partial(self._tarefa_concluida, ao_concluir))
+        tarefa.falhou.connect(self._tarefa_falhou)
+        tarefa.finished.connect(self._tarefa_finalizada)
+        self._tarefa_atual = tarefa
+        tarefa.start()
+        return True
+
+    def _definir_botoes_acao_habilitados(self, habilitados):
+        for botao in (self.btn_importar_faturas, self.btn_distribuir_faturas,
+                      self.btn_correcao_xml, self.btn_substituir_051, self.btn_substituir_pasta_051,
+                      self.btn_verificar_hash):
+            botao.setEnabled(habilitados)
+
+    def _tarefa_concluida(self, ao_concluir, resultado):
+        # Encerrando: o resultado já está no log, sem abrir diálogos antes de fechar a janela
+        if not self._encerrando: ao_concluir(resultado)
+
+    def _tarefa_falhou(self, erro):
+        descricao = self._tarefa_atual.descricao if self._tarefa_atual is not None else ""
+        self.log_message(f"ERRO: A operação '{descricao}' falhou: {erro}")
+        self.log_sink.descarregar()
+        if self._encerrando: return
+        QMessageBox.critical(self, "Erro", f"A operação '{descricao}' falhou.\n\n{erro.splitlines()[0] if erro else ''}")
+
+    def _tarefa_finalizada(self):
+        self.log_sink.descarregar()
+        if self._tarefa_atual is not None:
+            self._tarefa_atual.deleteLater()
+        self._tarefa_atual = None
+        self._definir_botoes_acao_habilitados(True)
+        self.btn_cancelar.setEnabled(False)
+        self.barra_progresso.setVisible(False)
+        self.label_progresso.setText("")
+
+    def _atualizar_progresso(self, progresso):
+        total = progresso.get('total', 0)
+        self.barra_progresso.setRange(0, max(total, 1))
+        self.barra_progresso.setValue(progresso.get('concluidos', 0))
+        texto = f"{progresso.get('concluidos', 0)}/{total}"
+        if progresso.get('arquivo_atual'):
+            texto = f"{progresso['arquivo_atual']} - {texto}"
+        if progresso.get('bytes_total'):
+            texto += f" ({progresso.get('bytes_processados', 0) / 1048576:.1f} de {progresso['bytes_total'] / 1048576:.1f} MB)"
+        self.label_progresso.setText(texto)
+
+    def cancelar_tarefa_atual(self):
+        if self._tarefa_atual is not None and self.controller:
+            self.log_message("Cancelamento solicitado. A operação será interrompida após a fatura atual.")
+            self.controller.solicitar_cancelamento()
+            self.btn_cancelar.setEnabled(False)
 
     def abrir_dialogo_importar_faturas(self):
         if not hasattr(self, "_ultimo_diretorio_importacao"):
@@ -95,7 +217,9 @@ class MainWindow(QMainWindow):
             self._ultimo_diretorio_importacao = nome_pasta
             self.log_message(f"Pasta de faturas selecionada: {nome_pasta}")
             if self.controller:
-                self.controller.processar_importacao_faturas(nome_pasta)
+                self._executar_em_segundo_plano("Importando faturas", self.controller.processar_importacao_faturas,
+                                                nome_pasta, num_workers=self.NUM_PROCESSOS_IMPORTACAO,
+                                                permite_cancelar=True)
             else:
                 self.log_message("ERRO: Ação de importação não pode ser executada (controlador não disponível).")
         else:
@@ -146,7 +270,8 @@ class MainWindow(QMainWindow):
         self.log_message(f"Auditores definidos: {', '.join(nomes_auditores)}")
 
         if self.controller:
-            self.controller.preparar_distribuicao_faturas(num_auditores, nomes_auditores)
+            self._executar_em_segundo_plano("Distribuindo faturas", self.controller.preparar_distribuicao_faturas,
+                                            num_auditores, nomes_auditores)
 
     def iniciar_preparacao_correcao_xml(self):
         self.log_message("Botão 'Correção XML' clicado.")
@@ -182,7 +307,8 @@ class MainWindow(QMainWindow):
         if ok_auditor and auditor_selecionado:
             self.log_message(f"Auditor selecionado para preparação de XML: {auditor_selecionado}")
             if self.controller:
-                self.controller.preparar_xmls_para_correcao(auditor_selecionado)
+                self._executar_em_segundo_plano("Preparando XMLs para correção", self.controller.preparar_xmls_para_correcao,
+                                                auditor_selecionado)
         else:
             self.log_message("Seleção de auditor para preparação de XML cancelada.")
 
@@ -212,27 +338,153 @@ class MainWindow(QMainWindow):
         
         self.log_message(f"Arquivo selecionado para substituição do hash: {caminho_arquivo}")
 
-        # Chama o método correspondente no controlador
-        sucesso, mensagem = self.controller.executar_substituicao_hash(caminho_arquivo)
+        # Chama o método correspondente no controlador, fora da thread da interface
+        self._executar_em_segundo_plano("Substituindo hash", self.controller.executar_substituicao_hash,
+                                        caminho_arquivo, ao_concluir=self._exibir_resultado_substituicao)
 
-        # Exibe o resultado para o usuário
+    def _exibir_resultado_substituicao(self, resultado):
+        sucesso, mensagem = resultado
         if sucesso:
             QMessageBox.information(self, "Sucesso", f"Arquivo processado com sucesso!\n\nNovo arquivo salvo em:\n{mensagem}")
         else:
             QMessageBox.critical(self, "Falha no Processamento", f"Não foi possível processar o arquivo.\n\nErro: {mensagem}")
 
+    def iniciar_substituicao_pasta_051(self):
+        """
+        Acionada pelo botão 'Substituir Pasta 051'. O usuário seleciona a pasta de um auditor em
+        'Correção XML' e todos os .051 dela passam pela substituição do hash, em paralelo.
+        """
+        self.log_message("Botão 'Substituir Pasta 051' clicado.")
+
+        if not self.controller:
+            QMessageBox.critical(self, "Erro", "Controlador não inicializado. Ação cancelada.")
+            return
+
+        diretorio_inicial = ""
+        if self.controller.pasta_faturas_importadas_atual:
+            diretorio_inicial = os.path.join(self.controller.pasta_faturas_importadas_atual, "Correção XML")
+        pasta_xmls = QFileDialog.getExistingDirectory(self, "Selecionar Pasta com os Arquivos .051 Corrigidos", diretorio_inicial)
+
+        if not pasta_xmls:
+            self.log_message("Seleção de pasta para substituição cancelada.")
+            return
+
+        self.log_message(f"Pasta selecionada para substituição do hash: {pasta_xmls}")
+        self._executar_em_segundo_plano("Substituindo hash em lote", self.controller.executar_substituicao_hash_em_lote,
+                                        pasta_xmls, num_workers=self.NUM_PROCESSOS_SUBSTITUICAO_HASH,
+                                        ao_concluir=self._exibir_resumo_substituicao_lote, permite_cancelar=True)
+
+    def _exibir_resumo_substituicao_lote(self, resumo_lote):
+        if not resumo_lote:
+            QMessageBox.information(self, "Substituição em Lote", "Nenhum arquivo .051 encontrado na pasta selecionada.")
+            return
+
+        sucessos = sum(1 for registro in resumo_lote if registro['status'] == WorkflowController.STATUS_SUBSTITUICAO_SUCESSO)
+        self._exibir_tabela_registros(f"Substituição em Lote - {sucessos}/{len(resumo_lote)} arquivo(s) com novo ZIP",
+                                      [("Arquivo", 'arquivo'), ("Hash Antigo", 'hash_antigo'), ("Hash Novo", 'hash_novo'),
+                                       ("ZIP Gerado", 'zip_gerado'), ("Status", 'status'), ("Mensagem", 'mensagem')],
+                                      resumo_lote)
+
+    def iniciar_verificacao_hash(self):
+        """
+        Acionada pelo botão 'Verificar Hash'. Confere o <ptu:hash> de todas as faturas ZIP da pasta
+        selecionada, sem alterar nenhum arquivo.
+        """
+        self.log_message("Botão 'Verificar Hash' clicado.")
+
+        if not self.controller:
+            QMessageBox.critical(self, "Erro", "Controlador não inicializado. Ação cancelada.")
+            return
+
+        if not hasattr(self, "_ultimo_diretorio_importacao"):
+            self._ultimo_diretorio_importacao = os.path.expanduser("~")
+        nome_pasta = QFileDialog.getExistingDirectory(self, "Selecionar Pasta com Faturas ZIP para Verificar",
+                                                      self._ultimo_diretorio_importacao)
+
+        if not nome_pasta:
+            self.log_message("Seleção de pasta para verificação cancelada.")
+            return
+
+        self._ultimo_diretorio_importacao = nome_pasta
+        self.log_message(f"Pasta selecionada para verificação do hash: {nome_pasta}")
+        self._executar_em_segundo_plano("Verificando hash", self.controller.verificar_hashes_faturas,
+                                        nome_pasta, num_workers=self.NUM_PROCESSOS_VERIFICACAO_HASH,
+                                        ao_concluir=self._exibir_resultado_verificacao_hash, permite_cancelar=True)
+
+    def _exibir_resultado_verificacao_hash(self, resultados):
+        if not resultados:
+            QMessageBox.information(self, "Verificação de Hash", "Nenhuma fatura ZIP verificada na pasta selecionada.")
+            return
+
+        a_revisar = [registro for registro in resultados if registro['status'] != WorkflowController.STATUS_HASH_CORRETO]
+        if not a_revisar:
+            QMessageBox.information(self, "Verificação de Hash", f"Todas as {len(resultados)} fatura(s) estão com o hash correto.")
+            return
+        self._exibir_tabela_registros(f"Verificação de Hash - {len(a_revisar)} de {len(resultados)} fatura(s) a revisar",
+                                      [("Arquivo ZIP", 'arquivo'), ("Arquivo XML", 'xml'), ("Hash Gravado", 'hash_gravado'),
+                                       ("Hash Calculado", 'hash_calculado'), ("Status", 'status'), ("Mensagem", 'mensagem')],
+                                      a_revisar)
+
+    def _exibir_tabela_registros(self, titulo, colunas, registros):
+        """Diálogo somente leitura com uma linha por registro; 'colunas' = [(título, chave do registro)]."""
+        dialogo = QDialog(self)
+        dialogo.setWindowTitle(titulo)
+        dialogo.resize(1000, 450)
+        tabela = QTableWidget(len(registros), len(colunas), dialogo)
+        tabela.setHorizontalHeaderLabels([titulo_coluna for titulo_coluna, _ in colunas])
+        tabela.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        for linha, registro in enumerate(registros):
+            for coluna, (_, chave) in enumerate(colunas):
+                valor = registro.get(chave) or ""
+                # Caminhos aparecem só com o nome do arquivo; o caminho completo fica na dica
+                item = QTableWidgetItem(" ".join((os.path.basename(valor) if os.path.isabs(valor) else valor).split()))
+                if os.path.isabs(valor): item.setToolTip(valor)
+                tabela.setItem(linha, coluna, item)
+        tabela.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.ResizeToContents)
+        tabela.horizontalHeader().setStretchLastSection(True)
+        botoes = QDialogButtonBox(QDialogButtonBox.StandardButton.Close, dialogo)
+        botoes.rejected.connect(dialogo.reject)
+        layout = QVBoxLayout(dialogo)
+        layout.addWidget(tabela)
+        layout.addWidget(botoes)
+        dialogo.exec()
+
 
     def closeEvent(self, event):
+        # Nunca espera a tarefa aqui (travaria a interface): com uma operação em andamento, pede o
+        # cancelamento e a janela é fechada de novo pelo sinal 'finished' da tarefa
+        if self._encerrando:
+            if self._tarefa_atual is not None: event.ignore()
+            else: self._aceitar_fechamento(event)
+            return
+
+        pergunta = "Você tem certeza que deseja sair?"
+        if self._tarefa_atual is not None:
+            pergunta = "Há uma operação em andamento. Ela será cancelada após a fatura atual.\nDeseja sair mesmo assim?"
         reply = QMessageBox.question(self, 'Sair do Audit+',
-                                       "Você tem certeza que deseja sair?",
+                                       pergunta,
                                        QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
                                        QMessageBox.StandardButton.No)
 
-        if reply == QMessageBox.StandardButton.Yes:
-            self.log_message("Audit+ encerrado pelo usuário.")
-            event.accept()
-        else:
+        if reply != QMessageBox.StandardButton.Yes:
             event.ignore()
+            return
+        self._encerrando = True
+        if self._tarefa_atual is None:
+            self._aceitar_fechamento(event)
+            return
+        if self.controller: self.controller.solicitar_cancelamento()
+        self.btn_cancelar.setEnabled(False)
+        self.label_progresso.setText("Encerrando após a operação atual...")
+        self.log_message("Saída solicitada. O Audit+ será fechado assim que a operação atual for interrompida.")
+        # Conectado depois de _tarefa_finalizada: quando close() rodar, _tarefa_atual já é None
+        self._tarefa_atual.finished.connect(self.close)
+        event.ignore()
+
+    def _aceitar_fechamento(self, event):
+        self.log_message("Audit+ encerrado pelo usuário.")
+        self.log_sink.descarregar()
+        event.accept()
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
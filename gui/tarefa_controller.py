@@ -0,0 +1,37 @@
+# gui/tarefa_controller.py
+
+import logging
+import traceback
+from PyQt6.QtCore import QThread, pyqtSignal
+
+
+class TarefaControllerThread(QThread):
+    """
+    Executa uma chamada do WorkflowController fora da thread da interface, para que a
+    janela continue respondendo durante importações e correções longas.
+
+    Sinais:
+        concluida(object): emitido com o retorno da função chamada.
+        falhou(str): emitido com a mensagem de erro se a função levantar uma exceção.
+
+    O log e o progresso do controller devem chegar à interface pelo LogSinkBuffer e por
+    MainWindow.sinal_progresso, nunca tocando nos widgets a partir desta thread.
+    """
+    concluida = pyqtSignal(object)
+    falhou = pyqtSignal(str)
+
+    def __init__(self, descricao, funcao, *args, parent=None, **kwargs):
+        super().__init__(parent)
+        self.descricao = descricao
+        self._funcao = funcao
+        self._args = args
+        self._kwargs = kwargs
+
+    def run(self):
+        try:
+            resultado = self._funcao(*self._args, **self._kwargs)
+        except Exception as e:
+            logging.exception(f"Falha na tarefa em segundo plano '{self.descricao}'.")
+            self.falhou.emit(f"{e}\n{traceback.format_exc()}")
+            return
+        self.concluida.emit(resultado)
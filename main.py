@@ -1,6 +1,7 @@
 # Conteúdo para: main.py
 
 import sys
+import multiprocessing
 from PyQt6.QtWidgets import QApplication
 from PyQt6.QtCore import QFile, QTextStream # Para carregar o tema escuro
 
@@ -11,6 +12,8 @@ from gui.main_window import MainWindow
 THEME_FILE = "gui/assets/dark_theme.qss"
 
 if __name__ == '__main__':
+    # Necessário para a importação paralela (ProcessPoolExecutor) no executável gerado pelo PyInstaller
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv) # Cria a aplicação PyQt6
 
     # Tenta carregar e aplicar o tema escuro
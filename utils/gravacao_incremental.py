@@ -0,0 +1,574 @@
+# utils/gravacao_incremental.py
+
+"""
+Gravação incremental de um XML alterado em memória: em vez de serializar a árvore inteira
+(e reindentar o documento), aplica sobre os bytes originais só os trechos que mudaram.
+Fora desses trechos a saída é idêntica, byte a byte, ao arquivo lido.
+
+Quem altera a árvore registra cada alteração num RegistroAlteracoes (antes de alterar um texto
+ou remover um elemento, depois de inserir um elemento novo):
+
+    registro = gravacao_incremental.RegistroAlteracoes()
+    registro.texto_alterado(no); no.text = "novo"
+    registro.removido(no); no.getparent().remove(no)
+    pai.append(novo_no); registro.inserido(novo_no)
+
+Na gravação, cada elemento envolvido é localizado nos bytes pela linha em que termina a sua
+tag de abertura (elemento.sourceline) e pela ordem entre as tags que terminam nessa linha. O
+custo depende do número de alterações, não do tamanho do arquivo (além da cópia dos bytes).
+Cada trecho localizado é conferido com o conteúdo da árvore (nome da tag, texto original,
+tail); qualquer divergência, ou um caso não suportado, levanta GravacaoIncrementalIndisponivel
+para que quem chamou grave a árvore completa.
+"""
+
+import re
+from lxml import etree
+
+# Acima disso (ex: arquivo sem quebras de linha) localizar um elemento deixa de ser barato
+LIMITE_ELEMENTOS_MESMA_LINHA = 5000
+# Maior linha que o libxml2 guarda no próprio elemento (ver RegistroAlteracoes.linha_original)
+LIMITE_LINHA_LIBXML2 = 65535
+TAMANHO_BLOCO_LINHAS = 64 * 1024
+TAMANHO_MINIMO_BLOCO_LINHAS = 256
+LINHAS_BUSCA_DIRETA = 16
+
+_RE_TAG_ABERTURA = re.compile(rb'<([^\s/>!?]+)(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>')
+_RE_REFERENCIA = re.compile(r'&(#[xX][0-9a-fA-F]+|#[0-9]+|lt|gt|amp|quot|apos);')
+_ENTIDADES = {'lt': '<', 'gt': '>', 'amp': '&', 'quot': '"', 'apos': "'"}
+
+
+class GravacaoIncrementalIndisponivel(Exception):
+    """A alteração não pode ser aplicada sobre os bytes originais; grave a árvore completa."""
+
+
+def _e_elemento(no):
+    return isinstance(no.tag, str)
+
+
+class RegistroAlteracoes:
+    """
+    Alterações feitas numa árvore lida de um arquivo, na ordem em que aconteceram.
+    Depois de inválido (movimentação de nós, elemento não localizável...), as chamadas
+    seguintes são ignoradas e a gravação incremental não é tentada.
+    """
+
+    def __init__(self):
+        self.textos_originais = {} # elemento -> texto antes da primeira alteração
+        self.removidos = [] # (elemento, linha, ordem)
+        self.inseridos = []
+        self._inseridos = set()
+        self._linhas_originais = {}
+        self._removidos_por_linha = {}
+        self._pais_alterados = set()
+        self.motivo_invalido = None
+
+    @property
+    def valido(self):
+        return self.motivo_invalido is None
+
+    def invalidar(self, motivo):
+        if self.motivo_invalido is None: self.motivo_invalido = motivo
+
+    def texto_alterado(self, elemento):
+        """Chamar antes de alterar elemento.text."""
+        if not self.valido or elemento in self.textos_originais or self.e_novo(elemento): return
+        # A linha pode depender do nó de texto que será substituído (ver linha_original)
+        self._linhas_originais[elemento] = self.linha_original(elemento)
+        self.textos_originais[elemento] = elemento.text
+
+    def removido(self, elemento):
+        """Chamar antes de remover o elemento da árvore (ele sai com o tail, como no lxml)."""
+        if not self.valido or self.e_novo(elemento): return # criado em memória: não está nos bytes
+        try:
+            # O elemento e os descendentes deixam de contar nas linhas em que estavam
+            posicoes = [self.posicao(no) for no in elemento.iter() if _e_elemento(no) and not self.e_novo(no)]
+        except GravacaoIncrementalIndisponivel as e:
+            self.invalidar(str(e))
+            return
+        for linha, ordem in posicoes:
+            self._removidos_por_linha.setdefault(linha, []).append(ordem)
+        self._pais_alterados.add(elemento.getparent())
+        self.removidos.append((elemento, *posicoes[0]))
+
+    def inserido(self, elemento):
+        """Chamar depois de inserir um elemento criado em memória."""
+        if not self.valido: return
+        if elemento.sourceline is not None or elemento in self._linhas_originais:
+            self.invalidar(f"elemento <{etree.QName(elemento).localname}> movido de posição")
+            return
+        self._pais_alterados.add(elemento.getparent())
+        self._inseridos.add(elemento)
+        self.inseridos.append(elemento)
+
+    def e_novo(self, elemento):
+        """O elemento (ou um ancestral) foi inserido em memória e não existe nos bytes originais."""
+        if not self._inseridos or elemento.sourceline is not None: return False
+        while elemento is not None:
+            if elemento in self._inseridos: return True
+            elemento = elemento.getparent()
+        return False
+
+    def linha_original(self, no):
+        """
+        Linha em que termina a tag de abertura do elemento no arquivo. O libxml2 guarda a linha
+        dos elementos em 16 bits: a partir de 65535 o lxml devolve a linha do primeiro filho
+        (ou do próximo irmão), que é o fim do texto que segue a tag. Aqui a linha é recuperada
+        descontando as quebras desse texto. None se não der para saber (ex: vizinhos alterados).
+        """
+        if no in self._linhas_originais: return self._linhas_originais[no]
+        linha = no.sourceline
+        if linha is None or linha < LIMITE_LINHA_LIBXML2: return linha
+        if not _e_elemento(no): return None
+        if no.text: return linha - no.text.count('\n')
+        if no in self._pais_alterados: return None
+        if len(no): return self.linha_original(no[0])
+        if no.tail: return linha - no.tail.count('\n')
+        pai = no.getparent()
+        if pai in self._pais_alterados: return None
+        proximo = no.getnext()
+        if proximo is not None: return self.linha_original(proximo)
+        anterior = no.getprevious()
+        # Sem próximo irmão o libxml2 usa o nó anterior: o texto que termina onde o elemento começa
+        if (anterior.tail if anterior is not None else pai is not None and pai.text): return linha
+        return None
+
+    def posicao(self, elemento):
+        """
+        (linha, ordem) do elemento no documento original: a linha em que termina a tag de abertura
+        e quantas tags de abertura terminam antes dela na mesma linha. Percorre os elementos
+        anteriores em ordem reversa de documento até sair da linha; os elementos já removidos
+        da árvore entram pela ordem registrada na remoção.
+        """
+        linha = self.linha_original(elemento)
+        if linha is None:
+            raise GravacaoIncrementalIndisponivel(f"linha de origem de <{etree.QName(elemento).localname}> desconhecida")
+        anteriores_na_linha = 0
+        no = elemento
+        while True:
+            anterior = no.getprevious()
+            if anterior is None:
+                no = no.getparent()
+                if no is None: break
+            else:
+                while len(anterior): anterior = anterior[-1]
+                no = anterior
+            if not _e_elemento(no) or self.e_novo(no): continue
+            linha_anterior = self.linha_original(no)
+            if linha_anterior is None:
+                raise GravacaoIncrementalIndisponivel(f"linha de origem de <{etree.QName(no).localname}> desconhecida")
+            if linha_anterior < linha: break
+            anteriores_na_linha += 1
+            if anteriores_na_linha > LIMITE_ELEMENTOS_MESMA_LINHA:
+                raise GravacaoIncrementalIndisponivel(f"mais de {LIMITE_ELEMENTOS_MESMA_LINHA} elementos na linha {linha}")
+
+        ordem = anteriores_na_linha
+        for ordem_removido in sorted(self._removidos_por_linha.get(linha, ())):
+            if ordem_removido > ordem: break
+            ordem += 1
+        return linha, ordem
+
+
+def _inicios_de_linha(dados, linhas):
+    """
+    Deslocamento do início de cada linha pedida (numeradas a partir de 1). As quebras são contadas
+    em blocos que dobram enquanto a próxima linha pedida está longe e encolhem perto dela, de modo
+    que o custo acompanha a distância entre as linhas pedidas.
+    """
+    inicios = {}
+    linha_atual, posicao, bloco = 1, 0, TAMANHO_MINIMO_BLOCO_LINHAS
+    for linha in sorted(set(linhas)):
+        # Linhas próximas (o caso comum: alterações na mesma guia) vão direto de quebra em quebra
+        while linha_atual < linha and linha - linha_atual <= LINHAS_BUSCA_DIRETA:
+            quebra = dados.find(b'\n', posicao)
+            if quebra < 0: raise GravacaoIncrementalIndisponivel(f"linha {linha} além do fim do arquivo")
+            linha_atual, posicao = linha_atual + 1, quebra + 1
+        while linha_atual < linha:
+            fim_bloco = min(posicao + bloco, len(dados))
+            quebras = dados.count(b'\n', posicao, fim_bloco)
+            if linha_atual + quebras < linha:
+                if fim_bloco == len(dados): raise GravacaoIncrementalIndisponivel(f"linha {linha} além do fim do arquivo")
+                linha_atual, posicao = linha_atual + quebras, fim_bloco
+                bloco = min(bloco * 2, TAMANHO_BLOCO_LINHAS)
+            elif bloco > TAMANHO_MINIMO_BLOCO_LINHAS:
+                bloco //= 2
+            else:
+                linha_atual, posicao = linha_atual + 1, dados.find(b'\n', posicao) + 1
+        inicios[linha] = posicao
+    return inicios
+
+
+def _fim_de_marcacao(dados, posicao):
+    """Fim de um comentário, CDATA, instrução de processamento, DOCTYPE ou tag de fechamento em 'posicao'."""
+    if dados[posicao + 1:posicao + 2] not in (b'!', b'?', b'/'): return None
+    for inicio, fim in ((b'<!--', b'-->'), (b'<![CDATA[', b']]>'), (b'<?', b'?>'), (b'<!', b'>'), (b'</', b'>')):
+        if dados.startswith(inicio, posicao):
+            final = dados.find(fim, posicao + len(inicio))
+            if final < 0: raise GravacaoIncrementalIndisponivel("marcação sem fechamento")
+            return final + len(fim)
+    return None
+
+
+def _tags_de_abertura_na_linha(dados, inicio_linha, fim_linha):
+    """(início, fim, nome, auto-fechada) das tags de abertura cujo '>' está na linha."""
+    posicao = inicio_linha
+    # Tag aberta numa linha anterior e fechada nesta
+    anterior = dados.rfind(b'<', 0, inicio_linha)
+    if anterior >= 0 and dados.find(b'>', anterior, inicio_linha) < 0: posicao = anterior
+    while True:
+        menor = dados.find(b'<', posicao, fim_linha)
+        if menor < 0: return
+        fim_marcacao = _fim_de_marcacao(dados, menor)
+        if fim_marcacao is not None:
+            posicao = fim_marcacao
+            continue
+        tag = _RE_TAG_ABERTURA.match(dados, menor)
+        if tag is None: raise GravacaoIncrementalIndisponivel(f"tag de abertura não reconhecida no byte {menor}")
+        if tag.end() > fim_linha: return
+        yield menor, tag.end(), tag.group(1), bool(tag.group(2))
+        posicao = tag.end()
+
+
+def _fim_do_elemento(dados, fim_tag_abertura):
+    """Fim da tag de fechamento correspondente a uma tag de abertura (não auto-fechada)."""
+    profundidade, posicao = 1, fim_tag_abertura
+    while True:
+        menor = dados.find(b'<', posicao)
+        if menor < 0: raise GravacaoIncrementalIndisponivel("elemento sem tag de fechamento")
+        fim_marcacao = _fim_de_marcacao(dados, menor)
+        if fim_marcacao is not None:
+            if dados.startswith(b'</', menor):
+                profundidade -= 1
+                if profundidade == 0: return fim_marcacao
+            posicao = fim_marcacao
+            continue
+        tag = _RE_TAG_ABERTURA.match(dados, menor)
+        if tag is None: raise GravacaoIncrementalIndisponivel(f"tag de abertura não reconhecida no byte {menor}")
+        if not tag.group(2): profundidade += 1
+        posicao = tag.end()
+
+
+def _fim_de_texto(dados, posicao):
+    """Fim do texto que começa em 'posicao' (text ou tail do lxml): o próximo '<'."""
+    fim = dados.find(b'<', posicao)
+    return len(dados) if fim < 0 else fim
+
+
+def _referencia(correspondencia):
+    nome = correspondencia.group(1)
+    if nome[0] == '#':
+        return chr(int(nome[2:], 16) if nome[1] in 'xX' else int(nome[1:]))
+    return _ENTIDADES[nome]
+
+
+def _texto_dos_bytes(trecho, codificacao):
+    texto = trecho.decode(codificacao).replace('\r\n', '\n').replace('\r', '\n')
+    return _RE_REFERENCIA.sub(_referencia, texto)
+
+
+def _escapar_texto(texto, codificacao):
+    texto = texto.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;')
+    return texto.encode(codificacao, 'xmlcharrefreplace')
+
+
+def _escapar_atributo(valor, codificacao):
+    valor = (valor.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;')
+             .replace('\n', '&#10;').replace('\r', '&#13;').replace('\t', '&#9;'))
+    return valor.encode(codificacao, 'xmlcharrefreplace')
+
+
+def _nome_qualificado(elemento):
+    nome_local = elemento.tag.rpartition('}')[2]
+    prefixo = elemento.prefix
+    return f"{prefixo}:{nome_local}" if prefixo else nome_local
+
+
+def _serializar_novo(elemento, nsmap_pai, codificacao):
+    """Serializa um elemento criado em memória (e o seu tail) como o lxml faria dentro do documento."""
+    if any(not _e_elemento(filho) for filho in elemento):
+        raise GravacaoIncrementalIndisponivel("comentário ou instrução em elemento novo")
+    if any(nome.startswith('{') for nome in elemento.attrib):
+        raise GravacaoIncrementalIndisponivel("atributo com namespace em elemento novo")
+    nome = _nome_qualificado(elemento).encode(codificacao)
+    partes = [b'<', nome]
+    for prefixo, uri in elemento.nsmap.items():
+        if nsmap_pai.get(prefixo) != uri:
+            partes += [b' xmlns', (b':' + prefixo.encode(codificacao)) if prefixo else b'', b'="', _escapar_atributo(uri, codificacao), b'"']
+    for chave, valor in elemento.attrib.items():
+        partes += [b' ', chave.encode(codificacao), b'="', _escapar_atributo(valor, codificacao), b'"']
+    if elemento.text is None and not len(elemento):
+        partes.append(b'/>')
+    else:
+        partes.append(b'>')
+        if elemento.text: partes.append(_escapar_texto(elemento.text, codificacao))
+        for filho in elemento:
+            partes.append(_serializar_novo(filho, elemento.nsmap, codificacao))
+        partes += [b'</', nome, b'>']
+    if elemento.tail: partes.append(_escapar_texto(elemento.tail, codificacao))
+    return b''.join(partes)
+
+
+def _esta_na_arvore(elemento, raiz):
+    while elemento is not None:
+        if elemento is raiz: return True
+        elemento = elemento.getparent()
+    return False
+
+
+class _Localizador:
+    """Resolve (linha, ordem) em trechos dos bytes originais, conferindo o nome da tag."""
+
+    def __init__(self, dados, posicoes):
+        self.dados = dados
+        self._inicios = _inicios_de_linha(dados, [linha for linha, _ in posicoes])
+        self._tags_por_linha = {}
+
+    def tag_de_abertura(self, linha, ordem, nome_esperado):
+        if linha not in self._tags_por_linha:
+            inicio_linha = self._inicios[linha]
+            fim_linha = self.dados.find(b'\n', inicio_linha)
+            if fim_linha < 0: fim_linha = len(self.dados)
+            self._tags_por_linha[linha] = list(_tags_de_abertura_na_linha(self.dados, inicio_linha, fim_linha))
+        tags = self._tags_por_linha[linha]
+        if ordem >= len(tags) or tags[ordem][2] != nome_esperado:
+            raise GravacaoIncrementalIndisponivel(f"<{nome_esperado}> não encontrado na linha {linha}")
+        return tags[ordem]
+
+    def fim_do_elemento(self, tag):
+        inicio, fim, _, auto_fechada = tag
+        return fim if auto_fechada else _fim_do_elemento(self.dados, fim)
+
+
+def inicio_dos_elementos(dados, elementos):
+    """
+    Deslocamento, nos bytes originais 'dados', do '<' da tag de abertura de cada elemento de uma
+    árvore ainda sem alterações. Levanta GravacaoIncrementalIndisponivel se algum não for localizado.
+    """
+    if not elementos: return []
+    codificacao = elementos[0].getroottree().docinfo.encoding or 'UTF-8'
+    registro = RegistroAlteracoes()
+    posicoes = [registro.posicao(elemento) for elemento in elementos]
+    localizador = _Localizador(dados, posicoes)
+    return [localizador.tag_de_abertura(linha, ordem, _nome_qualificado(elemento).encode(codificacao))[0]
+            for elemento, (linha, ordem) in zip(elementos, posicoes)]
+
+
+def montar_edicoes(dados, raiz, registro):
+    """
+    Lista ordenada de (início, fim, bytes novos) que leva os bytes originais 'dados' ao estado
+    atual da árvore de 'raiz', a partir das alterações do registro.
+    """
+    if not registro.valido:
+        raise GravacaoIncrementalIndisponivel(registro.motivo_invalido)
+    codificacao = raiz.getroottree().docinfo.encoding or 'UTF-8'
+    if '<'.encode(codificacao, 'ignore') != b'<':
+        raise GravacaoIncrementalIndisponivel(f"codificação '{codificacao}' não suportada")
+
+    # Texto alterado em elementos originais que continuam na árvore (e com valor diferente)
+    textos = [(elemento, original) for elemento, original in registro.textos_originais.items()
+              if elemento.text != original and _esta_na_arvore(elemento, raiz)]
+
+    # Elementos novos agrupados por sequência de irmãos novos; cada grupo entra depois do irmão
+    # original anterior (e do seu tail) ou, se não houver, no início do conteúdo do pai
+    grupos, vistos = [], set()
+    for elemento in registro.inseridos:
+        if elemento in vistos or not _esta_na_arvore(elemento, raiz): continue
+        pai = elemento.getparent()
+        if registro.e_novo(pai): continue # dentro de outro elemento novo
+        primeiro = elemento
+        while primeiro.getprevious() is not None and registro.e_novo(primeiro.getprevious()):
+            primeiro = primeiro.getprevious()
+        ancora = primeiro.getprevious()
+        if ancora is not None and not _e_elemento(ancora):
+            raise GravacaoIncrementalIndisponivel("elemento novo logo após comentário ou instrução")
+        sequencia, no = [], primeiro
+        while no is not None and registro.e_novo(no):
+            vistos.add(no)
+            sequencia.append(no)
+            no = no.getnext()
+        conteudo = b''.join(_serializar_novo(novo, pai.nsmap, codificacao) for novo in sequencia)
+        grupos.append((pai, ancora, conteudo))
+
+    elementos = {elemento for elemento, _ in textos}
+    elementos.update(ancora if ancora is not None else pai for pai, ancora, _ in grupos)
+    posicoes = {elemento: registro.posicao(elemento) for elemento in elementos}
+    localizador = _Localizador(dados, list(posicoes.values()) + [(linha, ordem) for _, linha, ordem in registro.removidos])
+
+    def localizar(elemento, linha=None, ordem=None):
+        if linha is None: linha, ordem = posicoes[elemento]
+        return localizador.tag_de_abertura(linha, ordem, _nome_qualificado(elemento).encode(codificacao))
+
+    def conferir(trecho, esperado, descricao):
+        if _texto_dos_bytes(trecho, codificacao) != (esperado or ''):
+            raise GravacaoIncrementalIndisponivel(f"{descricao} não confere com o arquivo")
+
+    edicoes = []
+    inicio_conteudo = {} # elemento -> [texto novo ou None, grupo a inserir no início]
+    for elemento, original in textos:
+        inicio_conteudo.setdefault(elemento, [None, b''])[0] = (original, elemento.text)
+    for pai, ancora, conteudo in grupos:
+        if ancora is None:
+            inicio_conteudo.setdefault(pai, [None, b''])[1] += conteudo
+            continue
+        tag = localizar(ancora)
+        fim_ancora = localizador.fim_do_elemento(tag)
+        fim_tail = _fim_de_texto(dados, fim_ancora)
+        conferir(dados[fim_ancora:fim_tail], ancora.tail, f"tail de <{tag[2].decode(codificacao)}>")
+        edicoes.append((fim_tail, fim_tail, conteudo))
+
+    for elemento, (texto, conteudo) in inicio_conteudo.items():
+        inicio, fim, nome, auto_fechada = localizar(elemento)
+        texto_novo = _escapar_texto(texto[1], codificacao) if texto is not None and texto[1] else b''
+        if auto_fechada:
+            if texto is not None and texto[0]:
+                raise GravacaoIncrementalIndisponivel(f"texto de <{nome.decode(codificacao)}> não confere com o arquivo")
+            # <x/> -> <x>texto novo</x>; a barra fica logo antes do '>'
+            edicoes.append((fim - 2, fim, b'>' + texto_novo + conteudo + b'</' + nome + b'>'))
+            continue
+        fim_texto = _fim_de_texto(dados, fim)
+        if texto is not None:
+            conferir(dados[fim:fim_texto], texto[0], f"texto de <{nome.decode(codificacao)}>")
+        else:
+            texto_novo = dados[fim:fim_texto]
+        edicoes.append((fim, fim_texto, texto_novo + conteudo))
+
+    remocoes = []
+    for elemento, linha, ordem in registro.removidos:
+        tag = localizar(elemento, linha, ordem)
+        fim_elemento = localizador.fim_do_elemento(tag)
+        fim_tail = _fim_de_texto(dados, fim_elemento)
+        conferir(dados[fim_elemento:fim_tail], elemento.tail, f"tail de <{tag[2].decode(codificacao)}>")
+        remocoes.append((tag[0], fim_tail, b''))
+    # Remoções dentro de um trecho já removido (filho removido antes do pai) não contam
+    remocoes.sort(key=lambda edicao: (edicao[0], -edicao[1]))
+    fim_removido = -1
+    for remocao in remocoes:
+        if remocao[1] <= fim_removido: continue
+        edicoes.append(remocao)
+        fim_removido = remocao[1]
+
+    # Inserções (início == fim) antes de trechos que começam no mesmo byte
+    edicoes.sort(key=lambda edicao: (edicao[0], edicao[1]))
+    for anterior, atual in zip(edicoes, edicoes[1:]):
+        if atual[0] < anterior[1]:
+            raise GravacaoIncrementalIndisponivel(f"alterações sobrepostas nos bytes {anterior[0]}-{anterior[1]} e {atual[0]}-{atual[1]}")
+    return edicoes
+
+
+def escrever_edicoes(dados, edicoes, arquivo):
+    """Escreve no arquivo binário aberto os bytes originais 'dados' com as edições de montar_edicoes."""
+    visao = memoryview(dados)
+    posicao = 0
+    for inicio, fim, conteudo in edicoes:
+        arquivo.write(visao[posicao:inicio])
+        arquivo.write(conteudo)
+        posicao = fim
+    arquivo.write(visao[posicao:])
+
+
+def gravar_alteracoes(dados, raiz, registro, caminho_destino):
+    """
+    Grava em 'caminho_destino' os bytes originais 'dados' com as alterações do registro aplicadas.
+    Retorna o número de trechos alterados. Levanta GravacaoIncrementalIndisponivel, sem gravar
+    nada, se as alterações não puderem ser aplicadas sobre os bytes.
+    """
+    edicoes = montar_edicoes(dados, raiz, registro)
+    with open(caminho_destino, 'wb') as arquivo:
+        escrever_edicoes(dados, edicoes, arquivo)
+    return len(edicoes)
+
+
+# Conferência (para rodar 'python -m utils.gravacao_incremental [arquivos]'): aplica as regras de
+# cada motor que registra alterações nos exemplos (ou nos arquivos dados) e confere que a saída
+# incremental tem a mesma forma canônica que arvore_xml.write(...) e que, fora dos trechos
+# editados, os bytes são os do arquivo lido.
+if __name__ == '__main__':
+    import io
+    import os
+    import sys
+    import logging
+    from utils import xml_parser
+    from core.workflow_controller import WorkflowController
+
+    logging.getLogger().setLevel(logging.WARNING)
+    pasta_exemplos = os.path.dirname(os.path.abspath(__file__))
+    arquivos = sys.argv[1:] or [os.path.join(pasta_exemplos, nome) for nome in sorted(os.listdir(pasta_exemplos)) if nome.endswith('.xml')]
+    # O motor XSLT devolve um documento novo e sempre grava a árvore completa
+    motores = (WorkflowController.MOTOR_REGRAS_PASSAGEM_UNICA, WorkflowController.MOTOR_REGRAS_SEQUENCIAL)
+
+    def _forma_canonica(dados):
+        return etree.tostring(xml_parser.carregar_arvore_xml(io.BytesIO(dados)), method='c14n')
+
+    def _bytes_preservados(dados, edicoes, saida):
+        """Os trechos entre as edições aparecem intactos na saída, na ordem, e nada sobra no fim."""
+        posicao_dados = posicao_saida = 0
+        for inicio, fim, conteudo in edicoes:
+            if saida[posicao_saida:posicao_saida + inicio - posicao_dados] != dados[posicao_dados:inicio]: return False
+            posicao_saida += inicio - posicao_dados
+            if saida[posicao_saida:posicao_saida + len(conteudo)] != conteudo: return False
+            posicao_saida += len(conteudo)
+            posicao_dados = fim
+        return saida[posicao_saida:] == dados[posicao_dados:]
+
+    def _verificar(nome, dados, raiz, registro):
+        edicoes = montar_edicoes(dados, raiz, registro)
+        saida = io.BytesIO()
+        escrever_edicoes(dados, edicoes, saida)
+        completa = io.BytesIO()
+        raiz.getroottree().write(completa, encoding=raiz.getroottree().docinfo.encoding, xml_declaration=True)
+        iguais = _forma_canonica(saida.getvalue()) == _forma_canonica(completa.getvalue())
+        preservados = _bytes_preservados(dados, edicoes, saida.getvalue())
+        alterados = sum(fim - inicio for inicio, fim, _ in edicoes)
+        print(f"{'OK  ' if iguais and preservados else 'ERRO'} {nome}: {len(edicoes)} trecho(s), {alterados} de {len(dados)} bytes substituídos"
+              + ("" if iguais else " (forma canônica diverge de write)") + ("" if preservados else " (bytes fora dos trechos alterados)"))
+        return iguais and preservados
+
+    todos_conferem = True
+    for caminho_arquivo in arquivos:
+        for motor in motores:
+            controller = WorkflowController(log_callback=lambda mensagem: None)
+            controller.MOTOR_REGRAS = motor
+            controller.GRAVACAO_XML = controller.GRAVACAO_XML_INCREMENTAL
+            dados, raiz, registro = controller._ler_xml_para_gravacao(caminho_arquivo)
+            total, raiz, registro, _ = controller._aplicar_regras_no_xml_lido(raiz, registro)
+            try:
+                todos_conferem &= _verificar(f"{os.path.basename(caminho_arquivo)} [{motor}, {total} alteração(ões)]", dados, raiz, registro)
+            except GravacaoIncrementalIndisponivel as e:
+                print(f"ERRO {os.path.basename(caminho_arquivo)} [{motor}]: gravação incremental indisponível ({e})")
+                todos_conferem = False
+
+    # Casos sintéticos: texto em tag auto-fechada, remoção de pai e filho, inserção no início do
+    # conteúdo e após um irmão, entidades e alterações além da linha 65535 (limite do libxml2)
+    linhas_longe = '\n'.join(f'<ptu:item n="{indice}">v{indice}</ptu:item>' for indice in range(LIMITE_LINHA_LIBXML2 + 10))
+    casos_sinteticos = [
+        b'<?xml version="1.0" encoding="ISO-8859-1"?>\n<ptu:r xmlns:ptu="http://ptu.unimed.coop.br/schemas/V3_0">\n  <ptu:a/>\n  <ptu:b>x &amp; y</ptu:b>\n'
+        b'  <ptu:c><ptu:d>1</ptu:d></ptu:c>\n  <ptu:e>Jos\xe9</ptu:e>\n</ptu:r>\n',
+        f'<ptu:r xmlns:ptu="http://ptu.unimed.coop.br/schemas/V3_0">\n{linhas_longe}\n<ptu:fim/>\n</ptu:r>\n'.encode('utf-8'),
+    ]
+
+    def _alterar(raiz, registro):
+        elementos = [no for no in raiz.iter() if _e_elemento(no) and no is not raiz]
+        primeiro, ultimo = elementos[0], elementos[-1]
+        registro.texto_alterado(primeiro); primeiro.text = 'novo <texto> & "aspas"'
+        registro.texto_alterado(ultimo); ultimo.text = 'Conceição'
+        com_filho = next((no for no in elementos if len(no)), None)
+        if com_filho is not None:
+            registro.removido(com_filho[0]); com_filho.remove(com_filho[0])
+            registro.removido(com_filho); com_filho.getparent().remove(com_filho)
+        inicio = etree.Element(etree.QName(raiz, 'inicio'), nsmap=raiz.nsmap); inicio.tail = '\n'
+        raiz.insert(0, inicio); registro.inserido(inicio)
+        depois = etree.SubElement(raiz, etree.QName(raiz, 'depois'), atributo='1 < 2')
+        depois.text = 'valor'; registro.inserido(depois)
+        meio = elementos[len(elementos) // 2]
+        registro.texto_alterado(meio); meio.text = 'meio'
+
+    for indice, xml_caso in enumerate(casos_sinteticos, 1):
+        raiz = xml_parser.carregar_arvore_xml(io.BytesIO(xml_caso)).getroot()
+        registro = RegistroAlteracoes()
+        _alterar(raiz, registro)
+        try:
+            todos_conferem &= _verificar(f"caso sintético {indice}", xml_caso, raiz, registro)
+        except GravacaoIncrementalIndisponivel as e:
+            print(f"ERRO caso sintético {indice}: gravação incremental indisponível ({e})")
+            todos_conferem = False
+    print("A gravação incremental confere com a gravação completa." if todos_conferem else "HÁ GRAVAÇÕES DIVERGENTES.")
+    sys.exit(0 if todos_conferem else 1)
@@ -0,0 +1,140 @@
+# utils/ptu_xpath.py
+
+"""
+Tags e expressões XPath do PTU A500 (namespace V3_0), compiladas uma única vez por processo.
+
+- TAG_*: nomes em notação Clark ('{namespace}nome'), internados, para comparar com
+  elemento.tag, filtrar iter()/iterparse e usar em find() sem dicionário de namespaces.
+- CAMINHO_*: caminhos ElementPath em notação Clark para find() com mais de um nível.
+- XPATH_*: objetos etree.XPath já compilados; chamar como função: XPATH_X(elemento).
+"""
+
+import sys
+from lxml import etree
+
+NAMESPACE_PTU = 'http://ptu.unimed.coop.br/schemas/V3_0'
+NAMESPACES = {'ptu': NAMESPACE_PTU}
+
+
+def tag_ptu(nome):
+    return sys.intern(f"{{{NAMESPACE_PTU}}}{nome}")
+
+
+def caminho_ptu(*nomes, descendente=False):
+    """Caminho ElementPath em notação Clark: caminho_ptu('a', 'b') -> '{ns}a/{ns}b' ('.//' no início se 'descendente')."""
+    caminho = "/".join(tag_ptu(nome) for nome in nomes)
+    return f".//{caminho}" if descendente else caminho
+
+
+def _xpath(expressao):
+    return etree.XPath(expressao, namespaces=NAMESPACES)
+
+
+# --- Tags ---
+TAG_CABECALHO = tag_ptu('cabecalho')
+TAG_ARQUIVO_COBRANCA = tag_ptu('arquivoCobrancaUtilizacao')
+TAG_COBRANCA = tag_ptu('Cobranca')
+TAG_DOCUMENTO1 = tag_ptu('documento1')
+TAG_DOCUMENTO2 = tag_ptu('documento2')
+TAG_TP_DOCUMENTO = tag_ptu('tp_Documento')
+TAG_NFE = tag_ptu('NFE')
+TAG_GUIA_CONSULTA = tag_ptu('guiaConsulta')
+TAG_GUIA_SADT = tag_ptu('guiaSADT')
+TAG_GUIA_INTERNACAO = tag_ptu('guiaInternacao')
+TAG_GUIA_HONORARIOS = tag_ptu('guiaHonorarios')
+TAG_DADOS_GUIA = tag_ptu('dadosGuia')
+TAG_NR_GUIAS = tag_ptu('nr_Guias')
+TAG_NR_GUIA_TISS_PRESTADOR = tag_ptu('nr_GuiaTissPrestador')
+TAG_DADOS_BENEFICIARIO = tag_ptu('dadosBeneficiario')
+TAG_ID_BENEF = tag_ptu('id_Benef')
+TAG_NM_BENEF = tag_ptu('nm_Benef')
+TAG_DADOS_INTERNACAO = tag_ptu('dadosInternacao')
+TAG_RG_INTERNACAO = tag_ptu('rg_Internacao')
+TAG_DT_CONHECIMENTO = tag_ptu('dt_Conhecimento')
+TAG_DT_PROTOCOLO = tag_ptu('dt_Protocolo')
+TAG_DT_EXECUCAO = tag_ptu('dt_Execucao')
+TAG_CONTRATADO_EXECUTANTE = tag_ptu('contratadoExecutante')
+TAG_CONTRATADO_SOLICITANTE = tag_ptu('contratadoSolicitante')
+TAG_DADOS_EXECUTANTE = tag_ptu('dadosExecutante')
+TAG_DADOS_HOSPITAL = tag_ptu('dadosHospital')
+TAG_EQUIPE_PROFISSIONAL = tag_ptu('equipe_Profissional')
+TAG_PRESTADOR_EQUIPE = tag_ptu('Prestador')
+TAG_CNES = tag_ptu('CNES')
+TAG_CD_PREST = tag_ptu('cd_Prest')
+TAG_TP_PRESTADOR = tag_ptu('tp_Prestador')
+TAG_TP_PARTICIPACAO = tag_ptu('tp_Participacao')
+TAG_PROCEDIMENTOS_EXECUTADOS = tag_ptu('procedimentosExecutados')
+TAG_PROCEDIMENTOS = tag_ptu('procedimentos')
+TAG_ID_PACOTE = tag_ptu('id_Pacote')
+TAG_CD_PACOTE = tag_ptu('cd_Pacote')
+TAG_TP_TABELA = tag_ptu('tp_Tabela')
+TAG_CD_SERVICO = tag_ptu('cd_Servico')
+TAG_VALORES = tag_ptu('valores')
+TAG_TAXAS = tag_ptu('taxas')
+TAG_VL_SERV_COBRADO = tag_ptu('vl_ServCobrado')
+TAG_VL_CO_COBRADO = tag_ptu('vl_CO_Cobrado')
+TAG_TX_ADM_SERVICO = tag_ptu('tx_AdmServico')
+TAG_TX_ADM_CO = tag_ptu('tx_AdmCO')
+TAG_HASH = tag_ptu('hash')
+
+# --- Caminhos para find() ---
+CAMINHO_UNIMED_PRESTADOR_CD_PREST = caminho_ptu('UnimedPrestador', 'cd_Prest')
+CAMINHO_PRESTADOR_TP_PRESTADOR = caminho_ptu('prestador', 'tp_Prestador')
+CAMINHO_PRESTADOR_ID_REC_PROPRIO = caminho_ptu('prestador', 'id_RecProprio')
+CAMINHO_DESC_TP_ATENDIMENTO = caminho_ptu('dadosAtendimento', 'tp_Atendimento', descendente=True)
+CAMINHO_GUIA_ID_BENEF = caminho_ptu('dadosBeneficiario', 'id_Benef')
+CAMINHO_GUIA_NR_GUIA_TISS_PRESTADOR = caminho_ptu('dadosGuia', 'nr_Guias', 'nr_GuiaTissPrestador')
+
+# --- XPath: cabeçalho ---
+# A partir da raiz do documento (extrair_dados_fatura_xml)
+XPATH_CAMPOS_CABECALHO_DOCUMENTO = (
+    ('numero_fatura', _xpath('.//ptu:cabecalho/ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:documento1/ptu:nr_Documento')),
+    ('competencia', _xpath('.//ptu:cabecalho/ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:nr_Competencia')),
+    ('codigo_unimed_destino', _xpath('.//ptu:cabecalho/ptu:unimed/ptu:cd_Uni_Destino')),
+    ('data_emissao', _xpath('.//ptu:cabecalho/ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:documento1/ptu:dt_EmissaoDoc')),
+    ('data_vencimento', _xpath('.//ptu:cabecalho/ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:documento1/ptu:dt_VencimentoDoc')),
+    ('valor_total_documento', _xpath('.//ptu:cabecalho/ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:documento1/ptu:vl_TotalDoc')),
+)
+# Relativos a <ptu:cabecalho> (leitura em streaming), na mesma ordem
+XPATH_CAMPOS_CABECALHO = (
+    ('numero_fatura', _xpath('./ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:documento1/ptu:nr_Documento')),
+    ('competencia', _xpath('./ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:nr_Competencia')),
+    ('codigo_unimed_destino', _xpath('./ptu:unimed/ptu:cd_Uni_Destino')),
+    ('data_emissao', _xpath('./ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:documento1/ptu:dt_EmissaoDoc')),
+    ('data_vencimento', _xpath('./ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:documento1/ptu:dt_VencimentoDoc')),
+    ('valor_total_documento', _xpath('./ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:documento1/ptu:vl_TotalDoc')),
+)
+
+# --- XPath: guias de internação ---
+XPATH_GUIAS_INTERNACAO = _xpath('.//ptu:guiaInternacao')
+XPATH_GUIA_NR_GUIA_TISS_PRESTADOR = _xpath('./ptu:dadosGuia/ptu:nr_Guias/ptu:nr_GuiaTissPrestador')
+XPATH_GUIA_ID_BENEF = _xpath('./ptu:dadosBeneficiario/ptu:id_Benef')
+XPATH_GUIA_NM_BENEF = _xpath('./ptu:dadosBeneficiario/ptu:nm_Benef')
+XPATH_GUIA_RG_INTERNACAO = _xpath('./ptu:dadosInternacao/ptu:rg_Internacao')
+XPATH_GUIA_PROCEDIMENTOS_EXECUTADOS_DIRETOS = _xpath('./ptu:dadosGuia/ptu:procedimentosExecutados')
+XPATH_DESC_PROCEDIMENTOS_EXECUTADOS = _xpath('.//ptu:procedimentosExecutados')
+XPATH_PROC_TP_TABELA = _xpath('.//ptu:procedimentos/ptu:tp_Tabela')
+XPATH_PROC_CD_SERVICO = _xpath('.//ptu:procedimentos/ptu:cd_Servico')
+XPATH_PROC_VL_SERV_COBRADO = _xpath('.//ptu:valores/ptu:vl_ServCobrado')
+XPATH_PROC_TX_ADM_SERVICO = _xpath('.//ptu:taxas/ptu:tx_AdmServico')
+XPATH_PROC_VL_CO_COBRADO = _xpath('.//ptu:valores/ptu:vl_CO_Cobrado')
+XPATH_PROC_TX_ADM_CO = _xpath('.//ptu:taxas/ptu:tx_AdmCO')
+
+# --- Tags lidas pela importação (nome local, incluindo as do caminho até cada campo) ---
+# Comparadas com regras_config.TAGS_ALTERADAS_POR_REGRA para saber se a importação depende das regras
+TAGS_LIDAS_CABECALHO = frozenset((
+    'cabecalho', 'GuiasCobrancaUtilizacao', 'Cobranca', 'documento1', 'nr_Documento', 'nr_Competencia',
+    'unimed', 'cd_Uni_Destino', 'dt_EmissaoDoc', 'dt_VencimentoDoc', 'vl_TotalDoc',
+))
+TAGS_LIDAS_GUIAS_INTERNACAO = frozenset((
+    'guiaInternacao', 'dadosGuia', 'nr_Guias', 'nr_GuiaTissPrestador', 'dadosBeneficiario', 'id_Benef', 'nm_Benef',
+    'dadosInternacao', 'rg_Internacao', 'procedimentosExecutados', 'procedimentos', 'tp_Tabela', 'cd_Servico',
+    'valores', 'vl_ServCobrado', 'vl_CO_Cobrado', 'taxas', 'tx_AdmServico', 'tx_AdmCO',
+))
+
+# --- XPath: regras de negócio (os caminhos de cada regra vêm de core/regras_config.py) ---
+XPATH_GUIA_ANCESTRAL = _xpath('ancestor::ptu:guiaConsulta | ancestor::ptu:guiaSADT | ancestor::ptu:guiaInternacao | ancestor::ptu:guiaHonorarios')
+
+# --- XPath: hash ---
+XPATH_HASH_PTUA500 = _xpath('/ptu:ptuA500/ptu:hash')
+XPATH_RAIZ_PTUA500 = _xpath('/ptu:ptuA500')
@@ -0,0 +1,158 @@
+# utils/rastreamento.py
+
+"""
+Rastreamento estruturado por canal (parser, regras, hash, zip) para diagnóstico.
+
+Cada canal fica desligado por padrão. Desligado, não formata nada: quem chama testa
+'canal.ativo' antes de montar os campos, então o custo no laço é uma leitura de atributo.
+
+    _RASTRO = rastreamento.obter_canal(rastreamento.CANAL_PARSER)
+    if _RASTRO.ativo: _RASTRO.registrar("procedimento", guia=nr_guia, tp_tabela=tp_tabela)
+
+Ligado, cada chamada vira uma linha JSON em um arquivo rotativo (logs/rastreamento.jsonl).
+Os canais podem ser ligados por código (habilitar_canais) ou pela variável de ambiente
+AUDITPLUS_RASTREAMENTO, ex: "parser,hash" ou "todos". A variável também vale para os
+processos da importação paralela, que escrevem em arquivos próprios (sufixo com o PID).
+"""
+
+import os
+import json
+import logging
+import multiprocessing
+from logging.handlers import RotatingFileHandler
+
+CANAL_PARSER = "parser"
+CANAL_REGRAS = "regras"
+CANAL_HASH = "hash"
+CANAL_ZIP = "zip"
+CANAIS_DISPONIVEIS = (CANAL_PARSER, CANAL_REGRAS, CANAL_HASH, CANAL_ZIP)
+
+VARIAVEL_AMBIENTE_CANAIS = "AUDITPLUS_RASTREAMENTO"
+VARIAVEL_AMBIENTE_ARQUIVO = "AUDITPLUS_RASTREAMENTO_ARQUIVO"
+ARQUIVO_RASTREAMENTO_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'logs', 'rastreamento.jsonl')
+TAMANHO_MAXIMO_ARQUIVO = 10 * 1024 * 1024
+QUANTIDADE_ARQUIVOS_ROTACAO = 5
+
+_NOME_LOGGER_BASE = "auditplus.rastreamento"
+
+
+class _FormatadorJsonLinhas(logging.Formatter):
+    """Uma linha JSON por evento: instante, canal, evento, PID e os campos informados."""
+
+    def format(self, record):
+        registro = {
+            "ts": round(record.created, 6),
+            "canal": record.canal,
+            "evento": record.msg,
+            "pid": record.process,
+        }
+        registro.update(record.campos)
+        return json.dumps(registro, ensure_ascii=False, default=str)
+
+
+class CanalRastreamento:
+    __slots__ = ("nome", "ativo", "_logger")
+
+    def __init__(self, nome):
+        self.nome = nome
+        self.ativo = False
+        self._logger = logging.getLogger(f"{_NOME_LOGGER_BASE}.{nome}")
+
+    def registrar(self, evento, **campos):
+        if not self.ativo:
+            return
+        self._logger.info(evento, extra={"canal": self.nome, "campos": campos})
+
+
+_canais = {nome: CanalRastreamento(nome) for nome in CANAIS_DISPONIVEIS}
+_handler_arquivo = None
+_caminho_arquivo_base = None
+
+
+def obter_canal(nome):
+    """Retorna o canal pelo nome. O objeto é sempre o mesmo, então pode ser guardado em variável de módulo."""
+    if nome not in _canais:
+        raise ValueError(f"Canal de rastreamento desconhecido: '{nome}'. Disponíveis: {', '.join(CANAIS_DISPONIVEIS)}")
+    return _canais[nome]
+
+
+def _caminho_arquivo_do_processo(caminho_arquivo, processo_filho=False):
+    # Processos filhos (importação paralela) não podem rotacionar o mesmo arquivo do processo principal
+    if not processo_filho and multiprocessing.parent_process() is None:
+        return caminho_arquivo
+    raiz, extensao = os.path.splitext(caminho_arquivo)
+    return f"{raiz}.{os.getpid()}{extensao}"
+
+
+def _garantir_handler_arquivo(caminho_arquivo=None, processo_filho=False):
+    global _handler_arquivo, _caminho_arquivo_base
+    if _handler_arquivo is not None:
+        return
+    _caminho_arquivo_base = os.path.abspath(caminho_arquivo or ARQUIVO_RASTREAMENTO_PADRAO)
+    caminho_arquivo = _caminho_arquivo_do_processo(_caminho_arquivo_base, processo_filho)
+    os.makedirs(os.path.dirname(caminho_arquivo), exist_ok=True)
+
+    handler = RotatingFileHandler(caminho_arquivo, maxBytes=TAMANHO_MAXIMO_ARQUIVO,
+                                  backupCount=QUANTIDADE_ARQUIVOS_ROTACAO, encoding='utf-8', delay=True)
+    handler.setFormatter(_FormatadorJsonLinhas())
+    logger_base = logging.getLogger(_NOME_LOGGER_BASE)
+    logger_base.addHandler(handler)
+    logger_base.setLevel(logging.INFO)
+    logger_base.propagate = False # Não repete o rastreamento no console
+    _handler_arquivo = handler
+
+
+def _reabrir_arquivo_no_processo_filho():
+    """Após um fork (pool da importação no Linux), troca o handler herdado por um arquivo próprio do filho."""
+    global _handler_arquivo
+    if _handler_arquivo is None:
+        return
+    logging.getLogger(_NOME_LOGGER_BASE).removeHandler(_handler_arquivo)
+    _handler_arquivo = None
+    _garantir_handler_arquivo(_caminho_arquivo_base, processo_filho=True)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reabrir_arquivo_no_processo_filho)
+
+
+def habilitar_canais(nomes, caminho_arquivo=None):
+    """
+    Liga os canais informados ("todos" liga todos). 'caminho_arquivo' só tem efeito
+    na primeira habilitação do processo; depois o arquivo já está aberto.
+    """
+    if isinstance(nomes, str):
+        nomes = [nomes]
+    if "todos" in nomes:
+        nomes = CANAIS_DISPONIVEIS
+    canais = [obter_canal(nome) for nome in nomes]
+    _garantir_handler_arquivo(caminho_arquivo)
+    for canal in canais:
+        canal.ativo = True
+
+
+def desabilitar_canais(nomes=None):
+    """Desliga os canais informados, ou todos se 'nomes' for None."""
+    if isinstance(nomes, str):
+        nomes = [nomes]
+    for nome in (nomes or CANAIS_DISPONIVEIS):
+        obter_canal(nome).ativo = False
+
+
+def canais_ativos():
+    return [nome for nome, canal in _canais.items() if canal.ativo]
+
+
+def _configurar_pelo_ambiente():
+    valor = os.environ.get(VARIAVEL_AMBIENTE_CANAIS, "").strip()
+    if not valor:
+        return
+    nomes = [nome.strip().lower() for nome in valor.split(",") if nome.strip()]
+    nomes_validos = [nome for nome in nomes if nome == "todos" or nome in _canais]
+    for nome in set(nomes) - set(nomes_validos):
+        logging.warning(f"Canal de rastreamento desconhecido em {VARIAVEL_AMBIENTE_CANAIS}: '{nome}'. Ignorado.")
+    if nomes_validos:
+        habilitar_canais(nomes_validos, os.environ.get(VARIAVEL_AMBIENTE_ARQUIVO) or None)
+
+
+_configurar_pelo_ambiente()
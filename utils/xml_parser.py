@@ -5,32 +5,75 @@ import os
 import json
 import logging
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - (xml_parser) - %(message)s')
-NAMESPACES = {'ptu': 'http://ptu.unimed.coop.br/schemas/V3_0'}
+try:
+    from utils import rastreamento
+    from utils import ptu_xpath
+except ImportError:
+    import rastreamento
+    import ptu_xpath
 
-def extrair_dados_fatura_xml(caminho_arquivo_xml):
-    nome_base_arquivo = os.path.basename(caminho_arquivo_xml)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - (xml_parser) - %(message)s')
+NAMESPACES = ptu_xpath.NAMESPACES
+_RASTRO = rastreamento.obter_canal(rastreamento.CANAL_PARSER)
+
+def carregar_arvore_xml(origem_xml, nome_arquivo=None):
+    """
+    Faz o parse de um arquivo PTU com as mesmas opções usadas pelas regras de negócio.
+    'origem_xml' pode ser um caminho ou um stream aberto (ex: membro de um ZIP); neste
+    caso 'nome_arquivo' é registrado na árvore para aparecer nas mensagens de log.
+    Retorna o ElementTree; erros de sintaxe são propagados para quem chamou.
+    """
+    parser_xml = etree.XMLParser(recover=True, strip_cdata=False, resolve_entities=False)
+    return etree.parse(origem_xml, parser=parser_xml, base_url=nome_arquivo)
+
+def is_arvore_ja_carregada(origem_xml):
+    """True se 'origem_xml' já é uma árvore parseada (ElementTree ou elemento), e não um caminho."""
+    return isinstance(origem_xml, (etree._Element, etree._ElementTree))
+
+def nome_base_origem(origem_xml):
+    """
+    Nome do arquivo de 'origem_xml' para mensagens de log e rastreamento, seja a origem um caminho
+    ou uma árvore (ou raiz) já carregada; para a árvore vale a URL registrada no parse
+    (ver carregar_arvore_xml), ou "<arvore em memoria>" sem ela.
+    """
+    if not is_arvore_ja_carregada(origem_xml):
+        return os.path.basename(origem_xml)
+    arvore = origem_xml if isinstance(origem_xml, etree._ElementTree) else origem_xml.getroottree()
+    url = arvore.docinfo.URL
+    return os.path.basename(url) if url else "<arvore em memoria>"
+
+def obter_raiz(origem_xml):
+    """
+    Aceita um caminho de arquivo, um ElementTree ou um elemento raiz já parseado.
+    Retorna a raiz (a própria árvore, sem novo parse, quando já carregada), ou None se o arquivo
+    não existir.
+    """
+    if isinstance(origem_xml, etree._ElementTree):
+        return origem_xml.getroot()
+    if isinstance(origem_xml, etree._Element):
+        return origem_xml
+    if not os.path.exists(origem_xml):
+        logging.error(f"Arquivo XML não encontrado em '{origem_xml}'")
+        return None
+    parser_xml = etree.XMLParser(recover=True)
+    return etree.parse(origem_xml, parser=parser_xml).getroot()
+
+def extrair_dados_fatura_xml(origem_xml):
+    """
+    Lê os dados do cabeçalho da fatura.
+    'origem_xml' pode ser o caminho do .051 ou a raiz (ou ElementTree) já parseada,
+    o que permite reaproveitar a árvore usada pelas regras de negócio.
+    """
+    nome_base_arquivo = nome_base_origem(origem_xml)
     dados_fatura = {}
     try:
-        if not os.path.exists(caminho_arquivo_xml):
-            logging.error(f"Arquivo XML não encontrado em '{caminho_arquivo_xml}'")
-            return None
-        parser_xml = etree.XMLParser(recover=True)
-        arvore_xml = etree.parse(caminho_arquivo_xml, parser=parser_xml)
-        raiz = arvore_xml.getroot()
-
-        def _obter_texto(elemento_pai, xpath_expr):
-            elemento_lista = elemento_pai.xpath(xpath_expr, namespaces=NAMESPACES)
-            if elemento_lista and elemento_lista[-1].text is not None:
-                return elemento_lista[-1].text.strip()
+        raiz = obter_raiz(origem_xml)
+        if raiz is None:
             return None
 
-        dados_fatura['numero_fatura'] = _obter_texto(raiz, './/ptu:cabecalho/ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:documento1/ptu:nr_Documento')
-        dados_fatura['competencia'] = _obter_texto(raiz, './/ptu:cabecalho/ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:nr_Competencia')
-        dados_fatura['codigo_unimed_destino'] = _obter_texto(raiz, './/ptu:cabecalho/ptu:unimed/ptu:cd_Uni_Destino')
-        dados_fatura['data_emissao'] = _obter_texto(raiz, './/ptu:cabecalho/ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:documento1/ptu:dt_EmissaoDoc')
-        dados_fatura['data_vencimento'] = _obter_texto(raiz, './/ptu:cabecalho/ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:documento1/ptu:dt_VencimentoDoc')
-        dados_fatura['valor_total_documento'] = _obter_texto(raiz, './/ptu:cabecalho/ptu:GuiasCobrancaUtilizacao/ptu:Cobranca/ptu:documento1/ptu:vl_TotalDoc')
+        for campo, xpath_campo in ptu_xpath.XPATH_CAMPOS_CABECALHO_DOCUMENTO:
+            elemento_lista = xpath_campo(raiz)
+            dados_fatura[campo] = elemento_lista[-1].text.strip() if elemento_lista and elemento_lista[-1].text is not None else None
         return dados_fatura
     except etree.XMLSyntaxError as exsyn:
         logging.error(f"O arquivo XML '{nome_base_arquivo}' está mal formado. Detalhes: {exsyn}")
@@ -39,6 +82,51 @@ def extrair_dados_fatura_xml(caminho_arquivo_xml):
         logging.exception(f"Erro inesperado ao processar cabeçalho do XML '{nome_base_arquivo}': {e}")
         return None
 
+# Campos do cabeçalho, relativos a <ptu:cabecalho>, na mesma ordem de extrair_dados_fatura_xml
+_CAMPOS_CABECALHO = ptu_xpath.XPATH_CAMPOS_CABECALHO
+_TAG_CABECALHO = ptu_xpath.TAG_CABECALHO
+_TAG_ARQUIVO_COBRANCA = ptu_xpath.TAG_ARQUIVO_COBRANCA
+
+def extrair_dados_cabecalho_streaming(origem_xml, nome_arquivo=None):
+    """
+    Versão em streaming de extrair_dados_fatura_xml: lê o arquivo com iterparse e para
+    assim que </ptu:cabecalho> fecha, sem montar o restante da árvore. O tempo não depende
+    do tamanho do arquivo, já que o cabeçalho fica no início do .051.
+    'origem_xml' pode ser um caminho ou um stream binário (ex: membro aberto de um ZIP).
+    Retorna o mesmo dicionário de extrair_dados_fatura_xml, ou None em caso de erro.
+    """
+    nome_base_arquivo = nome_arquivo or (os.path.basename(origem_xml) if isinstance(origem_xml, str) else "<stream>")
+    try:
+        if isinstance(origem_xml, str):
+            if not os.path.exists(origem_xml):
+                logging.error(f"Arquivo XML não encontrado em '{origem_xml}'")
+                return None
+            with open(origem_xml, 'rb') as arquivo_xml:
+                return _ler_cabecalho_iterparse(arquivo_xml)
+        return _ler_cabecalho_iterparse(origem_xml)
+    except etree.XMLSyntaxError as exsyn:
+        logging.error(f"O arquivo XML '{nome_base_arquivo}' está mal formado. Detalhes: {exsyn}")
+        return None
+    except Exception as e:
+        logging.exception(f"Erro inesperado ao processar cabeçalho do XML '{nome_base_arquivo}': {e}")
+        return None
+
+def _ler_cabecalho_iterparse(stream_xml):
+    dados_fatura = {campo: None for campo, _ in _CAMPOS_CABECALHO}
+    contexto = etree.iterparse(stream_xml, events=('start', 'end'), recover=True,
+                               tag=(_TAG_CABECALHO, _TAG_ARQUIVO_COBRANCA))
+    for evento, elemento in contexto:
+        if elemento.tag == _TAG_ARQUIVO_COBRANCA:
+            # As guias começaram sem nenhum cabeçalho antes: não há o que ler.
+            break
+        if evento == 'end':
+            for campo, xpath_campo in _CAMPOS_CABECALHO:
+                elemento_lista = xpath_campo(elemento)
+                if elemento_lista and elemento_lista[-1].text is not None:
+                    dados_fatura[campo] = elemento_lista[-1].text.strip()
+            break
+    return dados_fatura
+
 def _try_parse_float(valor_str, nome_campo="valor", guia_id="N/A", arquivo_base="N/A"):
     if valor_str is None:
         return 0.0
@@ -48,87 +136,77 @@ def _try_parse_float(valor_str, nome_campo="valor", guia_id="N/A", arquivo_base=
         logging.warning(f"'{nome_campo}' inválido ('{valor_str}') na guia '{guia_id}' do arquivo '{arquivo_base}'. Tratado como 0.0.")
         return 0.0
 
-def extrair_guias_internacao_relevantes(caminho_arquivo_xml, numero_fatura_pai, 
+def extrair_guias_internacao_relevantes(origem_xml, numero_fatura_pai, 
                                         codigos_hm_t00_a_ignorar, # Nome do parâmetro ajustado para corresponder à chamada
                                         valor_minimo_guia=25000.0):
-    nome_base_arquivo = os.path.basename(caminho_arquivo_xml)
-    print(f"--- XML Parser: Iniciando extração em '{nome_base_arquivo}' para Fatura '{numero_fatura_pai}'. Filtro >= {valor_minimo_guia:.2f} ---")
+    """
+    Extrai as guias de internação cujo valor para filtro atinge 'valor_minimo_guia'.
+    'origem_xml' pode ser o caminho do .051 ou a raiz (ou ElementTree) já parseada.
+    """
+    nome_base_arquivo = nome_base_origem(origem_xml)
+    if _RASTRO.ativo: _RASTRO.registrar("extracao_guias_inicio", arquivo=nome_base_arquivo, fatura=numero_fatura_pai, valor_minimo=valor_minimo_guia)
 
     guias_internacao_filtradas = []
     map_tipo_internacao = { "1": "Hospitalar", "2": "Hospital-dia", "3": "Domiciliar" }
 
     try:
-        if not os.path.exists(caminho_arquivo_xml):
-            logging.error(f"Arquivo XML '{caminho_arquivo_xml}' não encontrado.")
+        raiz = obter_raiz(origem_xml)
+        if raiz is None:
             return []
-
-        parser_xml = etree.XMLParser(recover=True)
-        arvore_xml = etree.parse(caminho_arquivo_xml, parser=parser_xml)
-        raiz = arvore_xml.getroot()
-        guias_internacao_xml = raiz.xpath('.//ptu:guiaInternacao', namespaces=NAMESPACES)
-
-        print(f"!!! DEBUG PRINT (XML Parser) !!! XML: {nome_base_arquivo}, Guias <ptu:guiaInternacao> encontradas: {len(guias_internacao_xml)}")
+        guias_internacao_xml = ptu_xpath.XPATH_GUIAS_INTERNACAO(raiz)
+        if _RASTRO.ativo: _RASTRO.registrar("guias_internacao_encontradas", arquivo=nome_base_arquivo, quantidade=len(guias_internacao_xml))
 
         if not guias_internacao_xml:
             logging.info(f"Nenhuma tag <ptu:guiaInternacao> encontrada em '{nome_base_arquivo}'.")
-            print(f"!!! DEBUG PRINT (XML Parser) !!! Nenhuma tag <ptu:guiaInternacao> encontrada em '{nome_base_arquivo}'.")
             return []
 
         for i, guia_xml_node in enumerate(guias_internacao_xml):
             valor_total_guia_calc_para_filtro = 0.0
             valor_total_real_da_guia = 0.0
 
-            nr_guia_node = guia_xml_node.xpath('./ptu:dadosGuia/ptu:nr_Guias/ptu:nr_GuiaTissPrestador', namespaces=NAMESPACES)
+            nr_guia_node = ptu_xpath.XPATH_GUIA_NR_GUIA_TISS_PRESTADOR(guia_xml_node)
             nr_guia = nr_guia_node[-1].text.strip() if nr_guia_node and nr_guia_node[-1].text is not None else f"GuiaDesconhecida_{i+1}"
 
-            id_benef_node = guia_xml_node.xpath('./ptu:dadosBeneficiario/ptu:id_Benef', namespaces=NAMESPACES)
+            id_benef_node = ptu_xpath.XPATH_GUIA_ID_BENEF(guia_xml_node)
             codigo_beneficiario = id_benef_node[-1].text.strip() if id_benef_node and id_benef_node[-1].text is not None else ""
 
-            nm_benef_node = guia_xml_node.xpath('./ptu:dadosBeneficiario/ptu:nm_Benef', namespaces=NAMESPACES)
+            nm_benef_node = ptu_xpath.XPATH_GUIA_NM_BENEF(guia_xml_node)
             nome_beneficiario = nm_benef_node[-1].text.strip() if nm_benef_node and nm_benef_node[-1].text is not None else ""
 
-            rg_internacao_node = guia_xml_node.xpath('./ptu:dadosInternacao/ptu:rg_Internacao', namespaces=NAMESPACES)
+            rg_internacao_node = ptu_xpath.XPATH_GUIA_RG_INTERNACAO(guia_xml_node)
             rg_internacao_cod = rg_internacao_node[-1].text.strip() if rg_internacao_node and rg_internacao_node[-1].text is not None else ""
             tipo_internacao_desc = map_tipo_internacao.get(rg_internacao_cod, f"Cod:{rg_internacao_cod}")
 
-            if nome_base_arquivo == "N0183113.051" and nr_guia == "255521452": 
-                print(f"\n!!! DEBUG XML SNIPPET for {nome_base_arquivo}, Guia {nr_guia} !!!")
-                try:
-                    print(etree.tostring(guia_xml_node, pretty_print=True).decode('utf-8')) # type: ignore
-                except Exception as e_tostring:
-                    print(f"Erro ao tentar converter guia_xml_node para string: {e_tostring}")
-                print("!!! END DEBUG XML SNIPPET !!!\n")
 
-            procedimentos_executados_nodes = guia_xml_node.xpath('./ptu:dadosGuia/ptu:procedimentosExecutados', namespaces=NAMESPACES)
+            procedimentos_executados_nodes = ptu_xpath.XPATH_GUIA_PROCEDIMENTOS_EXECUTADOS_DIRETOS(guia_xml_node)
             if not procedimentos_executados_nodes:
-                procedimentos_executados_nodes = guia_xml_node.xpath('.//ptu:procedimentosExecutados', namespaces=NAMESPACES)
+                procedimentos_executados_nodes = ptu_xpath.XPATH_DESC_PROCEDIMENTOS_EXECUTADOS(guia_xml_node)
 
             for j, proc_exec_node in enumerate(procedimentos_executados_nodes):
                 valor_procedimento_atual_para_soma = 0.0
 
-                tp_tabela_node = proc_exec_node.xpath('.//ptu:procedimentos/ptu:tp_Tabela', namespaces=NAMESPACES)
+                tp_tabela_node = ptu_xpath.XPATH_PROC_TP_TABELA(proc_exec_node)
                 tp_Tabela_atual = tp_tabela_node[-1].text.strip() if tp_tabela_node and tp_tabela_node[-1].text is not None else None
 
-                cd_servico_node = proc_exec_node.xpath('.//ptu:procedimentos/ptu:cd_Servico', namespaces=NAMESPACES)
+                cd_servico_node = ptu_xpath.XPATH_PROC_CD_SERVICO(proc_exec_node)
                 cd_Servico_atual = cd_servico_node[-1].text.strip() if cd_servico_node and cd_servico_node[-1].text is not None else None
-                print(f"       !!! DEBUG PRINT (XML Parser) !!! Guia '{nr_guia}', ProcExec {j+1}: tp_Tabela = {tp_Tabela_atual}, cd_Servico = {cd_Servico_atual}")
 
-                vl_serv_node_list = proc_exec_node.xpath('.//ptu:valores/ptu:vl_ServCobrado', namespaces=NAMESPACES)
+                vl_serv_node_list = ptu_xpath.XPATH_PROC_VL_SERV_COBRADO(proc_exec_node)
                 if vl_serv_node_list and vl_serv_node_list[-1].text is not None:
                     valor_serv = _try_parse_float(vl_serv_node_list[-1].text, "vl_ServCobrado", nr_guia, nome_base_arquivo)
                     valor_procedimento_atual_para_soma += valor_serv
 
-                tx_adm_node_list = proc_exec_node.xpath('.//ptu:taxas/ptu:tx_AdmServico', namespaces=NAMESPACES)
+                tx_adm_node_list = ptu_xpath.XPATH_PROC_TX_ADM_SERVICO(proc_exec_node)
                 if tx_adm_node_list and tx_adm_node_list[-1].text is not None:
                     valor_taxa = _try_parse_float(tx_adm_node_list[-1].text, "tx_AdmServico", nr_guia, nome_base_arquivo)
                     valor_procedimento_atual_para_soma += valor_taxa
 
-                vl_co_node_list = proc_exec_node.xpath('.//ptu:valores/ptu:vl_CO_Cobrado', namespaces=NAMESPACES)
+                vl_co_node_list = ptu_xpath.XPATH_PROC_VL_CO_COBRADO(proc_exec_node)
                 if vl_co_node_list and vl_co_node_list[-1].text is not None:
                     valor_co = _try_parse_float(vl_co_node_list[-1].text, "vl_CO_Cobrado", nr_guia, nome_base_arquivo)
                     valor_procedimento_atual_para_soma += valor_co
                 
-                tx_adm_co_node_list = proc_exec_node.xpath('.//ptu:taxas/ptu:tx_AdmCO', namespaces=NAMESPACES)
+                tx_adm_co_node_list = ptu_xpath.XPATH_PROC_TX_ADM_CO(proc_exec_node)
                 if tx_adm_co_node_list and tx_adm_co_node_list[-1].text is not None:
                     valor_taxa_co = _try_parse_float(tx_adm_co_node_list[-1].text, "tx_AdmCO", nr_guia, nome_base_arquivo)
                     valor_procedimento_atual_para_soma += valor_taxa_co
@@ -146,22 +224,25 @@ def extrair_guias_internacao_relevantes(caminho_arquivo_xml, numero_fatura_pai,
                     motivo_filtro = f"HM Tabela 00 (Cód: {cd_Servico_atual})"
                 
                 if procedimento_ignorado_para_filtro:
-                    logging.debug(f"Guia '{nr_guia}', Proc {j+1} (Tab:{tp_Tabela_atual}, Cód:{cd_Servico_atual}), Vlr {valor_procedimento_atual_para_soma:.2f} IGNORADO V_Filtro ({motivo_filtro}).")
-                    print(f"       !!! DEBUG PRINT (XML Parser) !!! Guia '{nr_guia}', ProcExec {j+1}: {motivo_filtro} -> IGNORADO para FILTRO")
+                    decisao_filtro = f"ignorado ({motivo_filtro})"
+                elif tp_Tabela_atual in ['00', '18', '19', '20']:
+                    valor_total_guia_calc_para_filtro += valor_procedimento_atual_para_soma
+                    decisao_filtro = "somado"
                 else:
-                    if tp_Tabela_atual in ['00', '18', '19', '20']:
-                        valor_total_guia_calc_para_filtro += valor_procedimento_atual_para_soma
-                        logging.debug(f"Guia '{nr_guia}', Proc {j+1} (Tab:{tp_Tabela_atual}, Cód:{cd_Servico_atual}), Vlr {valor_procedimento_atual_para_soma:.2f} SOMADO ao V_Filtro.")
-                        print(f"       !!! DEBUG PRINT (XML Parser) !!! Guia '{nr_guia}', ProcExec {j+1}: Tabela {tp_Tabela_atual} ({cd_Servico_atual}) -> SOMADO ao FILTRO (Valor: {valor_procedimento_atual_para_soma:.2f})")
-                    else:
-                        logging.debug(f"Guia '{nr_guia}', Proc {j+1} (Tab:{tp_Tabela_atual}, Cód:{cd_Servico_atual}), Vlr {valor_procedimento_atual_para_soma:.2f} NÃO SOMADO ao V_Filtro (Tabela não é 00,18,19,20 ou ignorada).")
-                        print(f"       !!! DEBUG PRINT (XML Parser) !!! Guia '{nr_guia}', ProcExec {j+1}: Tabela {tp_Tabela_atual} ({cd_Servico_atual}) -> NÃO SOMADO ao V_Filtro (Tabela não explicitamente considerada nem ignorada)")
-                
-                print(f"     !!! DEBUG PRINT (XML Parser) !!! Guia '{nr_guia}', ProcExec {j+1}: Valor TOTAL DESTE PROCEDIMENTO = {valor_procedimento_atual_para_soma:.2f}. Totais da GUIA -> Filtro: {valor_total_guia_calc_para_filtro:.2f}, Real: {valor_total_real_da_guia:.2f}")
-            
-            print(f"!!! DEBUG PRINT (XML Parser) !!! DETALHE GUIA (FIM): Guia '{nr_guia}' (FP: {numero_fatura_pai}), Benef: {codigo_beneficiario}, Nome: {nome_beneficiario}, V_Filtro: {valor_total_guia_calc_para_filtro:.2f}, V_Real: {valor_total_real_da_guia:.2f}, TipoIntern: {tipo_internacao_desc}")
+                    decisao_filtro = "nao_somado"
 
-            if valor_total_guia_calc_para_filtro >= valor_minimo_guia:
+                if _RASTRO.ativo: _RASTRO.registrar("procedimento", arquivo=nome_base_arquivo, guia=nr_guia, indice=j+1,
+                                                    tp_tabela=tp_Tabela_atual, cd_servico=cd_Servico_atual,
+                                                    valor=valor_procedimento_atual_para_soma, decisao_filtro=decisao_filtro,
+                                                    total_filtro=valor_total_guia_calc_para_filtro, total_real=valor_total_real_da_guia)
+
+            guia_relevante = valor_total_guia_calc_para_filtro >= valor_minimo_guia
+            if _RASTRO.ativo: _RASTRO.registrar("guia", arquivo=nome_base_arquivo, fatura=numero_fatura_pai, guia=nr_guia,
+                                                beneficiario=codigo_beneficiario, tipo_internacao=tipo_internacao_desc,
+                                                valor_filtro=valor_total_guia_calc_para_filtro,
+                                                valor_real=valor_total_real_da_guia, adicionada=guia_relevante)
+
+            if guia_relevante:
                 guia_info = {
                     "fatura_pai": numero_fatura_pai,
                     "numero_guia": nr_guia,
@@ -172,7 +253,6 @@ def extrair_guias_internacao_relevantes(caminho_arquivo_xml, numero_fatura_pai,
                     "valor_total_real": valor_total_real_da_guia
                 }
                 guias_internacao_filtradas.append(guia_info)
-                print(f"!!! DEBUG PRINT (XML Parser) !!! GUIA ADICIONADA: Guia '{nr_guia}' (FP: {numero_fatura_pai}) ADICIONADA (Valor p/ Filtro: {valor_total_guia_calc_para_filtro:.2f})")
         
         return guias_internacao_filtradas
 
@@ -183,6 +263,176 @@ def extrair_guias_internacao_relevantes(caminho_arquivo_xml, numero_fatura_pai,
         logging.exception(f"Erro inesperado ao processar guias de internação em '{nome_base_arquivo}': {e}")
         return []
 
+_TAG_GUIA_INTERNACAO = ptu_xpath.TAG_GUIA_INTERNACAO
+_TAG_PROCEDIMENTOS_EXECUTADOS = ptu_xpath.TAG_PROCEDIMENTOS_EXECUTADOS
+# Campos da guia: tag -> (caminho de ancestrais até a guia, chave no estado da guia)
+_CAMPOS_GUIA_STREAMING = {
+    ptu_xpath.TAG_NR_GUIA_TISS_PRESTADOR: ((ptu_xpath.TAG_NR_GUIAS, ptu_xpath.TAG_DADOS_GUIA), 'nr_guia'),
+    ptu_xpath.TAG_ID_BENEF: ((ptu_xpath.TAG_DADOS_BENEFICIARIO,), 'id_benef'),
+    ptu_xpath.TAG_NM_BENEF: ((ptu_xpath.TAG_DADOS_BENEFICIARIO,), 'nm_benef'),
+    ptu_xpath.TAG_RG_INTERNACAO: ((ptu_xpath.TAG_DADOS_INTERNACAO,), 'rg_internacao'),
+}
+# Campos do procedimento: tag -> (tag do pai imediato, chave no estado do procedimento)
+_CAMPOS_PROCEDIMENTO_STREAMING = {
+    ptu_xpath.TAG_TP_TABELA: (ptu_xpath.TAG_PROCEDIMENTOS, 'tp_tabela'),
+    ptu_xpath.TAG_CD_SERVICO: (ptu_xpath.TAG_PROCEDIMENTOS, 'cd_servico'),
+    ptu_xpath.TAG_VL_SERV_COBRADO: (ptu_xpath.TAG_VALORES, 'vl_serv'),
+    ptu_xpath.TAG_TX_ADM_SERVICO: (ptu_xpath.TAG_TAXAS, 'tx_adm'),
+    ptu_xpath.TAG_VL_CO_COBRADO: (ptu_xpath.TAG_VALORES, 'vl_co'),
+    ptu_xpath.TAG_TX_ADM_CO: (ptu_xpath.TAG_TAXAS, 'tx_adm_co'),
+}
+_TAG_DADOS_GUIA = ptu_xpath.TAG_DADOS_GUIA
+
+def extrair_guias_internacao_streaming(origem_xml, numero_fatura_pai, codigos_hm_t00_a_ignorar,
+                                       valor_minimo_guia=25000.0, nome_arquivo=None):
+    """
+    Versão em streaming de extrair_guias_internacao_relevantes, com memória constante.
+    Percorre o documento uma única vez com iterparse, guardando apenas o estado da guia de
+    internação e dos procedimentos abertos, e descarta cada subárvore assim que ela fecha.
+    Produz os mesmos dicionários de guia (inclusive a ordem das somas de 'valor_filtro' e
+    'valor_total_real'). 'origem_xml' pode ser um caminho ou um stream binário.
+    """
+    nome_base_arquivo = nome_arquivo or (os.path.basename(origem_xml) if isinstance(origem_xml, str) else "<stream>")
+    if _RASTRO.ativo: _RASTRO.registrar("extracao_guias_inicio", arquivo=nome_base_arquivo, fatura=numero_fatura_pai,
+                                        valor_minimo=valor_minimo_guia, modo="streaming")
+    try:
+        if isinstance(origem_xml, str):
+            if not os.path.exists(origem_xml):
+                logging.error(f"Arquivo XML '{origem_xml}' não encontrado.")
+                return []
+            with open(origem_xml, 'rb') as arquivo_xml:
+                return _percorrer_guias_internacao(arquivo_xml, numero_fatura_pai, codigos_hm_t00_a_ignorar,
+                                                   valor_minimo_guia, nome_base_arquivo)
+        return _percorrer_guias_internacao(origem_xml, numero_fatura_pai, codigos_hm_t00_a_ignorar,
+                                           valor_minimo_guia, nome_base_arquivo)
+    except etree.XMLSyntaxError as exsyn:
+        logging.error(f"O arquivo XML '{nome_base_arquivo}' (guias) está mal formado. Detalhes: {exsyn}")
+        return []
+    except Exception as e:
+        logging.exception(f"Erro inesperado ao processar guias de internação em '{nome_base_arquivo}': {e}")
+        return []
+
+def _ancestrais_conferem(elemento, caminho_ancestrais, elemento_final):
+    """True se os ancestrais de 'elemento' forem exatamente 'caminho_ancestrais' seguidos de 'elemento_final'."""
+    pai = elemento.getparent()
+    for tag_esperada in caminho_ancestrais:
+        if pai is None or pai.tag != tag_esperada:
+            return False
+        pai = pai.getparent()
+    return pai is elemento_final
+
+def _percorrer_guias_internacao(stream_xml, numero_fatura_pai, codigos_hm_t00_a_ignorar, valor_minimo_guia, nome_base_arquivo):
+    map_tipo_internacao = { "1": "Hospitalar", "2": "Hospital-dia", "3": "Domiciliar" }
+    guias_internacao_filtradas = []
+    indice_guia = 0
+    guia_atual = None           # estado da guiaInternacao aberta
+    procedimentos_abertos = []  # procedimentosExecutados abertos dentro da guia
+
+    for evento, elemento in etree.iterparse(stream_xml, events=('start', 'end'), recover=True):
+        tag = elemento.tag
+        if evento == 'start':
+            if tag == _TAG_GUIA_INTERNACAO and guia_atual is None:
+                indice_guia += 1
+                guia_atual = {'elemento': elemento, 'nr_guia': None, 'id_benef': None, 'nm_benef': None,
+                              'rg_internacao': None, 'procedimentos': []}
+            elif tag == _TAG_PROCEDIMENTOS_EXECUTADOS and guia_atual is not None:
+                pai = elemento.getparent()
+                procedimento = {'direto': pai is not None and pai.tag == _TAG_DADOS_GUIA and pai.getparent() is guia_atual['elemento'],
+                                'tp_tabela': None, 'cd_servico': None,
+                                'vl_serv': None, 'tx_adm': None, 'vl_co': None, 'tx_adm_co': None}
+                guia_atual['procedimentos'].append(procedimento)
+                procedimentos_abertos.append(procedimento)
+            continue
+
+        if guia_atual is not None:
+            if tag in _CAMPOS_PROCEDIMENTO_STREAMING and procedimentos_abertos:
+                tag_pai, chave = _CAMPOS_PROCEDIMENTO_STREAMING[tag]
+                pai = elemento.getparent()
+                if pai is not None and pai.tag == tag_pai:
+                    # Equivale ao último resultado de './/ptu:<pai>/ptu:<campo>' em cada procedimento aberto
+                    for procedimento in procedimentos_abertos:
+                        procedimento[chave] = elemento.text
+            elif tag in _CAMPOS_GUIA_STREAMING:
+                caminho_ancestrais, chave = _CAMPOS_GUIA_STREAMING[tag]
+                if _ancestrais_conferem(elemento, caminho_ancestrais, guia_atual['elemento']):
+                    guia_atual[chave] = elemento.text
+            elif tag == _TAG_PROCEDIMENTOS_EXECUTADOS and procedimentos_abertos:
+                procedimentos_abertos.pop()
+            elif tag == _TAG_GUIA_INTERNACAO and elemento is guia_atual['elemento']:
+                guia_info = _finalizar_guia_streaming(guia_atual, indice_guia, numero_fatura_pai, codigos_hm_t00_a_ignorar,
+                                                      valor_minimo_guia, map_tipo_internacao, nome_base_arquivo)
+                if guia_info:
+                    guias_internacao_filtradas.append(guia_info)
+                guia_atual = None
+                procedimentos_abertos = []
+
+        # Subárvore concluída: libera o elemento e os irmãos anteriores já processados.
+        elemento.clear(keep_tail=True)
+        pai = elemento.getparent()
+        if pai is not None:
+            while elemento.getprevious() is not None:
+                del pai[0]
+
+    if _RASTRO.ativo: _RASTRO.registrar("guias_internacao_encontradas", arquivo=nome_base_arquivo, quantidade=indice_guia)
+    if indice_guia == 0:
+        logging.info(f"Nenhuma tag <ptu:guiaInternacao> encontrada em '{nome_base_arquivo}'.")
+    return guias_internacao_filtradas
+
+def _finalizar_guia_streaming(guia_atual, indice_guia, numero_fatura_pai, codigos_hm_t00_a_ignorar,
+                              valor_minimo_guia, map_tipo_internacao, nome_base_arquivo):
+    nr_guia = guia_atual['nr_guia'].strip() if guia_atual['nr_guia'] is not None else f"GuiaDesconhecida_{indice_guia}"
+    codigo_beneficiario = guia_atual['id_benef'].strip() if guia_atual['id_benef'] is not None else ""
+    nome_beneficiario = guia_atual['nm_benef'].strip() if guia_atual['nm_benef'] is not None else ""
+    rg_internacao_cod = guia_atual['rg_internacao'].strip() if guia_atual['rg_internacao'] is not None else ""
+    tipo_internacao_desc = map_tipo_internacao.get(rg_internacao_cod, f"Cod:{rg_internacao_cod}")
+
+    # Mesma regra do DOM: procedimentos diretos em dadosGuia têm prioridade sobre os demais descendentes
+    procedimentos = [p for p in guia_atual['procedimentos'] if p['direto']] or guia_atual['procedimentos']
+
+    valor_total_guia_calc_para_filtro = 0.0
+    valor_total_real_da_guia = 0.0
+    for j, procedimento in enumerate(procedimentos):
+        valor_procedimento_atual_para_soma = 0.0
+        for chave, nome_campo in (('vl_serv', "vl_ServCobrado"), ('tx_adm', "tx_AdmServico"),
+                                  ('vl_co', "vl_CO_Cobrado"), ('tx_adm_co', "tx_AdmCO")):
+            if procedimento[chave] is not None:
+                valor_procedimento_atual_para_soma += _try_parse_float(procedimento[chave], nome_campo, nr_guia, nome_base_arquivo)
+        valor_total_real_da_guia += valor_procedimento_atual_para_soma
+
+        tp_Tabela_atual = procedimento['tp_tabela'].strip() if procedimento['tp_tabela'] is not None else None
+        cd_Servico_atual = procedimento['cd_servico'].strip() if procedimento['cd_servico'] is not None else None
+        if tp_Tabela_atual == '22':
+            decisao_filtro = "ignorado (Tabela 22)"
+        elif tp_Tabela_atual == '00' and cd_Servico_atual and cd_Servico_atual in codigos_hm_t00_a_ignorar:
+            decisao_filtro = f"ignorado (HM Tabela 00 (Cód: {cd_Servico_atual}))"
+        elif tp_Tabela_atual in ['00', '18', '19', '20']:
+            valor_total_guia_calc_para_filtro += valor_procedimento_atual_para_soma
+            decisao_filtro = "somado"
+        else:
+            decisao_filtro = "nao_somado"
+
+        if _RASTRO.ativo: _RASTRO.registrar("procedimento", arquivo=nome_base_arquivo, guia=nr_guia, indice=j+1,
+                                            tp_tabela=tp_Tabela_atual, cd_servico=cd_Servico_atual,
+                                            valor=valor_procedimento_atual_para_soma, decisao_filtro=decisao_filtro,
+                                            total_filtro=valor_total_guia_calc_para_filtro, total_real=valor_total_real_da_guia)
+
+    guia_relevante = valor_total_guia_calc_para_filtro >= valor_minimo_guia
+    if _RASTRO.ativo: _RASTRO.registrar("guia", arquivo=nome_base_arquivo, fatura=numero_fatura_pai, guia=nr_guia,
+                                        beneficiario=codigo_beneficiario, tipo_internacao=tipo_internacao_desc,
+                                        valor_filtro=valor_total_guia_calc_para_filtro,
+                                        valor_real=valor_total_real_da_guia, adicionada=guia_relevante)
+    if not guia_relevante:
+        return None
+    return {
+        "fatura_pai": numero_fatura_pai,
+        "numero_guia": nr_guia,
+        "codigo_beneficiario": codigo_beneficiario,
+        "nome_beneficiario": nome_beneficiario,
+        "tipo_internacao": tipo_internacao_desc,
+        "valor_filtro": valor_total_guia_calc_para_filtro,
+        "valor_total_real": valor_total_real_da_guia
+    }
+
 if __name__ == '__main__':
     logging.info("Executando xml_parser.py como script principal para teste.")
     